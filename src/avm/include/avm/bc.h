@@ -14,7 +14,7 @@
  * generated by the compiler.
  */
 
-#define BC_VERSION  1
+#define BC_VERSION  3
 #define BC_MAGIC    "<ABC"
 
 typedef unsigned char   _bc8;
@@ -40,6 +40,8 @@ struct __attribute__((packed)) bc_hdr
     _bc_ptr hdr_off_oname;      /* source name */
     _bc_ptr hdr_off_mname;      /* module name */
     _bc_ptr hdr_off_func;       /* main function name */
+    _bc_ptr hdr_off_sym;        /* symbol table */
+    _bc_ptr hdr_off_lines;      /* compact line table */
 };
 
 /* Single instruction */
@@ -52,15 +54,27 @@ struct bc_ins
     _bc8    ins_payload[];      /* payload */
 };
 
-/* Symbol, also known as a function. sym_ptr points to the start of the
+/* Symbol, also known as a function. sym_pos points to the start of the
    BCO_FUNCTION instruction. */
 
 struct bc_sym
 {
     _bc_ptr sym_pos;            /* location of symbol in file */
-    _bc16   sym_len;            /* length of symbol */
+    _bc16   sym_len;            /* length of the name */
     _bc16   sym_flags;          /* symbol flags */
-    _bc8    *sym_ptr;           /* pointer to symbol */
+    _bc_ptr sym_name;           /* name of the symbol */
+};
+
+/* Symbol table in the data segment, pointed to by hdr_off_sym. It is followed
+   by st_count bc_sym structures and an index of st_size _bc32 slots, each
+   holding the position of a symbol plus one, or 0 if the slot is empty. A
+   symbol is found by hashing its name with CRC-32 and probing the slots from
+   hash % st_size onwards. */
+
+struct bc_symtab
+{
+    _bc32   st_count;           /* amount of symbols */
+    _bc32   st_size;            /* amount of slots, a power of two */
 };
 
 /* Every instruction (with debug symbols) should point to a bc_source structure
@@ -73,11 +87,37 @@ struct bc_source
     _bc8    src_data[];         /* the actual string */
 };
 
+/* Compact line table in the data segment, pointed to by hdr_off_lines and used
+   instead of bc_source structures. It is followed by ln_count _bc_ptr values
+   pointing to the source of each line starting from line 1 (or 0 if the line
+   has no code), and by ln_size bytes of delta pairs. Each pair is an unsigned
+   code offset increment in BC_LINES_UNIT bytes and a signed line increment,
+   starting at the code segment and line 0. An increment of BC_LINES_NONE means
+   the instructions have no line, and the next increment is added to the line
+   before it. Offset increments over 255 are preceded by pairs of 255 and 0,
+   or 255 and BC_LINES_NONE while the instructions have no line. */
+
+struct bc_lines
+{
+    _bc32   ln_count;           /* amount of lines */
+    _bc32   ln_size;            /* size of the delta pairs */
+};
+
 /* Universal values */
 
 #define BC_FALSE            0x00
 #define BC_TRUE             0x01
 
+/* Symbol table hash (reversed CRC-32 polynomial) */
+
+#define BC_HASH_POLY        0xedb88320
+
+/* Line table offsets are counted in this many bytes, and the line increment
+   marking instructions without a line */
+
+#define BC_LINES_UNIT       4
+#define BC_LINES_NONE       -128
+
 /* hdr_sys */
 
 #define BC_SYS_UNKNOWN      0x00
@@ -93,6 +133,7 @@ struct bc_source
 
 #define BCF_HDR_BUILTIN     0x00000001      /* builtin module */
 #define BCF_HDR_STANDALONE  0x00000002      /* no dependencies */
+#define BCF_HDR_STREAMED    0x00000004      /* strings shared per block */
 
 /* sym_flags */
 
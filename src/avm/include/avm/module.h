@@ -33,6 +33,7 @@ struct module
     struct object      _self;
     unsigned int       m_nsyms;     /* amount of symbols */
     struct bc_sym      *m_syms;     /* symbols */
+    struct bc_symtab   *m_symtab;   /* symbol table */
     unsigned int       m_size;      /* size of the code */
 
     union
@@ -50,5 +51,9 @@ struct module
    opposite of this function is the _self.o_dtor function. */
 int module_load(struct module *module, char *path, int flags);
 
+/* Find the symbol with the given name using the hashed index of the symbol
+   table, returns NULL if there is no such symbol. */
+struct bc_sym *module_sym(struct module *module, char *name);
+
 
 #endif /* AVM_MODULE_H */
@@ -78,7 +78,15 @@ int module_load(struct module *module, char *path, int flags)
         module->m_header->hdr_off_mname);
     module->m_nsyms = 0;
     module->m_syms = NULL;
-    /* todo: Map symbols */
+    module->m_symtab = NULL;
+
+    /* The symbols are used straight from the mapped symbol table. */
+    if (module->m_header->hdr_off_sym) {
+        module->m_symtab = PTR_ADD(module->m_code,
+            module->m_header->hdr_off_sym);
+        module->m_nsyms = module->m_symtab->st_count;
+        module->m_syms = PTR_ADD(module->m_symtab, sizeof(struct bc_symtab));
+    }
     module->_self.o_flags |= AO_LOADED;
     module->m_size = module->m_header->hdr_size;
 
@@ -89,6 +97,37 @@ int module_load(struct module *module, char *path, int flags)
     return 0;
 }
 
+struct bc_sym *module_sym(struct module *module, char *name)
+{
+    _bc32 *slots;
+    _bc32 hash = 0xffffffff;
+    _bc32 mask, slot;
+    size_t len;
+    int bit;
+
+    if (!module->m_symtab)
+        return NULL;
+
+    for (len = 0; name[len]; len++) {
+        hash ^= (_bc8) name[len];
+        for (bit = 0; bit < 8; bit++)
+            hash = (hash >> 1) ^ (BC_HASH_POLY & -(hash & 1));
+    }
+    hash = ~hash;
+
+    slots = (_bc32 *) &module->m_syms[module->m_nsyms];
+    mask = module->m_symtab->st_size - 1;
+
+    for (slot = hash & mask; slots[slot]; slot = (slot + 1) & mask) {
+        struct bc_sym *sym = &module->m_syms[slots[slot] - 1];
+        if (sym->sym_len == len && !memcmp(
+                PTR_ADD(module->m_code, sym->sym_name), name, len))
+            return sym;
+    }
+
+    return NULL;
+}
+
 static int module_dtor(struct object *self)
 {
     struct module *module = (struct module *) self;
@@ -1,35 +1,179 @@
 """
 The entrypoint. Calls functions to compile the program.
 """
-import argparse
+import os
+import sys
+from types import SimpleNamespace
 
-import ac_parser
-from astro_file import AstroFile
+import build
+import stats
 from tokenizer import Tokenizer
 
 __author__  = 'xyLotus, bellrise'
 
 
+# Values of the options that are not given on the command line, shared by
+# argparse and the fast path for plain lists of source paths.
+_DEFAULTS = {
+    'noerr': False,
+    'tokenizer': Tokenizer.ENGINE_SCAN,
+    'compact': False,
+    'stream': False,
+    'output': None,
+    'jobs': 1,
+    'dump': False,
+    'cache_dir': None,
+    'cache_size': 64,
+    'cache_age': 7,
+    'stats': False,
+    'stats_json': None,
+    'watch': False,
+    'optimize': (),
+    'opt_rules': 'all',
+    'prune': False,
+    'strip_debug': False,
+    'line_table': False,
+}
+
+
+def argument_parser():
+    """Create the parser of the command line arguments. """
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Compile Astro source code '
+                                     'into bytecode.')
+    parser.add_argument('src', nargs='+', help='Paths to source files or '
+                        'directories containing them')
+    parser.add_argument('--noerr', action='store_true', help='Catches all '
+                        'errors at compilation runtime')
+    parser.add_argument('--tokenizer', choices=[Tokenizer.ENGINE_SCAN,
+                                                Tokenizer.ENGINE_LEGACY],
+                        help='Tokenizer engine to use')
+    parser.add_argument('--compact', action='store_true', help='Store tokens '
+                        'in a compact token stream (scan engine only)')
+    parser.add_argument('--stream', action='store_true', help='Compile the '
+                        'source line by line, keeping the memory used flat')
+    parser.add_argument('-o', '--output', help='Path to the bytecode file, '
+                        'defaults to the source path with an .abc extension. '
+                        'Only allowed with a single source file')
+    parser.add_argument('-j', '--jobs', type=int, help='Amount '
+                        'of files to compile in parallel, 0 for all cores')
+    parser.add_argument('--dump', action='store_true', help='Print the '
+                        'tokens and generated instructions')
+    parser.add_argument('--cache-dir', help='Reuse bytecode compiled from '
+                        'the same source, stored in this directory')
+    parser.add_argument('--cache-size', type=int, help='Maximum '
+                        'size of the cache in MiB (default: 64)')
+    parser.add_argument('--cache-age', type=float, help='Remove '
+                        'cache entries unused for this many days (default: 7)')
+    parser.add_argument('--stats', action='store_true', help='Print the '
+                        'time and peak memory of each compilation stage')
+    parser.add_argument('--stats-json', metavar='PATH', help='Write the '
+                        'statistics as JSON to this path, - for stdout')
+    parser.add_argument('--watch', action='store_true', help='Keep running '
+                        'and recompile the functions changed in the sources')
+    parser.add_argument('-O', '--optimize', action='store_true', help='Run '
+                        'the peephole optimizer on the instructions')
+    parser.add_argument('--opt-rules', metavar='RULES', help='Comma '
+                        'separated optimizer rules to run, out of nop, '
+                        'create_assign and empty_if (default: all)')
+    parser.add_argument('--prune', action='store_true', help='Remove the '
+                        'functions which cannot be called from main')
+    parser.add_argument('--strip-debug', action='store_true', help='Leave '
+                        'out the source lines of the instructions')
+    parser.add_argument('--line-table', action='store_true', help='Store '
+                        'the source lines in a compact line table')
+    parser.set_defaults(**_DEFAULTS)
+    return parser
+
+
+def parse_args(argv: list):
+    """Parse the command line arguments. Build steps mostly pass nothing but
+    source paths, which skip argparse, because importing and setting it up
+    takes longer than compiling a small file. """
+    if argv and not any(arg.startswith('-') for arg in argv):
+        return SimpleNamespace(src=argv, **_DEFAULTS)
+
+    parser = argument_parser()
+    args = parser.parse_args(argv)
+    if args.optimize:
+        from optimize import Optimizer
+        args.optimize = Optimizer.parse_rules(args.opt_rules)
+        unknown = set(args.optimize) - set(Optimizer.RULES)
+        if unknown:
+            parser.error(f'unknown optimization rules: {", ".join(unknown)}')
+    return args
+
+
 def main():
     """Collect command line arguments and call the functions. """
 
-    parser = argparse.ArgumentParser(description='Compile Astro source code '
-                                     'into bytecode.')  
-    parser.add_argument('src', help='Path to source code')
-    parser.add_argument('--noerr', action='store_true', help='Catches all errors'
-                        'at compilation runtime')
+    args = parse_args(sys.argv[1:])
+    args.stats = args.stats or args.stats_json is not None
+
+    sources = build.collect_sources(args.src)
+    if args.output and len(sources) > 1:
+        argument_parser().error('-o can only be used with a single source '
+                                'file')
+    options = build.Options.from_args(args)
+    jobs = args.jobs or os.cpu_count()
+
+    if args.watch:
+        import deps
+        import watch
+        graph = deps.DependencyGraph(sources)
+        try:
+            order = graph.order()
+        except ValueError as e:
+            print(e, file=sys.stderr)
+            sys.exit(1)
+        watch.watch([watch.IncrementalBuild(src, args.output, options,
+                                            graph.imports[src])
+                     for src in order])
+        return
+
+    cache = None
+    if args.cache_dir:
+        from cache import CompileCache
+        cache = CompileCache(args.cache_dir, args.cache_size << 20,
+                             args.cache_age * 24 * 3600)
+
+    if args.output:
+        results = [build.build_one(sources[0], args.output, options, cache)]
+    else:
+        try:
+            results = build.build_many(sources, options, jobs, cache)
+        except ValueError as e:
+            print(e, file=sys.stderr)
+            sys.exit(1)
 
-    args = parser.parse_args()
+    for result in results:
+        sys.stdout.write(result.stdout)
+        sys.stderr.write(result.stderr)
 
-    file_obj = AstroFile(args.src)
-    tokenizer = Tokenizer(file_obj)
-    tokenizer.tokenize()
-    print(tokenizer.tokens)
+    if args.stats:
+        reports = {r.src: r.stats for r in results}
+        if args.stats_json == '-':
+            stats.dump_json(reports, sys.stdout)
+        elif args.stats_json:
+            with open(args.stats_json, 'w') as f:
+                stats.dump_json(reports, f)
+        else:
+            for src, report in reports.items():
+                print(stats.format_report(src, report), file=sys.stderr)
 
-    from pprint import pp
-    parsed = ac_parser.Parser(args.src, tokenizer.get_context())
-    pp(parsed.parse())
+    if cache is not None:
+        # Workers count on their own copies of the cache
+        cache.hits = sum(r.cached for r in results if r.ok)
+        cache.misses = sum(not r.cached for r in results if r.ok)
+        cache.evict()
+        print(cache.report(), file=sys.stderr)
 
+    failed = [r.src for r in results if not r.ok]
+    if failed:
+        print(f'{len(failed)} of {len(results)} files failed to compile',
+              file=sys.stderr)
+        sys.exit(1)
 
 if __name__ == '__main__':
     main()
@@ -1,8 +1,9 @@
 """
 The parser.
 """
-from typing import List, Callable, Optional, Any
-from astro_types import TokenType, Token
+from __future__ import annotations
+from collections.abc import Callable
+from astro_types import LineContext, TokenType, Token, WHITESPACE
 import sys
 import avm
 import re
@@ -24,7 +25,7 @@ class Variable:
 
     name: str
     origin: int
-    value: Any
+    value: object
 
     def __init__(self, name, value, origin):
         """Create a new variable object. """
@@ -42,11 +43,41 @@ class Variable:
 
 class CodeBlock:
     """Each code block represents a single group, like a function or module.
-    The internal `code` list contains either token contexts, or CodeBlocks
-    which create a tree starting from the main CodeBlock. """
+    The internal `code` list contains either line contexts, or CodeBlocks
+    which create a tree starting from the main CodeBlock. The context of the
+    line opening the block is stored in `ctx`, which is None for the module.
+    """
 
-    code = []
-    locals: List[Variable] = []
+    __slots__ = ('ctx', 'name', 'code', 'locals')
+
+    def __init__(self, ctx: LineContext = None, name: str = None):
+        """Create an empty code block.
+        :param ctx: context of the line opening the block
+        :param name: name of the function or module
+        """
+        self.ctx = ctx
+        self.name = name
+        self.code = []
+        self.locals = []
+
+    def contexts(self):
+        """Yield every token context in the block and the blocks inside of
+        it in source order, including the lines opening the blocks. """
+        if self.ctx is not None:
+            yield self.ctx
+        stack = [iter(self.code)]
+        while stack:
+            for item in stack[-1]:
+                if isinstance(item, CodeBlock):
+                    yield item.ctx
+                    stack.append(iter(item.code))
+                    break
+                yield item
+            else:
+                stack.pop()
+
+    def __repr__(self):
+        return f'<CodeBlock {self.name}, {len(self.code)} items>'
 
 
 class Parser:
@@ -76,33 +107,48 @@ class Parser:
         )
     }
 
-    def __init__(self, filename: str, tokens: List[dict], trust_me=False):
+    # Signatures compiled by compile_signatures, grouped by the first token
+    # ID, along with a cache of already matched token ID tuples.
+    _dispatch = None
+    _match_cache = None
+    match_cache_size = 4096
+
+    def __init__(self, filename: str, tokens: list[LineContext],
+                 trust_me=False, source_file=None):
         """Setup the parser instance. This takes a token list. To actually
         start the parsing process, call parse() on the created object.
         :param filename: path to the file currently being compiled
-        :param tokens:   list of context groups
+        :param tokens:   list of line contexts
         :param trust_me: True if the parser should trust the developer with
-                         the data format
+                         the data format, which skips checking every line
+        :param source_file: the AstroFile the tokens come from, problems are
+                            reported in its original source if given
         """
         self.filename = filename
         self.tokens = tokens
+        self.source_file = source_file
         self.checks = []
+        self.tree = None
+
+        # Width of a single indent, found by calculate_indents if not set
+        self.indent_width = 0
 
         # This is set in trap_errors
         self.error_callback = None
 
-        if not trust_me:
-            if not isinstance(tokens[0], dict):
-                raise TypeError('token context should be a dict')
+        if type(self).__dict__.get('_dispatch') is None:
+            type(self).compile_signatures()
 
-            required_fields = 'line', 'source', 'tokens'
+        if not trust_me:
             for token in tokens:
-                if not all(key in token for key in required_fields):
-                    raise KeyError('missing keys in token context')
+                if not isinstance(token, LineContext):
+                    raise TypeError('token context should be a LineContext')
 
     def parse(self, checks=...) -> list:
         """Start parsing the provided token list, turning it into a syntax
-        tree that can then be synthesized into bytecode.
+        tree that can then be synthesized into bytecode. Returns the line
+        contexts with the type and indent fields set, the tree is stored in
+        self.tree.
         :param checks: a list of checks the parser should run, by default
                        all checks are enabled
         """
@@ -112,153 +158,218 @@ class Parser:
         self.calculate_indents()
 
         categorized_tokens = []
+        match = self.match
         for token_ctx in self.tokens:
-            tokens = token_ctx['tokens']
-            result = self.match(tokens)
+            result = match(token_ctx.tokens)
             if result is None:
                 self.error(token_ctx, 'invalid syntax')
-            token_ctx['type'] = result
+            token_ctx.type = result
             categorized_tokens.append(token_ctx)
 
-        tree = self.collect(categorized_tokens)
+        self.tree = self.collect(categorized_tokens)
+        return categorized_tokens
 
-        # Debug
-        from pprint import pp
-        pp(tree)
-
-        return []
-
-    def collect(self, tokens: List[dict]) -> List[CodeBlock]:
-        """Collect all token contexts into CodeBlocks. Uses the 'indent' field
+    def collect(self, tokens: list[LineContext]) -> CodeBlock:
+        """Collect all line contexts into CodeBlocks. Uses the indent field
         provided by calculate_indents to collect statements under functions.
         Each CodeBlock is a separate function or module that has a name and
-        a scope.
-        :param tokens: list of token contexts
+        a scope. A line indented deeper than the line before it opens a
+        block under that line, and a function always opens one. Blank lines
+        go into the innermost open block. Returns the module block.
+        :param tokens: list of line contexts
         """
-        # todo: implement this.
-        pass
+        module = CodeBlock(name=self.filename)
 
-    def match(self, tokens: List[Token]) -> Optional[int]:
-        """Match a token list to a statement type, and then return the BCO_
-        opcode of the type to parse it. We first fetch only the token IDs
-        and that are not spaces. Then iterate through the signatures using
-        similar to regex rules: if a ellipsis (...) is found in the middle,
-        it skips n tokens until it finds the next type in the signature. If
-        the ellipsis is at the end, it matches anything.
-        :param tokens: list of token contexts
-        :return: token ID or None if not matched
-        """
-        tokens = [tok.id for tok in tokens if tok.id is not TokenType.SPACE]
-        if not tokens:
-            return avm.BCO_NOP
+        # stack[n] is the open block holding the lines with an indent of n
+        stack = [module]
+        last = -1
 
-        for id_, sig in self.signatures.items():
-            # Check each signature for a matching one
-            tok_index = 0
+        for ctx in tokens:
+            type_ = ctx.type
+            if type_ == avm.BCO_NOP:
+                stack[-1].code.append(ctx)
+                continue
 
+            depth = ctx.indent + 1
+            if depth < len(stack):
+                del stack[depth:]
+            elif depth > len(stack) and last >= 0:
+                # calculate_indents allows only a single level deeper, so
+                # the last statement in the current block opens a new one
+                parent = stack[-1]
+                block = CodeBlock(parent.code[last])
+                block.code = parent.code[last+1:]
+                del parent.code[last+1:]
+                parent.code[last] = block
+                stack.append(block)
+
+            code = stack[-1].code
+            if type_ == avm.BCO_FUNCTION:
+                name = next((tok.value for tok in ctx.tokens
+                             if tok.id == TokenType.NAME), None)
+                block = CodeBlock(ctx, name)
+                code.append(block)
+                stack.append(block)
+                last = -1
+            else:
+                last = len(code)
+                code.append(ctx)
+
+        return module
+
+    @classmethod
+    def compile_signatures(cls):
+        """Compile the signatures into a dispatch table. Each signature is
+        turned into a regular expression over the token IDs (as characters),
+        and all signatures starting with the same token are joined into a
+        single pattern, keeping their order. This has to be called again if
+        the signatures are changed after creating a parser.
+        """
+        groups = {}
+        for id_, sig in cls.signatures.items():
             if sig[0] is ...:
                 raise SyntaxError('invalid signature: cannot start with any')
 
+            pattern = ''
             for sig_index, element in enumerate(sig):
-                # If the element in the signature is an ellipsis, skip until it
-                # finds the next element in the token list or to the end if no
-                # element is found after the ellipsis.
-                if element is ...:
-                    if sig_index - 1 == len(sig):
-                        return id_
-                    if sig_index + 1 >= len(sig):
-                        return id_
-                    if sig[sig_index+1] is ...:
-                        raise SyntaxError('invalid signature: 2 any fields')
-
-                    pos = tokens[tok_index:].index(sig[sig_index+1])
-                    if pos == -1:
-                        # If the next token hasn't been found, skip to another
-                        # signature.
-                        break
-
-                    # We have to take in account that we're taking a slice of
-                    # the tokens list
-                    tok_index += pos
+                if element is not ...:
+                    pattern += re.escape(chr(element))
                     continue
 
-                if not element == tokens[tok_index]:
-                    break
+                # An ellipsis at the end matches anything, otherwise it skips
+                # tokens until the first occurrence of the next element.
+                if sig_index + 1 >= len(sig):
+                    pattern += '.*'
+                    continue
+                if sig[sig_index+1] is ...:
+                    raise SyntaxError('invalid signature: 2 any fields')
+                pattern += f'[^{re.escape(chr(sig[sig_index+1]))}]*'
 
-                tok_index += 1
+            groups.setdefault(sig[0], []).append((id_, pattern))
 
-            # We found a match!
-            if tok_index == len(tokens):
-                return id_
+        cls._dispatch = {}
+        for first, sigs in groups.items():
+            regex = '|'.join(
+                f'(?P<s{index}>{pattern})\\Z'
+                for index, (_, pattern) in enumerate(sigs)
+            )
+            opcodes = {f's{index}': id_ for index, (id_, _) in enumerate(sigs)}
+            cls._dispatch[first] = re.compile(regex, re.DOTALL), opcodes
 
-        return None
+        cls._match_cache = {}
+
+    def match(self, tokens: list[Token]) -> int | None:
+        """Match a token list to a statement type, and then return the BCO_
+        opcode of the type to parse it. We first fetch only the token IDs
+        and that are not spaces. Then look up the signatures starting with
+        the first token, which use similar to regex rules: if a ellipsis
+        (...) is found in the middle, it skips n tokens until it finds the
+        next type in the signature. If the ellipsis is at the end, it
+        matches anything. Results are cached for each token ID tuple.
+        :param tokens: list of token contexts
+        :return: token ID or None if not matched
+        """
+        ids = tuple(tok.id for tok in tokens if tok.id not in WHITESPACE)
+        if not ids:
+            return avm.BCO_NOP
+
+        cache = self._match_cache
+        if ids in cache:
+            return cache[ids]
+
+        result = None
+        if ids[0] in self._dispatch:
+            regex, opcodes = self._dispatch[ids[0]]
+            found = regex.match(''.join(map(chr, ids)))
+            if found:
+                result = opcodes[found.lastgroup]
+
+        if len(cache) >= self.match_cache_size:
+            cache.clear()
+        cache[ids] = result
+        return result
 
     def calculate_indents(self):
-        """Count the indents for every token array in self.tokens, and add
-        a brand new field named 'indent' with the amount of indentations. The
+        """Count the indents for every line context in self.tokens, and set
+        their indent field to the amount of indentations. The
         chosen amount of indents is the first found amount. If real tabs (\t)
         are used, they are counted as 4 spaces which is interchangeable with
-        4 actual spaces.
+        4 actual spaces, and the width is stored in self.indent_width.
         """
-        width = 0
-
-        # Replace tabs with 4 spaces
-        for index, tok in enumerate(self.tokens):
-            self.tokens[index]['tokens'] = [
-                Token(TokenType.SPACE, ' ') * 4 if t.id == TokenType.TAB
-                else t
-                for t in tok['tokens']
-            ]
-
-        for index, context in enumerate(self.tokens):
-            context['indent'] = 0
+        for _ in self._indents(self.tokens):
+            pass
+
+    def stream(self, contexts):
+        """Yield the line contexts with the indent and type fields set, one
+        by one as they come in. This does the same as parse() without
+        building the syntax tree, so the contexts can be generated lazily
+        and nothing is kept around once they have been passed on.
+        :param contexts: iterable of line contexts
+        """
+        match = self.match
+        for ctx in self._indents(contexts):
+            result = match(ctx.tokens)
+            if result is None:
+                self.error(ctx, 'invalid syntax')
+            ctx.type = result
+            yield ctx
+
+    def _indents(self, contexts):
+        """Yield the contexts with the indent field set, see
+        calculate_indents. """
+        width = self.indent_width
+        previous = 0
+        for index, context in enumerate(contexts):
+            context.indent = 0
             # We need to skip the first line because of index stuff down below
-            if not context['tokens'] or index == 0:
+            if not context.tokens or index == 0:
+                yield context
                 continue
 
-            if context['tokens'][0].id == TokenType.SPACE:
+            tab = self._indent_width(context.source)
+            if tab:
                 if not width:
-                    # If the tab size wasn't defined yet, count it
-                    width = self._count_continuous(context['source'], ' ')
-
-                # If the tab size isn't the same as the defined width, throw
-                # a nice little indentation error width complex math trying to
-                # guess your tab size.
-                tab = self._count_continuous(context['source'], ' ')
-                if tab % width != 0 or (tab - width > width):
+                    # If the tab size wasn't defined yet, use this one
+                    width = self.indent_width = tab
+
+                # If the tab size isn't a multiple of the defined width, or
+                # the line is indented more than one level deeper than the
+                # previous line with code, throw a nice little error.
+                if tab % width != 0 or tab // width > previous + 1:
                     should_be = width
                     if tab > width:
-                        previous = self.tokens[index-1].get('indent', 0)
                         should_be = previous * width + width
 
                     self.error(
-                        context, f'invalid indent of {tab}, should be {should_be}',
+                        context,
+                        f'invalid indent of {tab}, should be {should_be}',
                         size=tab, tab=False
                     )
 
-                context['indent'] = tab // width
+                context.indent = tab // width
+
+            previous = context.indent
+            yield context
 
     @staticmethod
-    def _count_continuous(string, char) -> int:
-        """Count the amount of continuous chars from the start of the string.
+    def _indent_width(string: str) -> int:
+        """Return the width of the whitespace at the start of the string,
+        counting tabs as 4 spaces.
         :param string: string to count on
-        :param char: single character to compare
         """
-        counter = 0
-        for c in string:
-            if c is not char:
-                break
-            counter += 1
-        return counter
-
-    def trap_errors(self, callback: Callable[[str, dict], None]):
+        stripped = string.lstrip(' \t')
+        lead = string[:len(string) - len(stripped)]
+        return len(lead) + 3 * lead.count('\t')
+
+    def trap_errors(self, callback: Callable[[str, LineContext], None]):
         """Catch any errors that could close the parser, passing the error
-        message and the token context to the function.
+        message and the line context to the function.
         :param callback: a function that will be called when an error occurs.
         """
         self.error_callback = callback
 
-    def error(self, ctx: dict, *msg, at=0, size=0, tab=True, sep=' '):
+    def error(self, ctx: LineContext, *msg, at=0, size=0, tab=True,
+              sep=' '):
         """Print a compilation error and exit.
         :param ctx: line context - index, filename and source
         :param msg: any amount of data to print after that
@@ -274,7 +385,8 @@ class Parser:
                             size=size, tab=tab, sep=sep)
         exit(1)
 
-    def warn(self, ctx: dict, *msg, at=0, size=0, tab=True, sep=' '):
+    def warn(self, ctx: LineContext, *msg, at=0, size=0, tab=True,
+             sep=' '):
         """Print a warning.
         :param ctx: line context - index, filename and source
         :param msg: any amount of data to print after that
@@ -289,21 +401,32 @@ class Parser:
     def _print_problem(self, title, ctx, *msg, at, size, tab, sep):
         msg = sep.join([str(x) for x in msg])
         if not size:
-            size = len(ctx['source'])
+            size = len(ctx.source)
         if self.error_callback:
             self.error_callback(msg, ctx)
             return
 
         # We want to skip whitespace for the squiggly but only if tab is True
-        match = re.match(r'^\s*', ctx['source'])
+        match = re.match(r'^\s*', ctx.source)
         if tab and match:
             offset = match.span()[1]
             size -= offset
             at += offset
 
+        line, source = ctx.line, ctx.source
+        if self.source_file is not None:
+            # Lines collapsed out of a block comment do not look like any
+            # line in the file, so point at the original one instead
+            try:
+                line, at, source = self.source_file.original_source(line, at)
+            except (OSError, ValueError):
+                pass
+            else:
+                size = max(1, min(size, len(source) - at))
+
         print(
             f'{title} in {self.filename}:\n',
-            f'{ctx["line"]:4} | {ctx["source"]}\n',
+            f'{line:4} | {source}\n',
             ' ' * 7, ' ' * at, '^' + '~' * (size - 1), '\n',
             msg, sep='', file=sys.stderr
         )
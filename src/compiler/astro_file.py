@@ -1,24 +1,92 @@
 """
 File wrapper for the tokenizer.
 """
+import mmap
+import os
 import re
+from array import array
+from bisect import bisect_right
 
 __author__  = 'xyLotus, bellrise'
 __version__ = '0.0.5'
 
 
+_BLOCK_COMMENT = re.compile(r'(;;[\n\w\s]*;;)+')
+
+# A block comment may continue on the next line if the line has an opening
+# ';;' followed only by word characters or whitespace, or if it is already
+# inside of a comment and contains nothing else.
+_BLOCK_OPEN = re.compile(r';;[\w\s]*$')
+_BLOCK_BODY = re.compile(r'[\w\s]*')
+
+
+def _line_starts(content: str) -> array:
+    """Return the offsets at which every line in the string starts. """
+    starts = array('I', [0])
+    pos = content.find('\n')
+    while pos != -1:
+        starts.append(pos + 1)
+        pos = content.find('\n', pos + 1)
+    return starts
+
+
+def blank_block_comments(content: str) -> str:
+    """Replace every block comment with spaces, so the columns of the code
+    after the comment stay the same. """
+    pieces = []
+    last = 0
+    for match in _BLOCK_COMMENT.finditer(content):
+        start, end = match.span()
+        pieces.append(content[last:start])
+        pieces.append(' ' * (end - start))
+        last = end
+    pieces.append(content[last:])
+    return ''.join(pieces)
+
+
+def comment_open(line: str, is_open: bool) -> bool:
+    """Return whether a block comment may still be open after the line,
+    given whether one was open before it. """
+    if _BLOCK_OPEN.search(line):
+        return True
+    return is_open and bool(_BLOCK_BODY.fullmatch(line))
+
+
+def _strip_line(line: str) -> str:
+    """Cut off the line comment and trailing whitespace. """
+    comment = line.find(';')
+    if comment != -1:
+        line = line[:comment]
+    return line.rstrip()
+
+
 class AstroFile:
     """ Class that represents a astro file
     it __repr__'s the given file's @member file_name
     content and will probably be able to do various file operations. """
 
-    def __init__(self, file_name: str, cleanup: bool = True):
+    def __init__(self, file_name: str, cleanup: bool = True,
+                 stream: bool = False):
         """Prepare the file for use.
         :param file_name: path to the file
         :param cleanup: remove comments from the file
+        :param stream: do not read the file now, instead map it into memory
+                       and yield the lines one by one from lines()
         """
         self.file_name = str(file_name)
         self.content = ""
+        self.cleanup = cleanup
+        self.stream = stream
+
+        # Offset maps filled in by _cleanup, see original_position
+        self.line_offsets = None
+        self.source_lines = None
+
+        # The text from_string was given, see original_source
+        self._text = None
+
+        if stream:
+            return
 
         with open(file_name, 'r') as f:
             self.content = f.read()
@@ -26,27 +94,183 @@ class AstroFile:
         if cleanup:
             self._cleanup()
 
+    @classmethod
+    def from_string(cls, text, file_name: str = '<string>',
+                    cleanup: bool = True):
+        """Create a file from source code in memory instead of a path.
+        :param text: the source code, a string or a UTF-8 encoded buffer
+        :param file_name: name of the file used in errors
+        :param cleanup: remove comments from the file
+        """
+        obj = cls.__new__(cls)
+        obj.file_name = str(file_name)
+        obj.content = text if isinstance(text, str) else str(text, 'utf-8')
+        obj.cleanup = cleanup
+        obj.stream = False
+        obj.line_offsets = None
+        obj.source_lines = None
+        obj._text = obj.content
+
+        if cleanup:
+            obj._cleanup()
+        return obj
+
     def __repr__(self):
         return self.content
 
+    def original_position(self, line: int, column: int = 0) -> tuple:
+        """Map a position in the cleaned up content to the position in the
+        original file. Block comments spanning multiple lines are collapsed
+        into one line, so everything after them is moved around. Streamed
+        files are never held in memory, so their positions are returned as
+        is; numbered_lines() yields the original number of every line.
+        :param line: line number in the content, starting from 1
+        :param column: column in that line
+        :return: (line, column) tuple in the original source
+        """
+        if self.line_offsets is None:
+            return line, column
+
+        offset = self.line_offsets[line-1] + column
+        orig = bisect_right(self.source_lines, offset)
+        return orig, offset - self.source_lines[orig-1]
+
+    def original_source(self, line: int, column: int = 0) -> tuple:
+        """Find the original source of a position in a line yielded by
+        numbered_lines(). A line collapsed out of a block comment spans over
+        several original lines, and since block comments are replaced with
+        as many characters as they had, newlines included, the column is
+        followed through those lines until it fits. The original lines are
+        read again from the file, so only use this for reporting.
+        :param line: original number of the line, as numbered_lines() gives
+        :param column: column in the cleaned up line
+        :return: (line, column, source) tuple of the original line
+        """
+        source = ''
+        for number, (_, source) in enumerate(self._raw_lines(), 1):
+            if number < line:
+                continue
+            if column <= len(source):
+                return number, column, source
+            column -= len(source) + 1
+            line = number + 1
+        return line, column, source
+
     def _cleanup(self) -> None:
-        """Removes comments from the source file. """
+        """Removes comments from the source file in a single pass. Block
+        comments are replaced with spaces so the columns stay the same, and
+        line comments are cut off. The start offset of each resulting line
+        is kept in @member line_offsets, and the start of each original line
+        in @member source_lines. """
 
         content: str = self.content.replace('\r', '')
+        self.source_lines = _line_starts(content)
+
+        content = blank_block_comments(content)
+        self.line_offsets = _line_starts(content)
+
+        self.content = '\n'.join([_strip_line(s) for s in content.split('\n')])
+
+    def lines(self):
+        """Yield (offset, line) tuples for every line of the (cleaned up)
+        content. The offset is where the line starts in the original file,
+        in characters for eager files and in bytes for streamed files. """
+        if self.stream:
+            for _, offset, line in self.numbered_lines():
+                yield offset, line
+            return
+
+        offsets = self.line_offsets
+        pos = 0
+        for index, line in enumerate(self.content.split('\n')):
+            if offsets is not None:
+                pos = offsets[index]
+            yield pos, line
+            pos += len(line) + 1
+
+    def numbered_lines(self):
+        """Yield (number, offset, line) tuples like lines(), along with the
+        number of each line in the original file. In stream mode nothing is
+        held on to for the lines that have already been yielded, only lines
+        a block comment may still span over are held back. """
+        if not self.stream:
+            position = self.original_position
+            for index, (offset, line) in enumerate(self.lines(), 1):
+                yield position(index)[0], offset, line
+            return
+
+        raw = self._raw_lines()
+        if not self.cleanup:
+            for number, (offset, line) in enumerate(raw, 1):
+                yield number, offset, line
+            return
+
+        group = []
+        is_open = False
+        for number, (offset, line) in enumerate(raw, 1):
+            group.append((number, offset, line))
+            is_open = comment_open(line, is_open)
+            if not is_open:
+                yield from self._clean_group(group)
+                group = []
+
+        if group:
+            yield from self._clean_group(group)
+
+    def _clean_group(self, group: list):
+        """Clean up a group of (number, offset, line) tuples no block comment
+        crosses the boundary of, yielding the resulting lines along with
+        their numbers and offsets. """
+        if len(group) == 1:
+            number, offset, line = group[0]
+            yield number, offset, _strip_line(blank_block_comments(line))
+            return
+
+        # Collapsed lines disappear, the rest start where they used to
+        content = blank_block_comments('\n'.join(g[2] for g in group))
+        pos = 0
+        for number, offset, line in group:
+            if not pos or content[pos-1] == '\n':
+                end = content.find('\n', pos)
+                yield number, offset, _strip_line(content[pos:] if end == -1
+                                                  else content[pos:end])
+            pos += len(line) + 1
+
+    def _raw_lines(self):
+        """Yield (offset, line) tuples of the file before any cleanup. """
+        if self._text is not None:
+            return self._text_lines()
+        if os.path.getsize(self.file_name):
+            return self._mapped_lines()
+        return iter([(0, '')])
+
+    def _text_lines(self):
+        """Yield (offset, line) tuples from the text given to from_string,
+        with carriage returns removed like _cleanup does. """
+        pos = 0
+        for line in self._text.replace('\r', '').split('\n'):
+            yield pos, line
+            pos += len(line) + 1
+
+    def _mapped_lines(self):
+        """Yield (byte offset, line) tuples from the memory mapped file,
+        translating newlines like a file opened in text mode would. """
+        with open(self.file_name, 'rb') as f, \
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            pos = 0
+            while True:
+                end = data.find(b'\n', pos)
+                raw = data[pos:] if end == -1 else data[pos:end]
+                if end != -1 and raw.endswith(b'\r'):
+                    raw = raw[:-1]
+
+                if b'\r' in raw:
+                    for part in raw.split(b'\r'):
+                        yield pos, part.decode()
+                        pos += len(part) + 1
+                else:
+                    yield pos, raw.decode()
 
-        result = re.finditer(r'(;;[\n\w\s]*;;)+', content)
-        for match in result:
-            # The reason I'm not using .replace on a string here is because
-            # I would be cutting out every single instance which might come
-            # up in a later match.
-            spaces = ' ' * (match.span()[1] - match.span()[0])
-            content = content[:match.span()[0]] + spaces \
-                + content[match.span()[1]:]
-
-        lines = content.split('\n')
-        for index, line in enumerate(lines):
-            match = re.match(r'^[^;]*(?P<comment>;.*)$', line)
-            if match:
-                lines[index] = line.replace(match.group('comment'), '')
-
-        self.content = '\n'.join([s.rstrip() for s in lines])
+                if end == -1:
+                    break
+                pos = end + 1
@@ -1,4 +1,5 @@
 """ The file where all Astro types get defined. """
+from array import array
 
 __author__  = 'xyLotus, bellrise'
 __version__ = '0.1'
@@ -42,6 +43,29 @@ class TokenType:
         return 'NONE'
 
 
+# Token types which only separate other tokens.
+WHITESPACE = frozenset((TokenType.SPACE, TokenType.TAB))
+
+
+class LineContext:
+    """The tokens of a single line, along with its number in the original
+    file and its source. The parser fills in the indent level and the BCO_
+    type of the statement. """
+
+    __slots__ = ('line', 'source', 'tokens', 'indent', 'type')
+
+    def __init__(self, line: int, source: str, tokens, indent: int = 0,
+                 type_: int = None):
+        self.line = line
+        self.source = source
+        self.tokens = tokens
+        self.indent = indent
+        self.type = type_
+
+    def __repr__(self):
+        return f'<LineContext {self.line}: {self.source!r}>'
+
+
 class Token:
     """This class represents a single Token which can then be put into a list
     generated by the Tokenizer. """
@@ -66,3 +90,122 @@ class Token:
         """Generate a string representation of the Token using some reflective
         Python magic. """
         return self.__str__()
+
+
+class TokenView:
+    """A read-only view of a single token stored in a TokenStream. It has the
+    same id and value attributes as a Token, but the value is only sliced
+    from the source line when it is accessed. """
+
+    __slots__ = ('_stream', '_index')
+
+    def __init__(self, stream, index: int):
+        self._stream = stream
+        self._index = index
+
+    @property
+    def id(self) -> int:
+        return self._stream.ids[self._index]
+
+    @property
+    def line(self) -> int:
+        return self._stream.lines[self._index]
+
+    @property
+    def value(self) -> str:
+        stream, i = self._stream, self._index
+        start = stream.starts[i]
+        return stream.sources[stream.lines[i]][start:start+stream.lengths[i]]
+
+    def __str__(self):
+        return f'<Token id={TokenType.get(self.id)} value=\'{self.value}\'>'
+
+    def __repr__(self):
+        return self.__str__()
+
+
+class TokenLine:
+    """All tokens of a single line in a TokenStream. Behaves like the list of
+    Tokens the tokenizer creates for a line, creating TokenViews on access.
+    """
+
+    __slots__ = ('_stream', '_begin', '_end')
+
+    def __init__(self, stream, begin: int, end: int):
+        self._stream = stream
+        self._begin = begin
+        self._end = end
+
+    @property
+    def ids(self):
+        """Token IDs of this line, without creating any views. """
+        return self._stream.ids[self._begin:self._end]
+
+    def __len__(self):
+        return self._end - self._begin
+
+    def __getitem__(self, index: int) -> TokenView:
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('token index out of range')
+        return TokenView(self._stream, self._begin + index)
+
+    def __iter__(self):
+        for index in range(self._begin, self._end):
+            yield TokenView(self._stream, index)
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+class TokenStream:
+    """Compact, column based token storage. Instead of keeping a Token object
+    for every token, the token ID, line, start column and length are stored
+    in parallel arrays, and the values are sliced from the source lines only
+    when needed. Iterating over the stream yields a TokenLine for each line,
+    so it can be used in place of the usual list of token lists. """
+
+    __slots__ = ('sources', 'ids', 'lines', 'starts', 'lengths', '_offsets')
+
+    def __init__(self):
+        self.sources = []               # source of each line
+        self.ids = array('H')           # token ID
+        self.lines = array('I')         # line index of the token
+        self.starts = array('I')        # start column in the line
+        self.lengths = array('I')       # length of the token value
+        self._offsets = array('I', [0]) # first token index of each line
+
+    def append(self, id_: int, start: int, length: int):
+        """Add a token to the line that is currently being built. """
+        self.ids.append(id_)
+        self.lines.append(len(self.sources))
+        self.starts.append(start)
+        self.lengths.append(length)
+
+    def end_line(self, source: str):
+        """Finish the current line, storing its source. """
+        self.sources.append(source)
+        self._offsets.append(len(self.ids))
+
+    def token(self, index: int) -> TokenView:
+        """Return a view of the token at the absolute index. """
+        return TokenView(self, index)
+
+    def __len__(self):
+        return len(self.sources)
+
+    def __getitem__(self, index: int) -> TokenLine:
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('line index out of range')
+        return TokenLine(self, self._offsets[index], self._offsets[index+1])
+
+    def __iter__(self):
+        offsets = self._offsets
+        for index in range(len(self.sources)):
+            yield TokenLine(self, offsets[index], offsets[index+1])
+
+    def __repr__(self):
+        return repr(list(self))
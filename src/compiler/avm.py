@@ -11,28 +11,135 @@ file in any implementation of the compiler or interpreter, because the
 basic set of values will always be here along with some implementation
 specific fields.
 """
-from _ctypes import sizeof as _sizeof
-from abc import ABC, abstractmethod
-from ctypes import c_char as char, c_char_p as char_ptr
+import struct as _struct
+import zlib as _zlib
 
-_ptr_size = _sizeof(char_ptr)
-
-BC_VERSION  = 1
+BC_VERSION  = 3
 BC_MAGIC    = b'\x5aABC'
 __version__ = BC_VERSION
 
 
-class _bc_struct(ABC):
-    """Private handler for the struct classes. """
-
-    def __init__(self):
-        fields = self.__class__.__dict__['__annotations__']
-        for key, typ in fields.items():
-            self.__dict__[key] = typ()
+class _bc_type:
+    """One of the basic types from bc.h, along with its struct format. Index
+    it to get an array type, like in C: _bc8[4] or _bc8[...] for a flexible
+    array member at the end of a struct. """
+
+    def __init__(self, fmt: str, default=0, flexible=False):
+        self.fmt = fmt
+        self.default = default
+        self.flexible = flexible
+
+    def __getitem__(self, length):
+        if length is ...:
+            return _bc_type('', b'', flexible=True)
+        return _bc_type(f'{length}s', bytes(length))
+
+
+_bc8        = _bc_type('B')
+_bc16       = _bc_type('H')
+_bc32       = _bc_type('I')
+_bc_ptr     = _bc_type('I')
+
+
+class _bc_layout(type):
+    """Metaclass for the struct classes. Turns the annotated fields into slots
+    and builds the struct.Struct layout of the fixed size part once, when the
+    class is created. """
+
+    def __new__(mcs, name, bases, namespace):
+        fields = namespace.get('__annotations__', {})
+        namespace['__slots__'] = tuple(fields)
+        cls = super().__new__(mcs, name, bases, namespace)
+        if not fields:
+            return cls
+
+        names = tuple(fields)
+        flexible = [key for key, typ in fields.items() if typ.flexible]
+        if flexible and flexible != [names[-1]]:
+            raise TypeError(f'{name}: only the last field can be flexible')
+
+        cls._fields = names
+        cls._defaults = tuple(typ.default for typ in fields.values())
+        cls._flexible = flexible[0] if flexible else None
+        cls._fixed = names[:-1] if flexible else names
+        cls.layout = _struct.Struct(
+            '<' + ''.join(typ.fmt for typ in fields.values())
+        )
+        cls.SIZE = cls.layout.size
+        return cls
+
+
+class _bc_struct(metaclass=_bc_layout):
+    """Private handler for the struct classes. Fields may be passed in the
+    same order as they are declared, or by name. """
+
+    def __init__(self, *values, **fields):
+        for key, default in zip(self._fields, self._defaults):
+            setattr(self, key, default)
+        for key, value in zip(self._fields, values):
+            setattr(self, key, value)
+        for key, value in fields.items():
+            setattr(self, key, value)
 
-    @abstractmethod
     def size(self) -> int:
-        pass
+        """Size of the whole structure, including the flexible member. """
+        if self._flexible:
+            return self.SIZE + len(getattr(self, self._flexible))
+        return self.SIZE
+
+    def pack(self) -> bytes:
+        """Return the structure as bytes. """
+        data = self.layout.pack(*[getattr(self, key) for key in self._fixed])
+        if self._flexible:
+            data += bytes(getattr(self, self._flexible))
+        return data
+
+    def pack_into(self, buffer, offset: int) -> int:
+        """Write the structure into a writable buffer, returning the amount
+        of bytes written. """
+        self.layout.pack_into(buffer, offset,
+                              *[getattr(self, key) for key in self._fixed])
+        if not self._flexible:
+            return self.SIZE
+        data = getattr(self, self._flexible)
+        start = offset + self.SIZE
+        buffer[start:start+len(data)] = data
+        return self.SIZE + len(data)
+
+    @classmethod
+    def unpack_from(cls, buffer, offset: int = 0):
+        """Read the structure from a buffer without copying the flexible
+        member, which is a memoryview into the buffer. """
+        obj = cls.__new__(cls)
+        for key, value in zip(cls._fixed, cls.layout.unpack_from(buffer,
+                                                                 offset)):
+            setattr(obj, key, value)
+        if cls._flexible:
+            start = offset + cls.SIZE
+            end = start + obj._flexible_size(buffer, start)
+            setattr(obj, cls._flexible, memoryview(buffer)[start:end])
+        return obj
+
+    def _flexible_size(self, buffer, offset: int) -> int:
+        """Size of the flexible member located at the offset. """
+        return 0
+
+    def __repr__(self):
+        fields = ', '.join(f'{key}={getattr(self, key)!r}'
+                           for key in self._fields)
+        return f'<{self.__class__.__name__} {fields}>'
+
+
+def _strlen(buffer, offset: int) -> int:
+    """Length of the null terminated string at the offset. """
+    view = memoryview(buffer)
+    end = offset
+    while end < len(view):
+        found = view[end:end+256].tobytes().find(0)
+        if found != -1:
+            return end + found - offset
+        end += 256
+    return len(view) - offset
 
 
 class bc_hdr(_bc_struct):
@@ -41,58 +148,87 @@ class bc_hdr(_bc_struct):
     strings with names are located after the header, in the exact order the
     lengths are provided in the header. """
 
-    hdr_magic: bytes    # magic bytes [4]
-    hdr_version: int    # version
-    hdr_size: int       # sizeof bc_hdr + sizeof hdr_data
-    hdr_flags: int      # header flags
-    hdr_sys: char       # system
-    hdr_endian: char    # file endianness
-    hdr_off_data: int   # data segment
-    hdr_off_code: int   # code segment
-    hdr_off_mut: int    # mutable data segment
-    hdr_off_oname: int  # source name
-    hdr_off_mname: int  # module name
-    hdr_off_func: int   # main function name
-
-    def size(self) -> int:
-        return 42
+    hdr_magic: _bc8[4]      # magic bytes
+    hdr_version: _bc32      # version
+    hdr_size: _bc32         # sizeof bc_hdr + sizeof hdr_data
+    hdr_flags: _bc32        # header flags
+    hdr_sys: _bc8           # system
+    hdr_endian: _bc8        # file endianness
+    hdr_off_data: _bc_ptr   # data segment
+    hdr_off_code: _bc_ptr   # code segment
+    hdr_off_mut: _bc_ptr    # mutable data segment
+    hdr_off_oname: _bc_ptr  # source name
+    hdr_off_mname: _bc_ptr  # module name
+    hdr_off_func: _bc_ptr   # main function name
+    hdr_off_sym: _bc_ptr    # symbol table
+    hdr_off_lines: _bc_ptr  # compact line table
 
 
 class bc_ins(_bc_struct):
     """Single instruction"""
 
-    ins_type: int       # type of instruction
-    ins_len: int        # payload length
-    ins_source: int     # pointer to source string
-    ins_payload: bytes  # payload
+    ins_type: _bc16         # type of instruction
+    ins_len: _bc16          # payload length
+    ins_source: _bc_ptr     # pointer to source string
+    ins_payload: _bc8[...]  # payload
 
-    def size(self) -> int:
-        return 4 + len(self.ins_payload)
+    def _flexible_size(self, buffer, offset: int) -> int:
+        return self.ins_len
 
 
 class bc_sym(_bc_struct):
-    """Symbol, also known as a function. sym_ptr points to the start of the
+    """Symbol, also known as a function. sym_pos points to the start of the
     BCO_FUNCTION instruction. """
 
-    sym_pos: int        # location of symbol in file
-    sym_len: int        # symbol length
-    sym_flags: int      # flags
-    sym_ptr: char_ptr   # pointer to start of symbol
+    sym_pos: _bc_ptr        # location of symbol in file
+    sym_len: _bc16          # length of the name
+    sym_flags: _bc16        # flags
+    sym_name: _bc_ptr       # name of the symbol
 
-    def size(self) -> int:
-        return 8 + _ptr_size
+
+class bc_symtab(_bc_struct):
+    """Symbol table in the data segment, pointed to by hdr_off_sym. It is
+    followed by st_count bc_sym structures and an index of st_size _bc32
+    slots, each holding the position of a symbol plus one, or 0 if empty.
+    A symbol is found by hashing its name with bc_hash and probing the slots
+    from hash % st_size onwards. """
+
+    st_count: _bc32         # amount of symbols
+    st_size: _bc32          # amount of slots, a power of two
 
 
 class bc_source(_bc_struct):
     """Every instruction (with debug symbols) should point to a bc_source
     structure somewhere in the data segment, which in turn provides information
     about the line number and contents of a line from the orignal source code.
+    The null terminator is not a part of src_data.
+    """
+    src_line: _bc32         # line of the source
+    src_data: _bc8[...]     # the actual string
+
+    def _flexible_size(self, buffer, offset: int) -> int:
+        return _strlen(buffer, offset)
+
+
+class bc_lines(_bc_struct):
+    """Compact line table in the data segment, pointed to by hdr_off_lines
+    and used instead of bc_source structures. It is followed by ln_count
+    _bc_ptr values pointing to the source of each line starting from line 1
+    (or 0 if the line has no code), and by ln_size bytes of delta pairs.
+    Each pair is an unsigned code offset increment in BC_LINES_UNIT bytes
+    and a signed line increment, starting at the code segment and line 0.
+    An increment of BC_LINES_NONE means the instructions have no line, and
+    the next increment is added to the line before it.
     """
-    src_line: int       # line of the source
-    src_data: bytes     # the actual string
 
-    def size(self) -> int:
-        return 4 + len(self.src_data)
+    ln_count: _bc32         # amount of lines
+    ln_size: _bc32          # size of the delta pairs
+
+
+def bc_hash(name: bytes) -> int:
+    """CRC-32 of a symbol name, used by the symbol table. It is the same
+    checksum zlib computes. """
+    return _zlib.crc32(name)
 
 
 # Universal values
@@ -100,6 +236,12 @@ class bc_source(_bc_struct):
 BC_FALSE            = 0x00
 BC_TRUE             = 0x01
 
+# Line table offsets are counted in this many bytes, and the line increment
+# marking instructions without a line
+
+BC_LINES_UNIT       = 4
+BC_LINES_NONE       = -128
+
 # hdr_sys
 
 BC_SYS_UNKNOWN      = 0x00
@@ -115,6 +257,7 @@ BC_ENDIAN_BIG       = 0x01
 
 BCF_HDR_BUILTIN     = 0x00000001    # builtin module
 BCF_HDR_STANDALONE  = 0x00000002    # no dependencies
+BCF_HDR_STREAMED    = 0x00000004    # strings shared per block
 
 # sym_flags
 
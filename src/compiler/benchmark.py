@@ -0,0 +1,353 @@
+"""
+Benchmarks for the compiler. Generates synthetic Astro sources of different
+shapes, times every compilation stage separately and compares the results
+with a stored baseline. Run this file directly to print the results.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import ac_parser
+from astro_file import AstroFile
+from codegen import CodeGenerator
+from emitter import Emitter
+from tokenizer import Tokenizer
+
+__author__  = 'bellrise'
+__version__ = '0.3'
+
+# Most time the compiler may spend starting up and compiling an empty file,
+# on top of starting a bare interpreter. See the README.
+STARTUP_BUDGET_MS = 25
+
+
+def _functions(lines: int) -> list:
+    """Many small functions. """
+    code = []
+    while len(code) < lines:
+        n = len(code)
+        code += [f'! func{n}(a, b):', f'    out a', f'    x{n} = b',
+                 f'    func{n}(a, b)', '']
+    return code
+
+
+def _deep(lines: int, depth: int = 16) -> list:
+    """A single function nesting statements as deep as possible. """
+    code = ['! main():']
+    level = 1
+    step = 1
+    while len(code) < lines:
+        code.append('    ' * level + f'out level{level}')
+        if level in (1, depth):
+            step = -step if level == depth else 1
+        level += step
+    return code
+
+
+def _comments(lines: int) -> list:
+    """More comments than code. """
+    code = ['! main():']
+    while len(code) < lines:
+        n = len(code)
+        code += [f'    out x{n} ;; block comment {n} ;;',
+                 f'    ;; multiline', f'    comment {n} ;;', f'    y{n} = 1',
+                 f'    out y{n} ; line comment {n}']
+    return code
+
+
+def _long(lines: int, width: int = 400) -> list:
+    """Calls with very long argument lists. """
+    args = ', '.join(f'arg{i}' for i in range(width // 6))
+    code = ['! main():']
+    while len(code) < lines:
+        code.append(f'    call{len(code)}({args})')
+    return code
+
+
+SHAPES = {
+    'functions': _functions,
+    'deep': _deep,
+    'comments': _comments,
+    'long': _long,
+}
+
+
+def generate_source(shape: str, lines: int) -> str:
+    """Generate Astro source code of the given shape with around the given
+    amount of lines. """
+    return '\n'.join(SHAPES[shape](lines)) + '\n'
+
+
+def comment_source(comments: int) -> str:
+    """Generate Astro source code with the given amount of comments, mixing
+    single line block comments, multiline block comments and line comments.
+    """
+    lines = ['! main():']
+    for i in range(comments):
+        kind = i % 3
+        if kind == 0:
+            lines.append(f'    out x{i} ;; block comment {i} ;;')
+        elif kind == 1:
+            lines.append(f'    ;; multiline\n    comment {i} ;; y{i} = 1')
+        else:
+            lines.append(f'    out y{i} ; line comment {i}')
+    return '\n'.join(lines) + '\n'
+
+
+def _stages(path: str, engine: str):
+    """Yield (name, callable) pairs running the compilation stages one after
+    another, each working on the result of the previous one. """
+    state = {}
+
+    def read():
+        state['file'] = AstroFile(path)
+
+    def tokenize():
+        state['tokenizer'] = Tokenizer(state['file'], engine)
+        state['tokenizer'].tokenize()
+        state['contexts'] = state['tokenizer'].get_context()
+
+    def indents():
+        state['parser'] = ac_parser.Parser(path, state['contexts'],
+                                           trust_me=True)
+        state['parser'].calculate_indents()
+
+    def match():
+        parser = state['parser']
+        for ctx in state['contexts']:
+            ctx.type = parser.match(ctx.tokens)
+            if ctx.type is None:
+                parser.error(ctx, 'invalid syntax')
+
+    def collect():
+        state['tree'] = state['parser'].collect(state['contexts'])
+
+    def codegen():
+        emitter = Emitter('bench', path)
+        emitter.emit(CodeGenerator(path).generate(state['contexts']))
+        state['size'] = len(emitter.build())
+
+    yield 'read', read
+    yield 'tokenize', tokenize
+    yield 'indents', indents
+    yield 'match', match
+    yield 'collect', collect
+    yield 'codegen', codegen
+
+
+def run_shape(shape: str, lines: int, repeat: int, engine: str) -> dict:
+    """Benchmark every stage on a generated source of the shape. Times are
+    the best of repeat runs, and peak memory is measured in a separate run
+    with tracemalloc, so it does not slow down the timed runs. """
+    source = generate_source(shape, lines)
+    fd, path = tempfile.mkstemp(suffix='.asx')
+    with os.fdopen(fd, 'w') as f:
+        f.write(source)
+
+    try:
+        times = {}
+        for _ in range(repeat):
+            for name, stage in _stages(path, engine):
+                start = time.perf_counter()
+                stage()
+                elapsed = time.perf_counter() - start
+                times[name] = min(times.get(name, elapsed), elapsed)
+
+        peaks = {}
+        tracemalloc.start()
+        for name, stage in _stages(path, engine):
+            tracemalloc.reset_peak()
+            stage()
+            peaks[name] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    finally:
+        os.remove(path)
+
+    count = source.count('\n')
+    return {
+        name: {
+            'time': times[name],
+            'lines_per_sec': count / times[name] if times[name] else 0,
+            'mb_per_sec': len(source) / 1e6 / times[name]
+            if times[name] else 0,
+            'peak_mb': peaks[name] / 1e6,
+        }
+        for name in times
+    }
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list:
+    """Return a list of (shape, stage, old, new) regressions, where the time
+    of a stage grew more than the threshold (0.2 is 20%) over the baseline.
+    """
+    regressions = []
+    for shape, stages in results.items():
+        for stage, result in stages.items():
+            old = baseline.get(shape, {}).get(stage)
+            if old and result['time'] > old['time'] * (1 + threshold):
+                regressions.append((shape, stage, old['time'],
+                                    result['time']))
+    return regressions
+
+
+def print_results(results: dict):
+    print(f'{"shape":<10} {"stage":<9} {"time [ms]":>10} {"lines/s":>11} '
+          f'{"MB/s":>7} {"peak [MB]":>10}')
+    for shape, stages in results.items():
+        for stage, r in stages.items():
+            print(f'{shape:<10} {stage:<9} {r["time"] * 1000:10.2f} '
+                  f'{r["lines_per_sec"]:11.0f} {r["mb_per_sec"]:7.2f} '
+                  f'{r["peak_mb"]:10.2f}')
+
+
+def bench_cleanup(sizes):
+    """Time AstroFile._cleanup on comment heavy files of growing size. The
+    time per comment should stay the same if the cleanup is linear. """
+    print(f'{"comments":>10} {"time [ms]":>10} {"us/comment":>11}')
+    for size in sizes:
+        fd, path = tempfile.mkstemp(suffix='.asx')
+        with os.fdopen(fd, 'w') as f:
+            f.write(comment_source(size))
+        try:
+            elapsed = float('inf')
+            for _ in range(3):
+                start = time.perf_counter()
+                AstroFile(path)
+                elapsed = min(elapsed, time.perf_counter() - start)
+        finally:
+            os.remove(path)
+        print(f'{size:10} {elapsed * 1000:10.2f} '
+              f'{elapsed / size * 1e6:11.3f}')
+
+
+def _run(args: list, env: dict) -> float:
+    start = time.perf_counter()
+    subprocess.run(args, env=env, check=True, stdout=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+
+def import_times(path: str, env: dict = None) -> list:
+    """Compile the file in a new interpreter with -X importtime, returning
+    (module, self, cumulative) tuples of every import in seconds, the
+    slowest first. """
+    args = [sys.executable, '-X', 'importtime',
+            os.path.dirname(os.path.abspath(__file__)), path]
+    proc = subprocess.run(args, env=env, check=True, text=True,
+                          stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    imports = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        self_us, cumulative, name = line[12:].split('|')
+        if self_us.strip().isdigit():
+            imports.append((name.strip(), int(self_us) / 1e6,
+                            int(cumulative) / 1e6))
+    return sorted(imports, key=lambda i: i[2], reverse=True)
+
+
+def bench_startup(repeat: int) -> dict:
+    """Time compiling an empty file from a new interpreter, against starting
+    a bare interpreter. The bytecode cache is enabled and warmed up first,
+    like it is on a machine running builds. """
+    env = dict(os.environ)
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    fd, path = tempfile.mkstemp(suffix='.asx')
+    os.close(fd)
+
+    compiler = [sys.executable, os.path.dirname(os.path.abspath(__file__)),
+                path]
+    bare = [sys.executable, '-c', 'pass']
+    try:
+        _run(compiler, env)
+        base = min(_run(bare, env) for _ in range(repeat))
+        total = min(_run(compiler, env) for _ in range(repeat))
+        imports = import_times(path, env)
+    finally:
+        os.remove(path)
+        output = os.path.splitext(path)[0] + '.abc'
+        if os.path.exists(output):
+            os.remove(output)
+
+    return {'interpreter': base, 'compiler': total,
+            'overhead': total - base, 'imports': imports[:10]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run compiler benchmarks.')
+    parser.add_argument('--shapes', nargs='+', default=list(SHAPES),
+                        choices=list(SHAPES), help='Source shapes to run')
+    parser.add_argument('--lines', type=int, default=20000,
+                        help='Approximate amount of lines per source')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Amount of timed runs, the best one is kept')
+    parser.add_argument('--tokenizer', default=Tokenizer.ENGINE_SCAN,
+                        choices=[Tokenizer.ENGINE_SCAN,
+                                 Tokenizer.ENGINE_LEGACY],
+                        help='Tokenizer engine to benchmark')
+    parser.add_argument('--baseline', help='Compare the results with this '
+                        'JSON file, failing on regressions')
+    parser.add_argument('--save-baseline', help='Store the results in this '
+                        'JSON file')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='Allowed slowdown over the baseline (0.2 = 20%%)')
+    parser.add_argument('--json', action='store_true',
+                        help='Print the results as JSON')
+    parser.add_argument('--startup', action='store_true', help='Only time '
+                        'the start up of the compiler on an empty file')
+    parser.add_argument('--cleanup-scaling', type=int, nargs='*',
+                        metavar='COMMENTS', help='Only time the comment '
+                        'cleanup for these amounts of comments')
+    args = parser.parse_args()
+
+    if args.startup:
+        result = bench_startup(max(args.repeat, 10))
+        if args.json:
+            print(json.dumps(result, indent=2))
+        else:
+            print(f'interpreter {result["interpreter"] * 1000:8.2f} ms')
+            print(f'compiler    {result["compiler"] * 1000:8.2f} ms')
+            print(f'overhead    {result["overhead"] * 1000:8.2f} ms '
+                  f'(budget {STARTUP_BUDGET_MS} ms)')
+            print('slowest imports:')
+            for name, _, cumulative in result['imports']:
+                print(f'  {name:<28} {cumulative * 1000:8.2f} ms')
+        if result['overhead'] * 1000 > STARTUP_BUDGET_MS:
+            print('startup is over the budget', file=sys.stderr)
+            sys.exit(1)
+        return
+
+    if args.cleanup_scaling is not None:
+        bench_cleanup(args.cleanup_scaling or [10000, 20000, 40000, 80000])
+        return
+
+    results = {
+        shape: run_shape(shape, args.lines, args.repeat, args.tokenizer)
+        for shape in args.shapes
+    }
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_results(results)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        for shape, stage, old, new in regressions:
+            print(f'regression: {shape}/{stage} took {new * 1000:.2f} ms, '
+                  f'baseline {old * 1000:.2f} ms', file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,544 @@
+"""
+The build driver. Runs every compilation stage on a source file and writes
+the resulting bytecode, going through the compilation cache if there is one.
+Source code can also be compiled straight from memory with compile_source,
+which raises CompileError instead of exiting.
+"""
+import io
+import os
+import sys
+from contextlib import redirect_stderr, redirect_stdout
+
+import ac_parser
+import avm
+import deps
+import stats as _stats
+from astro_file import AstroFile
+from codegen import CodeGenerator
+from emitter import Emitter
+from optimize import CallGraph, Optimizer
+from tokenizer import Tokenizer
+
+__author__  = 'bellrise'
+__version__ = '0.1.0'
+
+# Name of the function the virtual machine starts the module from
+ENTRY = 'main'
+
+# Amount of instructions outside of functions after which a streamed module
+# is flushed, see compile_stream
+STREAM_CHUNK = 1024
+
+
+class CompileError(Exception):
+    """Raised by compile_source when the source does not compile, carrying
+    the diagnostics the compiler printed. """
+
+    def __init__(self, name: str, diagnostics: str):
+        super().__init__(diagnostics.rstrip() or f'{name}: failed to compile')
+        self.name = name
+        self.diagnostics = diagnostics
+
+
+class Options:
+    """Compilation options shared by every file in a build. """
+
+    __slots__ = ('tokenizer', 'compact', 'stream', 'dump', 'stats',
+                 'optimize', 'prune', 'strip_debug', 'line_table')
+
+    def __init__(self, tokenizer: str = Tokenizer.ENGINE_SCAN,
+                 compact: bool = False, stream: bool = False,
+                 dump: bool = False, stats: bool = False,
+                 optimize: tuple = (), prune: bool = False,
+                 strip_debug: bool = False, line_table: bool = False):
+        self.tokenizer = tokenizer
+        self.compact = compact
+        self.stream = stream
+        self.dump = dump
+        self.stats = stats
+        self.optimize = tuple(optimize)
+        self.prune = prune
+        self.strip_debug = strip_debug
+        self.line_table = line_table
+
+    @classmethod
+    def from_args(cls, args):
+        """Create the options from the parsed command line arguments. """
+        return cls(**{key: getattr(args, key) for key in cls.__slots__})
+
+    def key(self) -> str:
+        """Options that change the generated bytecode, used as a part of the
+        cache key. The tokenizer mode only changes how fast the same result
+        is produced, while streamed modules store strings once per block. """
+        key = 'O' + ','.join(self.optimize) if self.optimize else ''
+        for flag, enabled in (('P', self.prune), ('S', self.strip_debug),
+                              ('L', self.line_table),
+                              ('T', _streamed(self))):
+            if enabled:
+                key += flag
+        return key
+
+
+def module_name(path: str) -> str:
+    """Return the name of the module compiled from the given path. """
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+def output_path(path: str) -> str:
+    """Return the default bytecode path for the source path. """
+    return os.path.splitext(path)[0] + '.abc'
+
+
+def compile_file(src: str, options: Options, stats=_stats.NULL,
+                 interfaces: dict = None) -> bytearray:
+    """Run all compilation stages on the source file and return the built
+    bytecode.
+    :param src: path to the source code
+    :param options: compilation options
+    :param stats: Stats collecting the time and memory of each stage
+    :param interfaces: module name -> interface of the imported modules the
+                       calls are checked against
+    """
+    with stats.phase('read'):
+        file_obj = AstroFile(src, stream=options.stream)
+    return _compile(file_obj, options, stats, interfaces)
+
+
+def compile_source(text, name: str = '<string>', options: Options = None,
+                   stats=_stats.NULL, interfaces: dict = None) -> bytearray:
+    """Compile source code from memory and return the built bytecode, the
+    same way compile_file would for a file with the given name. Instead of
+    being printed, the diagnostics of a compilation error are raised in a
+    CompileError, so the process does not exit.
+    :param text: the source code, a string or a UTF-8 encoded buffer
+    :param name: file name of the source, the module is named after it
+    :param options: compilation options, the defaults if None
+    :param stats: Stats collecting the time and memory of each stage
+    :param interfaces: module name -> interface of the imported modules
+    """
+    options = options or Options()
+    with stats.phase('read'):
+        file_obj = AstroFile.from_string(text, name)
+    err = io.StringIO()
+    try:
+        with redirect_stderr(err):
+            data = _compile(file_obj, options, stats, interfaces)
+    except SystemExit:
+        raise CompileError(name, err.getvalue()) from None
+    # Pass the warnings on
+    sys.stderr.write(err.getvalue())
+    return data
+
+
+def _streamed(options: Options) -> bool:
+    """Whether the options compile files with compile_stream. Pruning needs
+    the call graph of the whole module before anything is emitted. """
+    return options.stream and not options.prune
+
+
+def _compile(file_obj: AstroFile, options: Options, stats,
+             interfaces: dict) -> bytearray:
+    src = file_obj.file_name
+    if _streamed(options):
+        emitter = compile_stream(file_obj, options, stats, interfaces)
+        out = io.BytesIO()
+        with stats.phase('emit'):
+            stats.count('bytes', emitter.write_spooled(out))
+        return bytearray(out.getbuffer())
+
+    with stats.phase('tokenize'):
+        tokenizer = Tokenizer(file_obj, options.tokenizer, options.compact)
+        tokenizer.tokenize()
+        contexts = tokenizer.get_context()
+    if options.dump:
+        tokenizer.output_tokens()
+    if stats.enabled:
+        stats.count('lines', len(contexts))
+        stats.count('tokens', sum(len(ctx.tokens) for ctx in contexts))
+
+    with stats.phase('parse'):
+        contexts = ac_parser.Parser(src, contexts, trust_me=True,
+                                    source_file=file_obj).parse()
+
+    with stats.phase('codegen'):
+        code = CodeGenerator(src).generate(contexts)
+        graph = CallGraph(code)
+    if interfaces:
+        deps.check_calls(src, code, interfaces)
+
+    if options.prune:
+        with stats.phase('prune'):
+            code = graph.prune(code, ENTRY)
+        stats.count('pruned_functions', graph.pruned)
+
+    if options.optimize:
+        optimizer = Optimizer(options.optimize)
+        with stats.phase('optimize'):
+            code = optimizer.optimize(code)
+        if options.dump:
+            print(optimizer.report())
+        if stats.enabled:
+            for rule, (count, size) in optimizer.savings.items():
+                stats.count(f'{rule}_saved_ins', count)
+                stats.count(f'{rule}_saved_bytes', size)
+
+    if options.dump:
+        for ins in code:
+            print(ins)
+
+    with stats.phase('emit'):
+        emitter = Emitter(module_name(src), os.path.basename(src), ENTRY,
+                          not options.strip_debug, options.line_table)
+        emitter.called = graph.reachable(ENTRY)
+        emitter.emit(code)
+        data = emitter.build()
+    if stats.enabled:
+        stats.count('instructions', len(code))
+        stats.count('bytes', len(data))
+    return data
+
+
+def compile_stream(file_obj: AstroFile, options: Options, stats=_stats.NULL,
+                   interfaces: dict = None) -> Emitter:
+    """Compile a file in a single pass, with its lines going through every
+    stage one by one. The instructions are collected a top level block at a
+    time, which is a function or up to STREAM_CHUNK instructions outside of
+    functions, then optimized and flushed into the code spool of the
+    returned emitter, so only the current block is held in memory. The
+    module is written with the write_spooled method of the emitter. Tokens
+    are not dumped, and the optimizer only sees a single block at a time.
+    :param file_obj: the file, ideally opened in stream mode
+    :param options: compilation options, prune is ignored
+    :param stats: Stats collecting the time and memory of each stage
+    :param interfaces: module name -> interface of the imported modules
+    """
+    src = file_obj.file_name
+    emitter = Emitter(module_name(src), os.path.basename(src), ENTRY,
+                      not options.strip_debug, options.line_table, spool=True)
+    optimizer = Optimizer(options.optimize) if options.optimize else None
+    graph = CallGraph()
+    wrong_calls = []
+
+    def flush(chunk: list):
+        graph.update(CallGraph(chunk))
+        if interfaces:
+            wrong_calls.extend(deps.wrong_calls(chunk, interfaces))
+        if optimizer:
+            chunk = optimizer.optimize(chunk)
+        if options.dump:
+            for ins in chunk:
+                print(ins)
+        emitter.emit(chunk)
+        emitter.flush()
+        stats.count('instructions', len(chunk))
+
+    with stats.phase('stream'):
+        contexts = Tokenizer(file_obj).contexts()
+        if stats.enabled:
+            contexts = _counted(contexts, stats)
+        parser = ac_parser.Parser(src, [], trust_me=True,
+                                  source_file=file_obj)
+
+        chunk = []
+        in_function = False
+        for ins in CodeGenerator(src).instructions(parser.stream(contexts)):
+            chunk.append(ins)
+            if ins.type == avm.BCO_FUNCTION:
+                in_function = True
+            elif ins.type == avm.BCO_ENDFUNC or not in_function \
+                    and len(chunk) >= STREAM_CHUNK \
+                    and ins.type != avm.BCO_CREATE:
+                in_function = False
+                flush(chunk)
+                chunk = []
+        flush(chunk)
+
+    # Functions defined later in the module hide the imported ones too
+    for ins, module, params in wrong_calls:
+        if ins.operands[0] not in graph.calls:
+            deps.call_error(src, ins, module, params)
+
+    emitter.called = graph.reachable(ENTRY)
+    if optimizer:
+        if options.dump:
+            print(optimizer.report())
+        if stats.enabled:
+            for rule, (count, size) in optimizer.savings.items():
+                stats.count(f'{rule}_saved_ins', count)
+                stats.count(f'{rule}_saved_bytes', size)
+    return emitter
+
+
+def _counted(contexts, stats):
+    """Count the lines and tokens of the contexts passing through. """
+    for ctx in contexts:
+        stats.count('lines', 1)
+        stats.count('tokens', len(ctx.tokens))
+        yield ctx
+
+
+def build_file(src: str, output: str, options: Options, cache=None,
+               stats=_stats.NULL, interfaces: dict = None) -> bool:
+    """Compile the source file into the output path. If a cache is passed and
+    it has an entry for the exact same source, options and interfaces of the
+    imported modules, the compilation is skipped. Returns True if the result
+    came from the cache.
+    :param src: path to the source code
+    :param output: path to the bytecode file, None for the default
+    :param options: compilation options
+    :param cache: optional CompileCache
+    :param stats: Stats collecting the time and memory of each stage
+    :param interfaces: module name -> interface of the imported modules
+    """
+    output = output or output_path(src)
+
+    if cache is None and _streamed(options):
+        # Write the module straight from the spools
+        with stats.phase('read'):
+            file_obj = AstroFile(src, stream=True)
+        emitter = compile_stream(file_obj, options, stats, interfaces)
+        with stats.phase('write'):
+            with open(output, 'wb') as f:
+                stats.count('bytes', emitter.write_spooled(f))
+        return False
+
+    if cache is None:
+        data = compile_file(src, options, stats, interfaces)
+        hit = False
+    else:
+        key = options.key()
+        if interfaces:
+            key += repr(sorted((name, sorted(functions.items()))
+                               for name, functions in interfaces.items()))
+        with stats.phase('cache'):
+            with open(src, 'rb') as f:
+                key = cache.key(f.read(), key)
+            data = cache.get(key)
+        hit = data is not None
+        if not hit:
+            data = compile_file(src, options, stats, interfaces)
+            with stats.phase('cache'):
+                cache.put(key, data)
+
+    with stats.phase('write'):
+        with open(output, 'wb') as f:
+            f.write(data)
+    return hit
+
+
+class BuildResult:
+    """Outcome of building a single file, along with everything the stages
+    printed, so results from many files can be reported in order. The stats
+    field is the Stats report if the statistics were enabled, the interface
+    field the interface of the module if it was asked for, and the data
+    field the bytecode if it was compiled in memory. """
+
+    __slots__ = ('src', 'ok', 'cached', 'stdout', 'stderr', 'stats',
+                 'interface', 'data')
+
+    def __init__(self, src: str, ok: bool, cached: bool, stdout: str,
+                 stderr: str, stats: dict = None, interface: dict = None,
+                 data: bytearray = None):
+        self.src = src
+        self.ok = ok
+        self.cached = cached
+        self.stdout = stdout
+        self.stderr = stderr
+        self.stats = stats
+        self.interface = interface
+        self.data = data
+
+
+def build_one(src: str, output: str, options: Options, cache=None,
+              interfaces: dict = None) -> BuildResult:
+    """Build a single file like build_file, but capture the output and turn
+    compilation errors (which exit) and any other error, like a file which
+    cannot be decoded, into a failed result. If interfaces are passed, the
+    interface of the built module is read back too. """
+    out, err = io.StringIO(), io.StringIO()
+    stats = _stats.Stats() if options.stats else _stats.NULL
+    ok = cached = False
+    interface = None
+    try:
+        with redirect_stdout(out), redirect_stderr(err):
+            cached = build_file(src, output, options, cache, stats,
+                                interfaces)
+        if interfaces is not None:
+            interface = deps.read_interface(output or output_path(src))
+        ok = True
+    except SystemExit:
+        pass
+    except Exception as e:
+        _report_error(err, src, e)
+    return BuildResult(src, ok, cached, out.getvalue(), err.getvalue(),
+                       stats.report(), interface)
+
+
+def _report_error(err, src: str, error: Exception):
+    """Write an error which did not come from the compiler itself. """
+    if isinstance(error, OSError) and error.strerror:
+        err.write(f'{src}: {error.strerror}\n')
+    else:
+        err.write(f'{src}: {type(error).__name__}: {error}\n')
+
+
+def compile_many(sources, options: Options = None) -> list:
+    """Compile many sources from memory in this process, reusing the state
+    of the compiler between them. Like build_one, the output is captured and
+    errors turn into failed results instead of exiting.
+    :param sources: iterable of (name, text) pairs, see compile_source
+    :param options: compilation options, the defaults if None
+    :return: a BuildResult with the bytecode in its data field for every
+             source, in order
+    """
+    options = options or Options()
+    results = []
+    for name, text in sources:
+        out, err = io.StringIO(), io.StringIO()
+        stats = _stats.Stats() if options.stats else _stats.NULL
+        data = None
+        try:
+            with redirect_stdout(out), redirect_stderr(err):
+                data = compile_source(text, name, options, stats)
+        except CompileError as e:
+            err.write(e.diagnostics)
+        except Exception as e:
+            _report_error(err, name, e)
+        results.append(BuildResult(name, data is not None, False,
+                                   out.getvalue(), err.getvalue(),
+                                   stats.report(), data=data))
+    return results
+
+
+def collect_sources(paths: list) -> list:
+    """Expand directories into the Astro source files they contain, keeping
+    the order of the paths and sorting the files found in directories. """
+    sources = []
+    for path in paths:
+        if not os.path.isdir(path):
+            sources.append(path)
+            continue
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            sources.extend(os.path.join(root, name) for name in sorted(files)
+                           if name.endswith('.asx'))
+    return list(dict.fromkeys(sources))
+
+
+# State of a worker process, set up once by _init_worker and reused for
+# every file the worker builds.
+_worker = {}
+
+
+def _init_worker(options: Options, cache):
+    _worker['options'] = options
+    _worker['cache'] = cache
+    ac_parser.Parser.compile_signatures()
+
+
+def _build_in_worker(src: str, interfaces: dict = None) -> BuildResult:
+    return build_one(src, None, _worker['options'], _worker['cache'],
+                     interfaces)
+
+
+def build_many(sources: list, options: Options, jobs: int = 1,
+               cache=None) -> list:
+    """Build many files, spreading them over a pool of worker processes.
+    The results are returned in the same order as the sources. If the files
+    import each other, every module is built after the ones it imports and
+    checked against their interfaces, see build_graph.
+    :param sources: paths to the source files
+    :param options: compilation options
+    :param jobs: amount of worker processes, 1 builds in this process
+    :param cache: optional CompileCache, copied into every worker
+    """
+    graph = deps.DependencyGraph(sources)
+    if any(graph.imports.values()):
+        return build_graph(graph, options, jobs, cache)
+
+    if jobs <= 1 or len(sources) <= 1:
+        _init_worker(options, cache)
+        return [_build_in_worker(src) for src in sources]
+
+    from concurrent.futures import ProcessPoolExecutor
+
+    with ProcessPoolExecutor(jobs, initializer=_init_worker,
+                             initargs=(options, cache)) as pool:
+        chunk = max(1, len(sources) // (jobs * 4))
+        return list(pool.map(_build_in_worker, sources, chunksize=chunk))
+
+
+def build_graph(graph: deps.DependencyGraph, options: Options, jobs: int = 1,
+                cache=None) -> list:
+    """Build the sources of a dependency graph in the order of their
+    imports. A module is started as soon as every module it imports is
+    built, so independent modules are built in parallel. Its cache key
+    includes the interfaces of the imported modules, so editing a module
+    without changing its interface does not rebuild the modules importing
+    it. Modules importing one that failed to build fail too, without being
+    built. Raises ValueError on import cycles.
+    :param graph: imports between the sources
+    :param options: compilation options
+    :param jobs: amount of worker processes, 1 builds in this process
+    :param cache: optional CompileCache, copied into every worker
+    """
+    order = graph.order()
+    results = {}
+    interfaces = {}
+    failed = set()
+    waiting = {src: len(imports) for src, imports in graph.imports.items()}
+    ready = [src for src in order if not waiting[src]]
+
+    def imported(src: str) -> dict:
+        return {module_name(dep): interfaces[dep]
+                for dep in graph.imports[src]}
+
+    def finish(result: BuildResult):
+        results[result.src] = result
+        if result.ok:
+            interfaces[result.src] = result.interface or {}
+        else:
+            failed.add(result.src)
+        for dep in graph.dependents[result.src]:
+            waiting[dep] -= 1
+            if not waiting[dep]:
+                ready.append(dep)
+
+    def skipped(src: str) -> BuildResult:
+        """Fail a module importing one that failed to build, because its
+        calls cannot be checked. """
+        broken = next((dep for dep in graph.imports[src] if dep in failed),
+                      None)
+        if broken is None:
+            return None
+        return BuildResult(src, False, False, '', f'{src}: not built, '
+                           f'because {broken} failed to compile\n')
+
+    if jobs <= 1:
+        _init_worker(options, cache)
+        while ready:
+            src = ready.pop(0)
+            finish(skipped(src) or _build_in_worker(src, imported(src)))
+        return [results[src] for src in graph.sources]
+
+    from concurrent.futures import (FIRST_COMPLETED, ProcessPoolExecutor,
+                                    wait)
+
+    with ProcessPoolExecutor(jobs, initializer=_init_worker,
+                             initargs=(options, cache)) as pool:
+        running = set()
+        while ready or running:
+            while ready:
+                src = ready.pop(0)
+                result = skipped(src)
+                if result:
+                    finish(result)
+                else:
+                    running.add(pool.submit(_build_in_worker, src,
+                                            imported(src)))
+            if not running:
+                break
+            done, running = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                finish(future.result())
+    return [results[src] for src in graph.sources]
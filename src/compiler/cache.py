@@ -0,0 +1,137 @@
+"""
+Persistent compilation cache. Compiled bytecode is stored on disk under a key
+made from the hash of the source, a fingerprint of the compiler and the
+bytecode version, so unchanged files do not have to be compiled again.
+"""
+import hashlib
+import os
+import tempfile
+import time
+from functools import lru_cache
+
+import avm
+
+__author__  = 'bellrise'
+__version__ = '0.1'
+
+# Modules whose code decides what bytecode is built from a source file
+_COMPILER = ('ac_parser', 'astro_file', 'astro_types', 'avm', 'build',
+             'codegen', 'deps', 'emitter', 'optimize', 'tokenizer')
+
+
+@lru_cache(maxsize=None)
+def fingerprint() -> str:
+    """Return a hash of the sources of the compiler modules, so any change
+    to the compiler invalidates the cached bytecode, even if nobody bumped
+    a version number. """
+    digest = hashlib.sha256()
+    root = os.path.dirname(os.path.abspath(__file__))
+    for name in _COMPILER:
+        with open(os.path.join(root, name + '.py'), 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+class CompileCache:
+    """A directory of cached bytecode files, one per key. Entries are written
+    to a temporary file first and then renamed, so concurrent builds never
+    see half written entries. Reading an entry updates its modification time,
+    which is used to evict the least recently used entries. """
+
+    SUFFIX = '.abc'
+
+    def __init__(self, directory: str, max_size: int = 64 << 20,
+                 max_age: float = 7 * 24 * 3600):
+        """Open or create the cache directory.
+        :param directory: path to the cache directory
+        :param max_size: maximum size of all entries in bytes
+        :param max_age: seconds after which an unused entry is removed
+        """
+        self.directory = directory
+        self.max_size = max_size
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(source: bytes, options: str = '') -> str:
+        """Return the cache key for the source code and options. """
+        digest = hashlib.sha256(source)
+        digest.update(f'\0{fingerprint()}\0{avm.BC_VERSION}\0{options}'
+                      .encode())
+        return digest.hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key + self.SUFFIX)
+
+    def get(self, key: str):
+        """Return the cached bytecode for the key, or None if there is no
+        entry for it. """
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return data
+
+    def put(self, key: str, data: bytes):
+        """Store the bytecode under the key. """
+        fd, temp = tempfile.mkstemp(dir=self.directory, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(temp, self._path(key))
+        except BaseException:
+            os.remove(temp)
+            raise
+
+    def evict(self) -> int:
+        """Remove entries older than max_age, and then the least recently
+        used ones until the cache fits in max_size. Returns the amount of
+        removed entries. """
+        now = time.time()
+        entries = []
+        removed = 0
+
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                is_temp = entry.name.startswith('.tmp-')
+                if now - stat.st_mtime > self.max_age:
+                    removed += self._remove(entry.path)
+                elif not is_temp and entry.name.endswith(self.SUFFIX):
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            removed += self._remove(path)
+            total -= size
+
+        return removed
+
+    @staticmethod
+    def _remove(path: str) -> int:
+        # Another build may have removed it already
+        try:
+            os.remove(path)
+            return 1
+        except FileNotFoundError:
+            return 0
+
+    def report(self) -> str:
+        """Return a short summary of the cache hits and misses. """
+        total = self.hits + self.misses
+        rate = self.hits / total * 100 if total else 0
+        return f'cache: {self.hits} hits, {self.misses} misses ' \
+               f'({rate:.0f}% hit rate)'
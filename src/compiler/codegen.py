@@ -0,0 +1,161 @@
+"""
+Code generation. Turns the categorized token contexts from the parser into
+a flat list of instructions, which can then be written by the emitter.
+"""
+from __future__ import annotations
+
+from astro_types import LineContext, TokenType, WHITESPACE
+import avm
+
+__author__  = 'bellrise'
+__version__ = '0.1'
+
+# A basic call with this name at the top level imports a module
+IMPORT = 'import'
+
+
+class Instruction:
+    """A single instruction before it is written into the bytecode. The
+    operands are strings, which the emitter places in the data segment and
+    replaces with _bc_ptr values in the payload. """
+
+    __slots__ = ('type', 'operands', 'line', 'source')
+
+    def __init__(self, type_: int, operands: tuple = (), line: int = 0,
+                 source: str = ''):
+        self.type = type_
+        self.operands = operands
+        self.line = line
+        self.source = source
+
+    def __eq__(self, other):
+        if not isinstance(other, Instruction):
+            return NotImplemented
+        return (self.type, self.operands, self.line, self.source) == \
+            (other.type, other.operands, other.line, other.source)
+
+    def __repr__(self):
+        return f'<Instruction {self.type:#06x} {self.operands} ' \
+               f'line={self.line}>'
+
+
+class CodeGenerator:
+    """Generates instructions from line contexts that already have the type
+    and indent fields set by the parser. """
+
+    def __init__(self, filename: str):
+        """Create a code generator.
+        :param filename: path to the file currently being compiled
+        """
+        self.filename = filename
+
+    def generate(self, contexts: list[LineContext]) -> list[Instruction]:
+        """Generate the instructions for all contexts. Functions are closed
+        with an ENDFUNC when the indentation goes back to the top level, and
+        variables are created with CREATE before they are first assigned.
+        :param contexts: list of categorized line contexts
+        """
+        return list(self.instructions(contexts))
+
+    def instructions(self, contexts):
+        """Yield the instructions for the contexts as they come in, so the
+        contexts can be generated lazily, see generate.
+        :param contexts: iterable of categorized line contexts
+        """
+        in_function = False
+        variables = set()
+
+        for ctx in contexts:
+            type_ = ctx.type
+            if type_ is None:
+                continue
+            if type_ == avm.BCO_NOP:
+                yield Instruction(avm.BCO_NOP)
+                continue
+
+            tokens = [t for t in ctx.tokens if t.id not in WHITESPACE]
+            line, source = ctx.line, ctx.source
+
+            if in_function and not ctx.indent:
+                yield Instruction(avm.BCO_ENDFUNC)
+                in_function = False
+
+            if type_ == avm.BCO_FUNCTION:
+                params = self._names(tokens[3:-2])
+                variables = set(params)
+                in_function = True
+                operands = (tokens[1].value, *params)
+
+            elif type_ == avm.BCO_CALL:
+                operands = (tokens[0].value, *self._arguments(ctx.tokens))
+
+            elif type_ == avm.BCO_ASSIGN:
+                name = tokens[0].value
+                value = self._after(ctx.tokens, TokenType.ASSIGN)
+                if name not in variables:
+                    variables.add(name)
+                    yield Instruction(avm.BCO_CREATE, (name,), line, source)
+                operands = name, value
+
+            elif type_ == avm.BCO_BASECALL:
+                if tokens[0].value == IMPORT and len(tokens) == 2 \
+                        and tokens[1].id == TokenType.NAME \
+                        and not ctx.indent:
+                    type_ = avm.BCO_IMPORT
+                    operands = tokens[1].value,
+                else:
+                    rest = self._after(ctx.tokens, TokenType.NAME)
+                    operands = (tokens[0].value, rest) if rest \
+                        else (tokens[0].value,)
+
+            else:
+                operands = ()
+
+            yield Instruction(type_, operands, line, source)
+
+        if in_function:
+            yield Instruction(avm.BCO_ENDFUNC)
+
+    @staticmethod
+    def _names(tokens) -> list:
+        """Return the values of all NAME tokens. """
+        return [t.value for t in tokens if t.id == TokenType.NAME]
+
+    @staticmethod
+    def _after(tokens, id_: int) -> str:
+        """Return the source after the first token of the given type. """
+        found = False
+        parts = []
+        for tok in tokens:
+            if found:
+                parts.append(tok.value)
+            elif tok.id == id_:
+                found = True
+        return ''.join(parts).strip()
+
+    @staticmethod
+    def _arguments(tokens) -> list:
+        """Split the source between the outermost parentheses of a call into
+        arguments. """
+        args = []
+        buffer = ''
+        depth = 0
+        for tok in tokens:
+            if tok.id == TokenType.LPAREN:
+                depth += 1
+                if depth == 1:
+                    continue
+            elif tok.id == TokenType.RPAREN:
+                depth -= 1
+                if not depth:
+                    break
+            elif tok.id == TokenType.COMMA and depth == 1:
+                args.append(buffer.strip())
+                buffer = ''
+                continue
+            if depth:
+                buffer += tok.value
+
+        if buffer.strip() or args:
+            args.append(buffer.strip())
+        return args
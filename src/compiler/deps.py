@@ -0,0 +1,156 @@
+"""
+Dependencies between modules. The imports of a source file are found with a
+single scan of the file instead of a full parse, and the modules are built
+in the order of their imports. Every module is checked against the interface
+of the modules it imports, which is read back from their symbol tables.
+"""
+import mmap
+import os
+import re
+
+from ac_parser import Parser
+from astro_types import LineContext
+from astro_file import blank_block_comments
+from codegen import Instruction
+import avm
+
+__author__  = 'bellrise'
+__version__ = '0.1'
+
+# Import statements at the top level, optionally followed by a line comment
+_IMPORT = re.compile(r'^import[ \t]+(\w+)[ \t]*(?:;.*)?$', re.M)
+
+
+def scan_imports(path: str) -> list:
+    """Return the names of the modules imported by the source file, in the
+    order they are first imported. Block comments are only blanked out if
+    the file has any. """
+    with open(path, 'r') as f:
+        content = f.read()
+    if ';;' in content:
+        content = blank_block_comments(content)
+    return list(dict.fromkeys(m.group(1) for m in _IMPORT.finditer(content)))
+
+
+def interface(data) -> dict:
+    """Return the interface of a compiled module, which maps the name of
+    every function to the amount of its parameters. Only the symbol table
+    and the FUNCTION instructions it points to are read.
+    :param data: the bytecode
+    """
+    hdr = avm.bc_hdr.unpack_from(data)
+    if not hdr.hdr_off_sym:
+        return {}
+    table = avm.bc_symtab.unpack_from(data, hdr.hdr_off_sym)
+    pos = hdr.hdr_off_sym + avm.bc_symtab.SIZE
+
+    functions = {}
+    for _ in range(table.st_count):
+        sym = avm.bc_sym.unpack_from(data, pos)
+        pos += avm.bc_sym.SIZE
+        name = bytes(data[sym.sym_name:sym.sym_name+sym.sym_len]).decode()
+        length = avm.bc_ins.layout.unpack_from(data, sym.sym_pos)[1]
+        functions.setdefault(name, length // 4 - 1)
+    return functions
+
+
+def read_interface(path: str) -> dict:
+    """Return the interface of the compiled module at the path. """
+    with open(path, 'rb') as f, \
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        return interface(data)
+
+
+def check_calls(src: str, code: list[Instruction], interfaces: dict):
+    """Check the calls to functions of the imported modules, exiting with a
+    compilation error if one is called with the wrong amount of arguments.
+    Functions defined in the module itself hide the imported ones.
+    :param src: path to the source code
+    :param code: instructions of the module
+    :param interfaces: module name -> interface of every imported module
+    """
+    local = {ins.operands[0] for ins in code if ins.type == avm.BCO_FUNCTION}
+    for ins, module, params in wrong_calls(code, interfaces):
+        if ins.operands[0] not in local:
+            call_error(src, ins, module, params)
+
+
+def wrong_calls(code: list[Instruction], interfaces: dict):
+    """Yield (instruction, module, parameters) for every call to a function
+    of an imported module with the wrong amount of arguments, including the
+    calls to functions the module defines itself. """
+    imported = {}
+    for module, functions in interfaces.items():
+        for name, params in functions.items():
+            imported.setdefault(name, (module, params))
+
+    for ins in code:
+        if ins.type != avm.BCO_CALL or ins.operands[0] not in imported:
+            continue
+        module, params = imported[ins.operands[0]]
+        if len(ins.operands) - 1 != params:
+            yield ins, module, params
+
+
+def call_error(src: str, ins: Instruction, module: str, params: int):
+    """Exit with the compilation error for a call from wrong_calls. """
+    ctx = LineContext(ins.line, ins.source, [])
+    Parser(src, [], trust_me=True).error(
+        ctx, f'{ins.operands[0]} from {module} takes {params} arguments, '
+        f'{len(ins.operands) - 1} given'
+    )
+
+
+class DependencyGraph:
+    """The imports between the source files of a single build. An import
+    is resolved to the source with the same module name, preferring one in
+    the directory of the importing file. Modules which are not a part of the
+    build are left for the virtual machine to load. """
+
+    def __init__(self, sources: list):
+        """Scan the imports of every source file.
+        :param sources: paths to the source files
+        """
+        self.sources = list(sources)
+        by_name = {}
+        for src in self.sources:
+            name = os.path.splitext(os.path.basename(src))[0]
+            by_name.setdefault(name, src)
+            by_name.setdefault((os.path.dirname(src), name), src)
+
+        # Source -> sources it imports, and sources importing it
+        self.imports = {}
+        self.dependents = {src: [] for src in self.sources}
+        for src in self.sources:
+            found = []
+            try:
+                names = scan_imports(src)
+            except (OSError, UnicodeDecodeError):
+                # Left for the build to report
+                names = ()
+            for name in names:
+                dep = by_name.get((os.path.dirname(src), name),
+                                  by_name.get(name))
+                if dep is not None and dep != src and dep not in found:
+                    found.append(dep)
+                    self.dependents[dep].append(src)
+            self.imports[src] = found
+
+    def order(self) -> list:
+        """Return the sources with every module after the ones it imports.
+        Raises ValueError on import cycles. """
+        waiting = {src: len(deps) for src, deps in self.imports.items()}
+        ready = [src for src in self.sources if not waiting[src]]
+        order = []
+        while ready:
+            src = ready.pop(0)
+            order.append(src)
+            for dep in self.dependents[src]:
+                waiting[dep] -= 1
+                if not waiting[dep]:
+                    ready.append(dep)
+
+        if len(order) != len(self.sources):
+            cycle = [src for src in self.sources if waiting[src]]
+            raise ValueError(f'import cycle between {", ".join(cycle)}')
+        return order
@@ -0,0 +1,485 @@
+"""
+The bytecode emitter. Lays out the header, data, code and mutable segments
+described in docs/bytecode into a single buffer and writes it to a file.
+"""
+import struct
+import sys
+from array import array
+from bisect import bisect_left
+from functools import lru_cache
+
+from codegen import Instruction
+import avm
+
+__author__  = 'bellrise'
+__version__ = '0.1'
+
+_HDR = avm.bc_hdr.layout
+_INS = avm.bc_ins.layout
+_SRC = avm.bc_source.layout
+_PTR = struct.Struct('<I')
+_SYM = avm.bc_sym.layout
+_SYMTAB = avm.bc_symtab.layout
+_LINES = avm.bc_lines.layout
+
+CODE_ALIGN = 16
+
+_FUNCTION = avm.BCO_FUNCTION
+_PUBLIC = avm.BCF_SYM_PUBLIC
+_CALLED = avm.BCF_SYM_PUBLIC | avm.BCF_SYM_CALLED
+# Line table pair skipping 255 units of instructions without a line
+_NO_LINE = bytes((255, avm.BC_LINES_NONE & 0xff))
+
+
+@lru_cache(maxsize=None)
+def _payload(count: int) -> struct.Struct:
+    """Return the layout of a payload with the given amount of pointers. """
+    return struct.Struct(f'<{count}I')
+
+
+def _slots(count: int) -> int:
+    """Amount of slots in the index of a symbol table. """
+    return 1 << (2 * count).bit_length()
+
+
+class _Spool:
+    """A temporary file standing in for a bytearray which is only ever
+    appended to, so its contents do not have to stay in memory. """
+
+    __slots__ = ('file', 'size')
+
+    def __init__(self):
+        import tempfile
+        self.file = tempfile.TemporaryFile()
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def __iadd__(self, data):
+        self.file.write(data)
+        self.size += len(data)
+        return self
+
+    def copy_to(self, out):
+        """Write the whole contents to the file object and close the spool.
+        """
+        import shutil
+        self.file.seek(0)
+        shutil.copyfileobj(self.file, out)
+        self.file.close()
+
+
+def _system() -> int:
+    if sys.platform.startswith('linux'):
+        return avm.BC_SYS_LINUX
+    if sys.platform.startswith('win'):
+        return avm.BC_SYS_WIN
+    return avm.BC_SYS_UNKNOWN
+
+
+class Emitter:
+    """Collects the data and instructions of a single module and writes the
+    bytecode. The data segment is built as instructions are added, because
+    it comes right after the header, so every pointer into it is known
+    immediately. Instructions are only stored in compact arrays and packed
+    into the final buffer in build().
+
+    Every instruction payload is a list of _bc_ptr values pointing to null
+    terminated strings in the data segment, one for each operand. Strings
+    are interned, so every distinct string is stored only once. The
+    symbol table with a hashed index of every function, and the line table
+    if there is one, are placed at the end of the data segment in build().
+
+    A spooling emitter writes the data segment into a temporary file, and
+    flush() moves the instructions added so far into another one, so large
+    modules can be emitted piece by piece without holding them in memory.
+    Strings are only interned between two flushes, and the line table is
+    spooled too, so nothing grows with the size of the module apart from
+    its symbols. The header is flagged with BCF_HDR_STREAMED. Such a module
+    is written with write_spooled() instead of build().
+    """
+
+    def __init__(self, module_name: str, source_name: str,
+                 entry: str = 'main', debug: bool = True,
+                 line_table: bool = False, spool: bool = False):
+        """Create an emitter for a single module.
+        :param module_name: name of the module, stored in hdr_off_mname
+        :param source_name: name of the source file, stored in hdr_off_oname
+        :param entry: name of the main function, stored in hdr_off_func
+        :param debug: point every instruction to a bc_source structure
+        :param line_table: store the debug information in a compact line
+                           table with every distinct source line stored
+                           once, instead of the bc_source structures
+        :param spool: keep the data, flushed code and line table in
+                      temporary files
+        """
+        self.debug = debug
+        self.line_table = debug and line_table
+        self.spool = spool
+        self.data = _Spool() if spool else bytearray()
+        self._sources = {}
+        self._strings = {}
+        # Line number -> pointer to its source, for the line table. When
+        # spooling, flush moves them into _line_ptrs, which holds a pointer
+        # for each of the first _line_count lines
+        self._line_sources = {}
+        self._line_ptrs = _Spool() if spool and self.line_table else None
+        self._line_count = 0
+        self._lines = array('I')
+        # Encoded line deltas, the amount of instructions they cover and
+        # the state of the encoder after them, see _line_deltas
+        self._deltas = bytearray() if self._line_ptrs is None else _Spool()
+        self._encoded = 0
+        self._delta_state = 0, 0, 0, 0
+
+        # Code written by flush, and the functions in it
+        self._code = _Spool() if spool else None
+        self._flushed = []
+
+        self._types = array('H')
+        self._source_ptrs = array('I')
+        self._counts = array('H')
+        self._operands = array('I')
+        # (instruction, operand, name) of every FUNCTION instruction
+        self._functions = []
+        # Names of the functions flagged with BCF_SYM_CALLED
+        self.called = set()
+        # BCF_HDR_ flags
+        self.flags = avm.BCF_HDR_STREAMED if spool else 0
+
+        self.off_oname = self.add_string(source_name)
+        self.off_mname = self.add_string(module_name)
+        self.off_func = self.add_string(entry)
+
+    @property
+    def data_offset(self) -> int:
+        """Location of the data segment in the file. """
+        return _HDR.size
+
+    def add_data(self, data: bytes) -> int:
+        """Append raw data to the data segment, returning a pointer to it. """
+        ptr = self.data_offset + len(self.data)
+        self.data += data
+        return ptr
+
+    def add_string(self, string: str) -> int:
+        """Add a null terminated string to the data segment, or return the
+        pointer to the same string if it was added before. """
+        ptr = self._strings.get(string)
+        if ptr is None:
+            ptr = self._strings[string] = self.add_data(string.encode()
+                                                        + b'\0')
+        return ptr
+
+    def add_source(self, line: int, source: str) -> int:
+        """Add a bc_source structure for the given line, returning a pointer
+        to it. Instructions generated from the same line share it. """
+        key = line, source
+        if key not in self._sources:
+            self._sources[key] = self.add_data(
+                _SRC.pack(line) + source.encode() + b'\0'
+            )
+        return self._sources[key]
+
+    def add_line(self, line: int, source: str):
+        """Add the source of a line to the line table. Lines with the same
+        source share a single string. """
+        if line not in self._line_sources:
+            self._line_sources[line] = self.add_string(source)
+
+    def add_instruction(self, type_: int, operands=(), line: int = 0,
+                        source: str = ''):
+        """Add an instruction to the end of the code segment.
+        :param type_: BCO_ opcode
+        :param operands: strings the payload points to
+        :param line: line number in the source, 0 for no debug info
+        :param source: source code of the line
+        """
+        if type_ == _FUNCTION:
+            self._functions.append(
+                (len(self._types), len(self._operands), operands[0])
+            )
+        self._types.append(type_)
+        if self.line_table:
+            self._lines.append(line)
+            if line:
+                self.add_line(line, source)
+            self._source_ptrs.append(0)
+        else:
+            self._source_ptrs.append(
+                self.add_source(line, source) if self.debug and line else 0
+            )
+        self._counts.append(len(operands))
+        for operand in operands:
+            self._operands.append(self.add_string(operand))
+
+    def emit(self, code: list[Instruction]):
+        """Add all instructions from the code generator. """
+        for ins in code:
+            self.add_instruction(ins.type, ins.operands, ins.line, ins.source)
+
+    def code_size(self) -> int:
+        """Size of the code segment in bytes. """
+        return _INS.size * len(self._types) + 4 * len(self._operands)
+
+    def mark(self) -> tuple:
+        """Return the position of the next instruction, so the instructions
+        added after it can be packed separately with pack_code. """
+        return len(self._types), len(self._operands)
+
+    def pack_code(self, start: tuple = (0, 0), end: tuple = None) -> bytearray:
+        """Pack the instructions added between two marks into the format of
+        the code segment. The pointers in them stay valid for as long as the
+        data segment is only appended to.
+        :param start: mark before the first instruction
+        :param end: mark after the last instruction, defaults to the end
+        """
+        end = end or self.mark()
+        buf = bytearray(_INS.size * (end[0] - start[0])
+                        + 4 * (end[1] - start[1]))
+        self._pack_into(buf, 0, start, end)
+        return buf
+
+    def functions(self, start: tuple = (0, 0), end: tuple = None) -> list:
+        """Return the (offset, name, pointer to name) of every FUNCTION
+        instruction added between two marks, the offset being relative to
+        the first instruction after the start mark. """
+        end = end or self.mark()
+        first = bisect_left(self._functions, (start[0],))
+        last = bisect_left(self._functions, (end[0],))
+        return [
+            (_INS.size * (index - start[0]) + 4 * (operand - start[1]), name,
+             self._operands[operand])
+            for index, operand, name in self._functions[first:last]
+        ]
+
+    @staticmethod
+    def symtab_size(count: int) -> int:
+        """Size of a symbol table with the given amount of symbols. The index
+        has at least twice as many slots as there are symbols. """
+        return _SYMTAB.size + _SYM.size * count + 4 * _slots(count)
+
+    def _pack_symtab(self, buf, pos: int, functions: list, off_code: int):
+        slots = _slots(len(functions))
+        mask = slots - 1
+        index = array('I', bytes(4 * slots))
+        _SYMTAB.pack_into(buf, pos, len(functions), slots)
+        pos += _SYMTAB.size
+
+        called = self.called
+        pack_sym = _SYM.pack_into
+        crc32 = avm.bc_hash
+        seen = set()
+        for number, (offset, name, ptr) in enumerate(functions, 1):
+            encoded = name.encode()
+            pack_sym(buf, pos, off_code + offset, len(encoded),
+                     _CALLED if name in called else _PUBLIC, ptr)
+            pos += _SYM.size
+
+            # Only the first function with a name can be looked up
+            if name in seen:
+                continue
+            seen.add(name)
+            slot = crc32(encoded) & mask
+            while index[slot]:
+                slot = (slot + 1) & mask
+            index[slot] = number
+
+        buf[pos:pos+4*slots] = index.tobytes()
+
+    def _line_deltas(self) -> bytearray:
+        """Encode the line of every instruction into delta pairs, adding a
+        pair only where the line changes. Increments which do not fit into
+        a byte are split into several pairs, and instructions without a line
+        get a BC_LINES_NONE pair, so the next line is still counted from the
+        last one. Offset increments over 255 are preceded by pairs of 255
+        which keep the line of the instructions they skip. Only the
+        instructions added since the last call are encoded, and appended to
+        the ones before. """
+        deltas = self._deltas
+        pos, last_pos, last_line, current = self._delta_state
+        first = self._encoded
+        for count, line in zip(self._counts[first:], self._lines[first:]):
+            if line != current:
+                offset = (pos - last_pos) // avm.BC_LINES_UNIT
+                # Fillers keep the line of the instructions they skip over
+                filler = b'\xff\0' if current else _NO_LINE
+                while offset > 255:
+                    deltas += filler
+                    offset -= 255
+                change = line - last_line
+                if not line:
+                    change = avm.BC_LINES_NONE
+                while not -127 <= change <= 127 and line:
+                    step = 127 if change > 0 else -127
+                    deltas += bytes((offset, step & 0xff))
+                    offset = 0
+                    change -= step
+                deltas += bytes((offset, change & 0xff))
+                last_pos, current = pos, line
+                last_line = line or last_line
+            pos += _INS.size + 4 * count
+        self._encoded = len(self._counts)
+        self._delta_state = pos, last_pos, last_line, current
+        return deltas
+
+    def _line_total(self) -> int:
+        """Amount of lines in the line table. """
+        return max(self._line_count, max(self._line_sources, default=0))
+
+    def _spool_lines(self):
+        """Move the pointers to the sources of the lines added since the
+        last flush into the line spool. Lines only ever grow, so the ones
+        before _line_count are all written already. """
+        for line in sorted(self._line_sources):
+            if line > self._line_count:
+                self._line_ptrs += bytes(4 * (line - 1 - self._line_count))
+                self._line_ptrs += _PTR.pack(self._line_sources[line])
+                self._line_count = line
+        self._line_sources.clear()
+
+    def _pack_lines(self, buf, pos: int, deltas: bytes):
+        count = self._line_total()
+        sources = array('I', bytes(4 * count))
+        for line, ptr in self._line_sources.items():
+            sources[line-1] = ptr
+        _LINES.pack_into(buf, pos, count, len(deltas))
+        pos += _LINES.size
+        buf[pos:pos+4*count] = sources.tobytes()
+        pos += 4 * count
+        buf[pos:pos+len(deltas)] = deltas
+
+    def _pack_into(self, buf, pos: int, start: tuple, end: tuple):
+        first, last = start[0], end[0]
+        operand = start[1]
+        pack_ins = _INS.pack_into
+        operands = self._operands
+        for type_, source, count in zip(self._types[first:last],
+                                        self._source_ptrs[first:last],
+                                        self._counts[first:last]):
+            pack_ins(buf, pos, type_, 4 * count, source)
+            pos += _INS.size
+            if count:
+                _payload(count).pack_into(
+                    buf, pos, *operands[operand:operand+count]
+                )
+                operand += count
+                pos += 4 * count
+
+    def build(self, code: list = None, functions: list = None) -> bytearray:
+        """Lay out the whole module into a single preallocated buffer.
+        :param code: pieces from pack_code making up the code segment, by
+                     default every added instruction is packed in order,
+                     which is the only way a line table is written
+        :param functions: (offset, name, pointer to name) of every function
+                          in the pieces, with the offset relative to the
+                          start of the code segment
+        """
+        if code is None:
+            functions = self.functions()
+            code_size = self.code_size()
+        else:
+            code_size = sum(len(piece) for piece in code)
+        deltas = self._line_deltas() if self.line_table and code is None \
+            else None
+        data_end = self.data_offset + len(self.data)
+        off_sym, off_lines, off_code = self._layout(len(functions or ()),
+                                                    deltas)
+        off_mut = off_code + code_size
+
+        buf = bytearray(off_mut)
+        self._pack_header(buf, off_code, off_mut, off_sym, off_lines)
+        buf[self.data_offset:data_end] = self.data
+        self._pack_symtab(buf, off_sym, functions or (), off_code)
+        if off_lines:
+            self._pack_lines(buf, off_lines, deltas)
+
+        if code is None:
+            self._pack_into(buf, off_code, (0, 0), self.mark())
+        else:
+            buf[off_code:] = b''.join(code)
+        return buf
+
+    def flush(self):
+        """Pack the instructions added so far into the code spool and drop
+        them, along with the sources of their lines and the interned
+        strings, so later blocks may store the same strings again. Functions
+        defined in them stay in the symbol table. """
+        if self.line_table:
+            self._line_deltas()
+            self._spool_lines()
+        offset = len(self._code)
+        self._code += self.pack_code()
+        self._flushed.extend((offset + position, name, ptr)
+                             for position, name, ptr in self.functions())
+
+        self._types = array('H')
+        self._source_ptrs = array('I')
+        self._counts = array('H')
+        self._operands = array('I')
+        self._lines = array('I')
+        self._functions = []
+        self._encoded = 0
+        self._sources.clear()
+        self._strings.clear()
+
+    def write_spooled(self, out) -> int:
+        """Flush the remaining instructions and write the module of a
+        spooling emitter to a binary file object. The spooled data and code
+        are copied over in pieces and closed, so this can only be called
+        once. Returns the amount of bytes written. """
+        self.flush()
+        deltas = self._deltas if self.line_table else None
+        data_end = self.data_offset + len(self.data)
+        off_sym, off_lines, off_code = self._layout(len(self._flushed),
+                                                    deltas)
+        off_mut = off_code + len(self._code)
+
+        # Everything between the data segment and the line table, or the
+        # code segment if there is none
+        tail = bytearray((off_lines or off_code) - data_end)
+        self._pack_symtab(tail, off_sym - data_end, self._flushed, off_code)
+
+        head = bytearray(self.data_offset)
+        self._pack_header(head, off_code, off_mut, off_sym, off_lines)
+        out.write(head)
+        self.data.copy_to(out)
+        out.write(tail)
+        if off_lines:
+            out.write(_LINES.pack(self._line_count, len(deltas)))
+            self._line_ptrs.copy_to(out)
+            deltas.copy_to(out)
+            out.write(bytes(off_code - off_lines - _LINES.size
+                            - 4 * self._line_count - len(deltas)))
+        self._code.copy_to(out)
+        return off_mut
+
+    def _layout(self, functions: int, deltas: bytes) -> tuple:
+        """Return the offsets of the symbol table, the line table (0 if
+        there are no deltas) and the code segment. """
+        data_end = self.data_offset + len(self.data)
+        off_sym = -(-data_end // 4) * 4
+        end = off_sym + self.symtab_size(functions)
+        off_lines = 0
+        if deltas is not None:
+            off_lines = end
+            end += _LINES.size + 4 * self._line_total() + len(deltas)
+        return off_sym, off_lines, -(-end // CODE_ALIGN) * CODE_ALIGN
+
+    def _pack_header(self, buf, off_code: int, off_mut: int, off_sym: int,
+                     off_lines: int):
+        _HDR.pack_into(
+            buf, 0, avm.BC_MAGIC, avm.BC_VERSION, off_mut, self.flags,
+            _system(), avm.BC_ENDIAN_SMALL, self.data_offset, off_code,
+            off_mut, self.off_oname, self.off_mname, self.off_func, off_sym,
+            off_lines
+        )
+
+    def write(self, path: str) -> int:
+        """Build the module and write it to the given path in one go,
+        returning the amount of bytes written. """
+        buf = self.build()
+        with open(path, 'wb') as f:
+            f.write(buf)
+        return len(buf)
@@ -0,0 +1,108 @@
+"""
+Static linker. Bundles several compiled modules into a single standalone
+bytecode image, so the virtual machine maps one file instead of loading every
+module on its own. Run this file directly to link files.
+"""
+import argparse
+import os
+
+from codegen import Instruction
+from emitter import Emitter
+from optimize import CallGraph
+from reader import Reader
+import avm
+
+__author__  = 'bellrise'
+__version__ = '0.1'
+
+
+def read_code(reader: Reader) -> list[Instruction]:
+    """Decode the code segment of a module back into instructions, with the
+    line and source of every instruction that has them. """
+    code = []
+    for op in reader.instructions():
+        found = reader.line(op)
+        line, source = found if found else (0, '')
+        code.append(Instruction(op.type, tuple(reader.operands(op)), line,
+                                source))
+    return code
+
+
+def link(paths: list, debug: bool = True, line_table: bool = False):
+    """Link the compiled modules into a single image and return it. The code
+    of the modules is laid out in the given order, the module name, source
+    name and entry point of the image are the ones of the first module.
+    Every pointer is placed again by the emitter, so the strings of all
+    modules are interned together and the symbol table covers every
+    function. Imports of the linked modules are removed, and the image is
+    flagged as standalone if there are none left.
+
+    The bc_source structures of the instructions are copied into the data
+    segment of the image and pointed to at their new offsets. A line table
+    has a single source for every line number, so the lines of several
+    modules cannot be told apart in it, and asking for one raises
+    ValueError when linking more than one module.
+    :param paths: compiled modules, the program first
+    :param debug: keep the source lines of the instructions
+    :param line_table: store the source lines in a line table
+    """
+    if len(paths) > 1 and line_table:
+        raise ValueError('cannot build a line table of more than one module, '
+                         'link without --line-table to keep the sources')
+
+    modules = []
+    for path in paths:
+        with Reader(path) as reader:
+            modules.append((path, reader.module_name, reader.source_name,
+                            reader.entry, read_code(reader)))
+
+    names = {name for _, name, _, _, _ in modules}
+    defined = {}
+    code = []
+    for path, _, _, _, module_code in modules:
+        for ins in module_code:
+            if ins.type == avm.BCO_FUNCTION:
+                name = ins.operands[0]
+                if name in defined:
+                    raise ValueError(f'{path}: function {name} is already '
+                                     f'defined in {defined[name]}')
+                defined[name] = path
+            elif ins.type == avm.BCO_IMPORT and ins.operands[0] in names:
+                continue
+            code.append(ins)
+
+    _, module_name, source_name, entry, _ = modules[0]
+    emitter = Emitter(module_name, source_name, entry, debug, line_table)
+    emitter.called = CallGraph(code).reachable(entry)
+    if not any(ins.type == avm.BCO_IMPORT for ins in code):
+        emitter.flags |= avm.BCF_HDR_STANDALONE
+    emitter.emit(code)
+    return emitter.build()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Link compiled Astro '
+                                     'modules into a single image.')
+    parser.add_argument('paths', nargs='+', help='Paths to the compiled '
+                        'modules, the program first')
+    parser.add_argument('-o', '--output', help='Path to the image, defaults '
+                        'to the first module with a .linked.abc extension')
+    parser.add_argument('--strip-debug', action='store_true', help='Leave '
+                        'out the source lines of the instructions')
+    parser.add_argument('--line-table', action='store_true', help='Store '
+                        'the source lines in a compact line table, only for '
+                        'a single module')
+    args = parser.parse_args()
+
+    output = args.output or os.path.splitext(args.paths[0])[0] \
+        + '.linked.abc'
+    try:
+        image = link(args.paths, not args.strip_debug, args.line_table)
+    except (OSError, ValueError) as e:
+        parser.exit(1, f'{e}\n')
+    with open(output, 'wb') as f:
+        f.write(image)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,188 @@
+"""
+Optimizations over the instructions from the code generator, run before they
+are emitted. The peephole optimizer removes the instructions the virtual
+machine would execute for no effect, with every rule turned on and off
+separately, and the call graph removes functions which are never called.
+"""
+from __future__ import annotations
+
+from codegen import Instruction
+import avm
+
+__author__  = 'bellrise'
+__version__ = '0.1'
+
+# Instructions which do not count as code inside of an IF chain
+_NOT_CODE = frozenset((avm.BCO_IF, avm.BCO_ELIF, avm.BCO_ELSE, avm.BCO_NOP))
+
+
+def code_size(code: list[Instruction]) -> int:
+    """Size of the instructions in the code segment, in bytes. """
+    return sum(avm.bc_ins.SIZE + 4 * len(ins.operands) for ins in code)
+
+
+class Optimizer:
+    """Applies the enabled rules to a list of instructions, counting how
+    many instructions and bytes each rule saved:
+
+    nop            - drop NOP instructions
+    create_assign  - fuse a CREATE followed by an ASSIGN to the same variable
+                     into a single CREATE with the value as a second operand
+    empty_if       - drop IF/ELIF/ELSE/ENDIF chains without any code in them
+                     and ELSE branches without any code, the conditions are
+                     not evaluated anymore
+    """
+
+    RULES = ('nop', 'create_assign', 'empty_if')
+
+    def __init__(self, rules=RULES):
+        """Create an optimizer.
+        :param rules: names of the enabled rules
+        """
+        for rule in rules:
+            if rule not in self.RULES:
+                raise ValueError(f'unknown optimization rule: {rule}')
+        self.rules = tuple(rule for rule in self.RULES if rule in rules)
+        self.savings = {rule: [0, 0] for rule in self.rules}
+
+    @classmethod
+    def parse_rules(cls, rules: str) -> tuple:
+        """Turn a comma separated list of rules into a tuple, 'all' enables
+        every rule. """
+        if rules == 'all':
+            return cls.RULES
+        return tuple(rule.strip() for rule in rules.split(',') if rule)
+
+    def optimize(self, code: list[Instruction]) -> list[Instruction]:
+        """Return the optimized list of instructions. """
+        for rule in self.rules:
+            before = len(code), code_size(code)
+            code = getattr(self, '_' + rule)(code)
+            saved = self.savings[rule]
+            saved[0] += before[0] - len(code)
+            saved[1] += before[1] - code_size(code)
+        return code
+
+    def report(self) -> str:
+        """Return the savings of every rule, one per line. """
+        return '\n'.join(
+            f'{rule}: -{count} instructions, -{size} bytes'
+            for rule, (count, size) in self.savings.items()
+        )
+
+    @staticmethod
+    def _nop(code: list) -> list:
+        return [ins for ins in code if ins.type != avm.BCO_NOP]
+
+    @staticmethod
+    def _create_assign(code: list) -> list:
+        result = []
+        index = 0
+        while index < len(code):
+            ins = code[index]
+            if ins.type == avm.BCO_CREATE and index + 1 < len(code):
+                nxt = code[index + 1]
+                if nxt.type == avm.BCO_ASSIGN and len(ins.operands) == 1 \
+                        and nxt.operands[:1] == ins.operands:
+                    result.append(Instruction(avm.BCO_CREATE, nxt.operands,
+                                              nxt.line, nxt.source))
+                    index += 2
+                    continue
+            result.append(ins)
+            index += 1
+        return result
+
+    @staticmethod
+    def _empty_if(code: list) -> list:
+        result = []
+        # [position of the IF in result, whether the chain has any code] for
+        # every open chain, innermost last
+        chains = []
+        for ins in code:
+            if ins.type == avm.BCO_IF:
+                chains.append([len(result), False])
+            elif ins.type == avm.BCO_ENDIF and chains:
+                start, has_code = chains.pop()
+                if not has_code:
+                    del result[start:]
+                    continue
+                # An ELSE followed by nothing but NOPs is dropped with them
+                end = len(result)
+                while result[end-1].type == avm.BCO_NOP:
+                    end -= 1
+                if result[end-1].type == avm.BCO_ELSE:
+                    del result[end-1:]
+                if chains:
+                    chains[-1][1] = True
+            elif ins.type not in _NOT_CODE and chains:
+                chains[-1][1] = True
+            result.append(ins)
+        return result
+
+
+class CallGraph:
+    """The functions of a module and the functions called from each one of
+    them, built from the FUNCTION and CALL instructions. Calls made outside
+    of any function are made when the module is loaded. """
+
+    def __init__(self, code: list[Instruction] = ()):
+        """Build the call graph of the instructions.
+        :param code: instructions of the whole module
+        """
+        # (index of FUNCTION, index after ENDFUNC, name) of every function
+        self.functions = []
+        # Function name -> names of the functions it calls, None for the
+        # calls made outside of functions
+        self.calls = {None: set()}
+        # Amount of functions removed by prune
+        self.pruned = 0
+
+        current = None
+        start = 0
+        for index, ins in enumerate(code):
+            if ins.type == avm.BCO_FUNCTION:
+                current, start = ins.operands[0], index
+                self.calls.setdefault(current, set())
+            elif ins.type == avm.BCO_ENDFUNC and current is not None:
+                self.functions.append((start, index + 1, current))
+                current = None
+            elif ins.type == avm.BCO_CALL:
+                self.calls[current].add(ins.operands[0])
+
+    def update(self, other: CallGraph):
+        """Add the calls of a graph built from another piece of the same
+        module. The function ranges are not added, because they are indices
+        into the other piece. """
+        for name, called in other.calls.items():
+            self.calls.setdefault(name, set()).update(called)
+
+    def reachable(self, entry: str) -> set:
+        """Return the names of the functions which can be called, starting
+        from the entry point and the calls made outside of functions. """
+        found = set()
+        stack = [entry, *self.calls[None]]
+        while stack:
+            name = stack.pop()
+            if name in found or name not in self.calls:
+                continue
+            found.add(name)
+            stack.extend(self.calls[name])
+        return found
+
+    def prune(self, code: list[Instruction], entry: str) -> list:
+        """Return the instructions without the functions which can never be
+        called. Modules without the entry point, like libraries, are returned
+        as they are, because other modules may call any of their functions.
+        """
+        if entry not in self.calls:
+            return code
+        keep = self.reachable(entry)
+        result = []
+        last = 0
+        for start, end, name in self.functions:
+            if name not in keep:
+                result.extend(code[last:start])
+                last = end
+                self.pruned += 1
+        result.extend(code[last:])
+        return result
@@ -0,0 +1,277 @@
+"""
+Bytecode reader and disassembler. The file is mapped into memory and only
+the parts that are asked for are decoded, so inspecting a single function
+of a huge module stays cheap. Run this file directly to disassemble a file.
+"""
+import argparse
+import mmap
+import struct
+from array import array
+from bisect import bisect_right
+
+import avm
+
+__author__  = 'bellrise'
+__version__ = '0.1'
+
+_INS = avm.bc_ins.layout
+_SYM = avm.bc_sym.layout
+_PTR = struct.Struct('<I')
+
+OPCODES = {
+    value: key[4:] for key, value in vars(avm).items()
+    if key.startswith('BCO_')
+}
+
+
+class Op:
+    """Location and fixed part of a single instruction in the code segment.
+    The payload is not read until it is needed. """
+
+    __slots__ = ('offset', 'type', 'length', 'source')
+
+    def __init__(self, offset: int, type_: int, length: int, source: int):
+        self.offset = offset
+        self.type = type_
+        self.length = length
+        self.source = source
+
+    @property
+    def name(self) -> str:
+        return OPCODES.get(self.type, f'{self.type:#06x}')
+
+    def __repr__(self):
+        return f'<Op {self.offset:#x} {self.name}>'
+
+
+class Reader:
+    """Maps a compiled bytecode file into memory and validates its header.
+    Use it as a context manager, or call close() when done. """
+
+    def __init__(self, path: str):
+        """Open the bytecode file.
+        :param path: path to the compiled file
+        """
+        self.path = path
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if len(self._map) < avm.bc_hdr.SIZE:
+            self.close()
+            raise ValueError(f'{path}: file is too small for a header')
+
+        self.header = avm.bc_hdr.unpack_from(self._map)
+        if self.header.hdr_magic != avm.BC_MAGIC:
+            self.close()
+            raise ValueError(f'{path}: invalid magic bytes')
+        if self.header.hdr_version != avm.BC_VERSION:
+            self.close()
+            raise ValueError(f'{path}: unsupported bytecode version '
+                             f'{self.header.hdr_version}')
+        self._line_index = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._map.close()
+
+    @property
+    def module_name(self) -> str:
+        return self.string(self.header.hdr_off_mname)
+
+    @property
+    def source_name(self) -> str:
+        return self.string(self.header.hdr_off_oname)
+
+    @property
+    def entry(self) -> str:
+        return self.string(self.header.hdr_off_func)
+
+    def string(self, ptr: int) -> str:
+        """Read the null terminated string the pointer points to. """
+        end = self._map.find(b'\0', ptr)
+        return self._map[ptr:end if end != -1 else len(self._map)].decode()
+
+    def source(self, ptr: int):
+        """Resolve a bc_source pointer into a (line, source) tuple, or return
+        None if the pointer is 0. """
+        if not ptr:
+            return None
+        line = _PTR.unpack_from(self._map, ptr)[0]
+        return line, self.string(ptr + avm.bc_source.SIZE)
+
+    def line(self, op: Op):
+        """Return the (line, source) tuple of the instruction, from its
+        bc_source structure or from the line table, or None if it has no
+        debug information. """
+        if op.source:
+            return self.source(op.source)
+        ptr = self.header.hdr_off_lines
+        if not ptr:
+            return None
+        if self._line_index is None:
+            self._line_index = self._decode_lines(ptr)
+
+        offsets, lines = self._line_index
+        index = bisect_right(offsets, op.offset - self.header.hdr_off_code)
+        line = lines[index-1] if index else 0
+        if not line:
+            return None
+        source = _PTR.unpack_from(
+            self._map, ptr + avm.bc_lines.SIZE + _PTR.size * (line - 1)
+        )[0]
+        return line, self.string(source) if source else ''
+
+    def _decode_lines(self, ptr: int) -> tuple:
+        """Decode the delta pairs of the line table into arrays of code
+        offsets and the lines starting at them. """
+        table = avm.bc_lines.unpack_from(self._map, ptr)
+        start = ptr + avm.bc_lines.SIZE + _PTR.size * table.ln_count
+        deltas = self._map[start:start+table.ln_size]
+
+        offsets, lines = array('I'), array('I')
+        pos = line = 0
+        for index in range(0, len(deltas), 2):
+            change = deltas[index+1]
+            change = change - 256 if change > 127 else change
+            pos += deltas[index] * avm.BC_LINES_UNIT
+            offsets.append(pos)
+            if change == avm.BC_LINES_NONE:
+                lines.append(0)
+                continue
+            line += change
+            lines.append(line)
+        return offsets, lines
+
+    def operands(self, op: Op) -> list:
+        """Return the strings the payload of the instruction points to. """
+        start = op.offset + avm.bc_ins.SIZE
+        return [
+            self.string(_PTR.unpack_from(self._map, start + index)[0])
+            for index in range(0, op.length, _PTR.size)
+        ]
+
+    def instructions(self, start: int = None):
+        """Lazily yield every instruction in the code segment.
+        :param start: offset of the first instruction, defaults to the start
+                      of the code segment
+        """
+        pos = self.header.hdr_off_code if start is None else start
+        end = self.header.hdr_off_mut
+        data = self._map
+        while pos < end:
+            type_, length, source = _INS.unpack_from(data, pos)
+            yield Op(pos, type_, length, source)
+            pos += avm.bc_ins.SIZE + length
+
+    def symbols(self):
+        """Lazily yield the bc_sym structure of every function in the symbol
+        table, in the order they are defined. """
+        ptr = self.header.hdr_off_sym
+        if not ptr:
+            return
+        table = avm.bc_symtab.unpack_from(self._map, ptr)
+        ptr += avm.bc_symtab.SIZE
+        for pos in range(ptr, ptr + _SYM.size * table.st_count, _SYM.size):
+            yield avm.bc_sym.unpack_from(self._map, pos)
+
+    def symbol(self, name: str):
+        """Find the bc_sym structure of a function using the hashed index of
+        the symbol table, returning None if there is no such function or
+        the file has no symbol table.
+        :param name: name of the function
+        """
+        ptr = self.header.hdr_off_sym
+        if not ptr:
+            return None
+        count, size = avm.bc_symtab.layout.unpack_from(self._map, ptr)
+        entries = ptr + avm.bc_symtab.SIZE
+        slots = entries + _SYM.size * count
+
+        encoded = name.encode()
+        mask = size - 1
+        slot = avm.bc_hash(encoded) & mask
+        while True:
+            number = _PTR.unpack_from(self._map, slots + 4 * slot)[0]
+            if not number:
+                return None
+            sym = avm.bc_sym.unpack_from(self._map,
+                                         entries + _SYM.size * (number - 1))
+            name_end = sym.sym_name + sym.sym_len
+            if self._map[sym.sym_name:name_end] == encoded:
+                return sym
+            slot = (slot + 1) & mask
+
+    def function(self, name: str):
+        """Yield the instructions of a single function, from its FUNCTION up
+        to and including the ENDFUNC instruction. The function is looked up
+        in the symbol table, files without one are searched instruction by
+        instruction, reading only the first operand of each FUNCTION. """
+        if self.header.hdr_off_sym:
+            sym = self.symbol(name)
+            if sym is None:
+                raise KeyError(f'no function named {name}')
+            for op in self.instructions(sym.sym_pos):
+                yield op
+                if op.type == avm.BCO_ENDFUNC:
+                    return
+            return
+
+        found = False
+        for op in self.instructions():
+            if not found:
+                if op.type != avm.BCO_FUNCTION:
+                    continue
+                start = op.offset + avm.bc_ins.SIZE
+                ptr = _PTR.unpack_from(self._map, start)[0]
+                if self.string(ptr) != name:
+                    continue
+                found = True
+
+            yield op
+            if op.type == avm.BCO_ENDFUNC:
+                return
+
+        if not found:
+            raise KeyError(f'no function named {name}')
+
+
+def disassemble(reader: Reader, function: str = None, source: bool = False):
+    """Yield the disassembly of the file or of a single function line by
+    line.
+    :param reader: opened bytecode file
+    :param function: only disassemble the function with this name
+    :param source: show the source line of each instruction if available
+    """
+    ops = reader.function(function) if function else reader.instructions()
+    for op in ops:
+        operands = ' '.join(reader.operands(op))
+        yield f'{op.offset:08x}  {op.name:<9} {operands}'.rstrip()
+        found = source and reader.line(op)
+        if found:
+            yield f'{"":10}; {found[0]:4} | {found[1]}'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Disassemble Astro '
+                                     'bytecode.')
+    parser.add_argument('path', help='Path to the compiled file')
+    parser.add_argument('-f', '--function', help='Only disassemble the '
+                        'function with this name')
+    parser.add_argument('-s', '--source', action='store_true',
+                        help='Show the source of each instruction')
+    args = parser.parse_args()
+
+    with Reader(args.path) as reader:
+        print(f'module {reader.module_name} from {reader.source_name}, '
+              f'entry {reader.entry}')
+        for line in disassemble(reader, args.function, args.source):
+            print(line)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+"""
+Per phase timing and memory statistics of a compilation. Stages wrap their
+work in `with stats.phase(name):` and report counts with stats.count(), which
+cost next to nothing when the statistics are disabled (the NULL instance).
+"""
+import time
+from contextlib import contextmanager, nullcontext
+
+__author__  = 'bellrise'
+__version__ = '0.1'
+
+
+class Stats:
+    """Collects the wall time and tracemalloc peak of each phase, along with
+    any counts reported by the stages. """
+
+    enabled = True
+
+    def __init__(self, memory: bool = True):
+        """Create a new statistics collector.
+        :param memory: trace memory allocations to report peak memory usage,
+                       which slows the compilation down
+        """
+        self.memory = memory
+        self.phases = {}
+        self.counts = {}
+
+        # Peaks of the phases the current one is nested in, since entering
+        # a phase resets the peak tracemalloc keeps
+        self._outer = []
+
+    @contextmanager
+    def phase(self, name: str):
+        """Measure the code run inside of the with block. Running the same
+        phase again adds to its time. Phases may be nested, the peak of the
+        outer phase includes the inner one. """
+        if self.memory:
+            import tracemalloc
+        started = self.memory and not tracemalloc.is_tracing()
+        if started:
+            tracemalloc.start()
+        if self.memory:
+            if self._outer:
+                peak = tracemalloc.get_traced_memory()[1]
+                self._outer[-1] = max(self._outer[-1], peak)
+            self._outer.append(0)
+            tracemalloc.reset_peak()
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            phase = self.phases.setdefault(name, {'time': 0.0, 'peak': 0})
+            phase['time'] += elapsed
+            if self.memory:
+                peak = max(self._outer.pop(),
+                           tracemalloc.get_traced_memory()[1])
+                phase['peak'] = max(phase['peak'], peak)
+                if self._outer:
+                    self._outer[-1] = max(self._outer[-1], peak)
+            if started:
+                tracemalloc.stop()
+
+    def count(self, name: str, value: int):
+        """Add a value to a counter, like the amount of lines or tokens. """
+        self.counts[name] = self.counts.get(name, 0) + value
+
+    def report(self) -> dict:
+        """Return the statistics as a dict that can be turned into JSON. """
+        result = {
+            'phases': self.phases,
+            'counts': self.counts,
+            'total_time': sum(p['time'] for p in self.phases.values()),
+        }
+        tokenize = self.phases.get('tokenize')
+        if tokenize and tokenize['time'] and 'tokens' in self.counts:
+            result['tokens_per_sec'] = self.counts['tokens'] / tokenize['time']
+        if self.memory:
+            result['peak'] = max(
+                (p['peak'] for p in self.phases.values()), default=0
+            )
+        return result
+
+
+class _NullStats:
+    """Statistics collector that does nothing. """
+
+    enabled = False
+    _context = nullcontext()
+
+    def phase(self, name: str):
+        return self._context
+
+    def count(self, name: str, value: int):
+        pass
+
+    def report(self):
+        return None
+
+
+NULL = _NullStats()
+
+
+def format_report(name: str, report: dict) -> str:
+    """Format a report from Stats.report as a human readable table. """
+    lines = [f'{name}:']
+    width = max(12, *map(len, report['phases']), *map(len, report['counts']))
+    for phase, values in report['phases'].items():
+        line = f'  {phase:<{width}} {values["time"] * 1000:10.2f} ms'
+        if 'peak' in report:
+            line += f' {values["peak"] / 1e6:10.2f} MB peak'
+        lines.append(line)
+
+    total = report['total_time'] * 1000
+    lines.append(f'  {"total":<{width}} {total:10.2f} ms')
+    for counter, value in report['counts'].items():
+        lines.append(f'  {counter:<{width}} {value:10}')
+    if 'tokens_per_sec' in report:
+        rate = report['tokens_per_sec']
+        lines.append(f'  {"tokens/s":<{width}} {rate:10.0f}')
+    return '\n'.join(lines)
+
+
+def dump_json(reports: dict, fp):
+    """Write the reports of many files as JSON. """
+    import json
+
+    json.dump({'files': reports}, fp, indent=2)
+    fp.write('\n')
@@ -1,24 +1,71 @@
 """ The file where the definition of the Tokenizer
 class is stored. """
 
+import re
+from array import array
+
 from astro_file import AstroFile
-from astro_types import Token, TokenType
+from astro_types import LineContext, Token, TokenStream, TokenType
 
 __author__  = 'xyLotus'
 __version__ = '0.1.0'   # sub-release [10% finished]
 
+# Single character tokens. Everything else is a part of a NAME. Tabs used to
+# be a part of the NAME after them, now every engine turns them into a TAB,
+# so the parser can measure indents made of tabs.
+_TYPE_MAP = {
+    ' ': TokenType.SPACE,
+    '\t': TokenType.TAB,
+    '!': TokenType.EXCL,
+    '(': TokenType.LPAREN,
+    ')': TokenType.RPAREN,
+    ':': TokenType.COLON,
+    ',': TokenType.COMMA,
+    '\'': TokenType.QUOTE,
+    '"': TokenType.DBQUOTE,
+    '=': TokenType.ASSIGN,
+}
+
+# One alternation matching either a whole run of name characters, or a single
+# character from the type map above.
+_SCANNER = re.compile(
+    '(?P<name>[^{0}]+)|(?P<punct>[{0}])'.format(
+        re.escape(''.join(_TYPE_MAP))
+    )
+)
+
+# Punctuation tokens are never modified, so a single instance of each one is
+# shared between all lines and all files.
+_PUNCT = {ch: Token(typ, ch) for ch, typ in _TYPE_MAP.items()}
+
 
 class Tokenizer:
     """ This class tokenizes the given files
     given in @member h_file and returns the tokens
     per line uncompressed and raw. """
 
-    def __init__(self, h_file: AstroFile):
+    ENGINE_SCAN   = 'scan'      # single regex pass, emits NAMEs directly
+    ENGINE_LEGACY = 'legacy'    # per-character tokens + _compress
+
+    def __init__(self, h_file: AstroFile, engine: str = ENGINE_SCAN,
+                 compact: bool = False):
         """ @member file = file to be tokenized,
-        @member tokens, token list; used in @method tokenize. """
+        @member tokens, token list; used in @method tokenize.
+        @member engine, which tokenizer engine to use, see ENGINE_*.
+        @member compact, store the tokens in a TokenStream instead of
+        lists of Token objects (scan engine only). """
+        if engine not in (self.ENGINE_SCAN, self.ENGINE_LEGACY):
+            raise ValueError(f'unknown tokenizer engine: {engine}')
+        if compact and engine != self.ENGINE_SCAN:
+            raise ValueError('compact tokens require the scan engine')
+
         self.is_compressed = False
+        self.engine = engine
+        self.compact = compact
         self.h_file = h_file
         self.tokens = []
+        self.sources = []
+        self.numbers = array('I')
         self.content = self.h_file.content
 
     def output_tokens(self):
@@ -30,42 +77,103 @@ class Tokenizer:
             print()
 
     def get_context(self):
-        """ Returns context in dict format providing
-        line, source and tokens. Should probably only
-        be called when tokens are compressed. """
+        """ Returns a LineContext providing line, source
+        and tokens for every line. Should probably only
+        be called when tokens are compressed. The line
+        is the line number in the original file. """
         if not self.is_compressed:
             print(f'[Tokenizer-Error]: Compress tokens with compress();')
             exit(1)
 
-        context_list = []
-        sources = self.content.split('\n')
-        for i, line in enumerate(self.tokens):
-            context_list.append({
-                'line': i + 1,
-                'source': sources[i],   
-                'tokens': self.tokens[i]
-            })
-
-        return context_list
+        sources = self.sources
+        numbers = self.numbers
+        return [
+            LineContext(numbers[i], sources[i], tokens)
+            for i, tokens in enumerate(self.tokens)
+        ]
+
+    def contexts(self):
+        """ Yields the LineContext of every line like get_context
+        as soon as the line is tokenized, without keeping
+        the tokens or sources in @member tokens. Always uses the scan
+        engine. """
+        punct = _PUNCT
+        name = TokenType.NAME
+        scan = _SCANNER.finditer
+
+        for number, _, line in self.h_file.numbered_lines():
+            yield LineContext(number, line, [
+                Token(name, m.group()) if m.lastgroup == 'name'
+                else punct[m.group()]
+                for m in scan(line)
+            ])
+
+    def _lines(self):
+        """ Yield the source lines from the file, storing them in
+        @member sources and their numbers in the original file in
+        @member numbers for get_context. """
+        self.sources = []
+        self.numbers = array('I')
+        for number, _, line in self.h_file.numbered_lines():
+            self.sources.append(line)
+            self.numbers.append(number)
+            yield line
 
     def tokenize(self) -> list:
         """ Tokenizes given file by accessing file handle
-        @member h_file (AstroFile) and storing the tokens in @member tokens."""
+        @member h_file (AstroFile) and storing the tokens in @member tokens,
+        using the engine chosen in @member engine."""
+        if self.engine == self.ENGINE_LEGACY:
+            return self._tokenize_legacy()
+        if self.compact:
+            return self._tokenize_compact()
+
+        punct = _PUNCT
+        name = TokenType.NAME
+
+        toks = []
+        for line in self._lines():
+            toks.append([
+                Token(name, m.group()) if m.lastgroup == 'name'
+                else punct[m.group()]
+                for m in _SCANNER.finditer(line)
+            ])
+
+        self.is_compressed = True
+        self.tokens = toks
+        return toks
+
+    def _tokenize_compact(self) -> TokenStream:
+        """ Same as the scan engine, but fills a TokenStream so no object
+        is kept around per token. """
+        stream = TokenStream()
+        append = stream.append
+        name = TokenType.NAME
+        numbers = self.numbers = array('I')
+
+        for number, _, line in self.h_file.numbered_lines():
+            numbers.append(number)
+            for m in _SCANNER.finditer(line):
+                start, end = m.span()
+                if m.lastgroup == 'name':
+                    append(name, start, end - start)
+                else:
+                    append(_TYPE_MAP[line[start]], start, 1)
+            stream.end_line(line)
+
+        self.is_compressed = True
+        self.tokens = stream
+        self.sources = stream.sources
+        return stream
+
+    def _tokenize_legacy(self) -> list:
+        """ The original tokenizer, creating a Token for every single
+        character and merging them with _compress afterwards. Kept around
+        for benchmarking against the scanner. """
         toks = []
+        type_map = _TYPE_MAP
 
-        type_map = {
-            ' ': TokenType.SPACE,
-            '!': TokenType.EXCL,
-            '(': TokenType.LPAREN,
-            ')': TokenType.RPAREN,
-            ':': TokenType.COLON,
-            ',': TokenType.COMMA,
-            '\'': TokenType.QUOTE,
-            '"': TokenType.DBQUOTE,
-            '=': TokenType.ASSIGN,
-        }
-
-        for line in self.content.split('\n'):
+        for line in self._lines():
             line_buffer = []
             for ch in line:
                 typ = type_map.get(ch, TokenType.SYM)
@@ -1,9 +1,31 @@
 """
-Tests for the astro_file module
+Tests for the compiler modules
 """
 import unittest
 
+import io
+import os
+import re
+import struct
+import tempfile
+from contextlib import redirect_stderr
+
+import ac_parser
 import astro_file
+import avm
+import benchmark
+import build
+import cache
+import codegen
+import deps
+import emitter
+import link
+import optimize
+import reader
+import stats
+import tokenizer
+import watch
+from astro_types import LineContext, Token, TokenType
 
 
 def read_file(path: str) -> str:
@@ -19,10 +41,1110 @@ class AstroFileTests(unittest.TestCase):
                  '    , param2):\n\n    function_content\n\n\n\n\n\n'
         self.assertEqual(file.content, result)
 
+    def test_original_position(self):
+        file = astro_file.AstroFile('test_sources/astro_file_comments.asx')
+        self.assertEqual(file.original_position(1, 30), (1, 30))
+        self.assertEqual(file.original_position(3, 4), (3, 4))
+        # The multiline comment on line 8 collapses the next 6 lines
+        self.assertEqual(file.original_position(8, 40), (11, 0))
+        self.assertEqual(file.original_position(9), (15, 0))
+
+    def test_original_source(self):
+        path = 'test_sources/astro_file_comments.asx'
+        with open(path) as f:
+            text = f.read()
+        for file in (astro_file.AstroFile(path),
+                     astro_file.AstroFile(path, stream=True),
+                     astro_file.AstroFile.from_string(text, path)):
+            self.assertEqual(file.original_source(3, 4),
+                             (3, 4, '    function_content'))
+            self.assertEqual(file.original_source(8, 40),
+                             (11, 0, '    d'))
+
+    def test_stream(self):
+        for path in TokenizerTests.sources:
+            eager = astro_file.AstroFile(path)
+            stream = astro_file.AstroFile(path, stream=True)
+            self.assertEqual(list(stream.lines()), list(eager.lines()))
+            self.assertEqual(list(stream.numbered_lines()),
+                             list(eager.numbered_lines()))
+            self.assertEqual(stream.content, '')
+
+            # The tokenizer keeps the numbers of the lines it holds on to
+            contexts = []
+            for file in (eager, stream):
+                tok = tokenizer.Tokenizer(file)
+                tok.tokenize()
+                contexts.append([ctx.line for ctx in tok.get_context()])
+            self.assertEqual(contexts[0], contexts[1])
+
+    def test_cleanup_line_comment(self):
+        file = astro_file.AstroFile('test_sources/astro_file_string.asx')
+        self.assertEqual(file.content.split('\n')[1], '')
+
+    def test_from_string(self):
+        for path in TokenizerTests.sources:
+            eager = astro_file.AstroFile(path)
+            with open(path, 'rb') as f:
+                text = f.read()
+            for source in (text.decode(), text, memoryview(text)):
+                file = astro_file.AstroFile.from_string(source, path)
+                self.assertEqual(list(file.lines()), list(eager.lines()))
+                self.assertEqual(file.original_position(3),
+                                 eager.original_position(3))
+
+
+class TokenizerTests(unittest.TestCase):
+
+    sources = [
+        'test_sources/astro_file_comments.asx',
+        'test_sources/astro_file_string.asx',
+    ]
+
+    @staticmethod
+    def context(path: str, engine: str, compact: bool = False) -> list:
+        tok = tokenizer.Tokenizer(astro_file.AstroFile(path), engine, compact)
+        tok.tokenize()
+        return [
+            (ctx.line, ctx.source, [str(t) for t in ctx.tokens])
+            for ctx in tok.get_context()
+        ]
+
+    def test_engines_match(self):
+        for path in self.sources:
+            self.assertEqual(
+                self.context(path, tokenizer.Tokenizer.ENGINE_SCAN),
+                self.context(path, tokenizer.Tokenizer.ENGINE_LEGACY)
+            )
+
+    def test_compact_match(self):
+        for path in self.sources:
+            self.assertEqual(
+                self.context(path, tokenizer.Tokenizer.ENGINE_SCAN, True),
+                self.context(path, tokenizer.Tokenizer.ENGINE_SCAN)
+            )
+
+    def test_scan_names(self):
+        file = astro_file.AstroFile('test_sources/astro_file_string.asx')
+        tok = tokenizer.Tokenizer(file)
+        line = tok.tokenize()[3]
+        self.assertEqual([t.value for t in line if t.id != 0],
+                         ['x', '=', "'", 'string', "'"])
+
+    def test_tabs(self):
+        fd, path = tempfile.mkstemp(suffix='.asx')
+        with os.fdopen(fd, 'w') as f:
+            f.write('! f(x):\n\tout\tx\n')
+        try:
+            for engine in (tokenizer.Tokenizer.ENGINE_LEGACY,
+                           tokenizer.Tokenizer.ENGINE_SCAN):
+                tokens = self.context(path, engine)[1][2]
+                self.assertEqual(tokens, [str(Token(TokenType.TAB, '\t')),
+                                          str(Token(TokenType.NAME, 'out')),
+                                          str(Token(TokenType.TAB, '\t')),
+                                          str(Token(TokenType.NAME, 'x'))])
+        finally:
+            os.remove(path)
+
+
+class ParserTests(unittest.TestCase):
+
+    def setUp(self):
+        self.parser = ac_parser.Parser('<test>', [LineContext(1, '', [])])
+
+    def match(self, *ids):
+        return self.parser.match([Token(id_) for id_ in ids])
+
+    def test_validate(self):
+        contexts = [LineContext(1, '', []), {'line': 2}]
+        with self.assertRaises(TypeError):
+            ac_parser.Parser('<test>', contexts)
+        ac_parser.Parser('<test>', contexts, trust_me=True)
+
+    def test_match(self):
+        T = TokenType
+        self.assertEqual(self.match(), avm.BCO_NOP)
+        self.assertEqual(self.match(T.SPACE, T.SPACE), avm.BCO_NOP)
+        self.assertEqual(
+            self.match(T.EXCL, T.NAME, T.LPAREN, T.NAME, T.COMMA, T.NAME,
+                       T.RPAREN, T.COLON),
+            avm.BCO_FUNCTION
+        )
+        self.assertEqual(self.match(T.NAME, T.LPAREN, T.RPAREN), avm.BCO_CALL)
+        self.assertEqual(self.match(T.NAME, T.SPACE, T.ASSIGN, T.NAME),
+                         avm.BCO_ASSIGN)
+        self.assertEqual(self.match(T.NAME, T.SPACE, T.NAME),
+                         avm.BCO_BASECALL)
+        self.assertEqual(self.match(T.NAME, T.LPAREN, T.NAME, T.RPAREN,
+                                    T.NAME), avm.BCO_BASECALL)
+
+    def test_match_short(self):
+        T = TokenType
+        # These used to raise IndexError and ValueError
+        self.assertEqual(self.match(T.NAME), avm.BCO_BASECALL)
+        self.assertIsNone(self.match(T.EXCL, T.NAME, T.LPAREN, T.NAME))
+        self.assertIsNone(self.match(T.COLON))
+
+    def test_match_cache(self):
+        T = TokenType
+        self.match(T.NAME, T.ASSIGN, T.NAME)
+        self.assertIn((T.NAME, T.ASSIGN, T.NAME), self.parser._match_cache)
+
+    def parse(self, source: str) -> ac_parser.Parser:
+        fd, path = tempfile.mkstemp(suffix='.asx')
+        with os.fdopen(fd, 'w') as f:
+            f.write(source)
+        try:
+            tok = tokenizer.Tokenizer(astro_file.AstroFile(path))
+            tok.tokenize()
+            parser = ac_parser.Parser(path, tok.get_context())
+            parser.parse()
+        finally:
+            os.remove(path)
+        return parser
+
+    def test_collect(self):
+        parser = self.parse('! main():\n    out x\n    if x:\n        out y\n'
+                            '\n    out z\n! f(a):\n\tout a\nout b\n')
+        tree = parser.tree
+        self.assertEqual([type(item) for item in tree.code[:3]],
+                         [ac_parser.CodeBlock, ac_parser.CodeBlock,
+                          LineContext])
+        self.assertEqual(tree.code[2].source, 'out b')
+        main, f = tree.code[:2]
+        self.assertEqual((main.name, f.name), ('main', 'f'))
+        self.assertEqual(len(main.code), 3)
+        self.assertEqual(main.code[1].ctx.source, '    if x:')
+        self.assertEqual(main.code[1].code[0].source, '        out y')
+        self.assertEqual(f.code[0].indent, 1)
+        self.assertIsNot(main.code, f.code)
+        self.assertEqual(list(tree.contexts()), parser.tokens)
+
+    def test_collect_deep(self):
+        source = benchmark.generate_source('deep', 2000)
+        parser = self.parse(source)
+        self.assertEqual(list(parser.tree.contexts()), parser.tokens)
+
+
+def generate(path: str) -> list:
+    tok = tokenizer.Tokenizer(astro_file.AstroFile(path))
+    tok.tokenize()
+    contexts = ac_parser.Parser(path, tok.get_context()).parse()
+    return codegen.CodeGenerator(path).generate(contexts)
+
+
+def listing(data: bytes) -> list:
+    """Return the names, symbols and disassembly with sources of a module,
+    without any offsets, so modules laid out differently can be compared.
+    """
+    fd, path = tempfile.mkstemp(suffix='.abc')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        with reader.Reader(path) as r:
+            return [r.module_name, r.source_name, r.entry] \
+                + [(r.string(s.sym_name), s.sym_flags) for s in r.symbols()] \
+                + [line[10:] for line in reader.disassemble(r, source=True)]
+    finally:
+        os.remove(path)
+
+
+class CodegenTests(unittest.TestCase):
+
+    def test_generate(self):
+        code = generate('test_sources/astro_file_string.asx')
+        self.assertEqual(
+            [(ins.type, ins.operands, ins.line) for ins in code], [
+                (avm.BCO_FUNCTION, ('function_name', 'param1', 'param2'), 1),
+                (avm.BCO_NOP, (), 0),
+                (avm.BCO_BASECALL, ('out', 'param1'), 3),
+                (avm.BCO_CREATE, ('x',), 4),
+                (avm.BCO_ASSIGN, ('x', "'string'"), 4),
+                (avm.BCO_ENDFUNC, (), 0),
+            ]
+        )
+
+
+class OptimizerTests(unittest.TestCase):
+
+    def code(self, *types):
+        return [codegen.Instruction(type_, operands) for type_, operands in
+                types]
+
+    def test_rules(self):
+        code = self.code(
+            (avm.BCO_FUNCTION, ('main',)), (avm.BCO_NOP, ()),
+            (avm.BCO_CREATE, ('x',)), (avm.BCO_ASSIGN, ('x', '1')),
+            (avm.BCO_CREATE, ('y',)), (avm.BCO_ASSIGN, ('x', '2')),
+            (avm.BCO_IF, ('x',)), (avm.BCO_IF, ('y',)), (avm.BCO_NOP, ()),
+            (avm.BCO_ELSE, ()), (avm.BCO_ENDIF, ()), (avm.BCO_ENDIF, ()),
+            (avm.BCO_IF, ('x',)), (avm.BCO_CALL, ('f',)), (avm.BCO_ELSE, ()),
+            (avm.BCO_ENDIF, ()), (avm.BCO_ENDFUNC, ())
+        )
+        optimizer = optimize.Optimizer()
+        self.assertEqual(optimizer.optimize(code), self.code(
+            (avm.BCO_FUNCTION, ('main',)), (avm.BCO_CREATE, ('x', '1')),
+            (avm.BCO_CREATE, ('y',)), (avm.BCO_ASSIGN, ('x', '2')),
+            (avm.BCO_IF, ('x',)), (avm.BCO_CALL, ('f',)),
+            (avm.BCO_ENDIF, ()), (avm.BCO_ENDFUNC, ())
+        ))
+        self.assertEqual(optimizer.savings, {
+            'nop': [2, 16], 'create_assign': [1, 12], 'empty_if': [6, 56]
+        })
+
+    def test_toggle(self):
+        code = self.code((avm.BCO_NOP, ()), (avm.BCO_IF, ('x',)),
+                         (avm.BCO_NOP, ()), (avm.BCO_ENDIF, ()))
+        self.assertEqual(optimize.Optimizer(('empty_if',)).optimize(code),
+                         code[:1])
+        self.assertEqual(optimize.Optimizer(()).optimize(code), code)
+        self.assertRaises(ValueError, optimize.Optimizer, ('unknown',))
+
+    def test_empty_else(self):
+        # Without the nop rule, the NOPs of the ELSE branch are still there
+        code = self.code((avm.BCO_IF, ('x',)), (avm.BCO_CALL, ('f',)),
+                         (avm.BCO_ELSE, ()), (avm.BCO_NOP, ()),
+                         (avm.BCO_ENDIF, ()))
+        self.assertEqual(optimize.Optimizer(('empty_if',)).optimize(code),
+                         code[:2] + code[4:])
+
+    def test_build(self):
+        src = 'test_sources/astro_file_string.asx'
+        full = build.compile_file(src, build.Options())
+        optimized = build.compile_file(src, build.Options(optimize=('nop',)))
+        self.assertLess(len(optimized), len(full))
+        self.assertNotEqual(build.Options(optimize=('nop',)).key(),
+                            build.Options().key())
+
+
+class CallGraphTests(unittest.TestCase):
+
+    def function(self, name, *calls):
+        return [codegen.Instruction(avm.BCO_FUNCTION, (name,)),
+                *(codegen.Instruction(avm.BCO_CALL, (call,))
+                  for call in calls),
+                codegen.Instruction(avm.BCO_ENDFUNC)]
+
+    def test_prune(self):
+        code = [*self.function('main', 'a', 'main'), *self.function('a', 'b'),
+                *self.function('b', 'a'), *self.function('unused', 'main'),
+                codegen.Instruction(avm.BCO_CALL, ('init',)),
+                *self.function('init', 'print'), *self.function('dead')]
+        graph = optimize.CallGraph(code)
+        self.assertEqual(graph.reachable('main'), {'main', 'a', 'b', 'init'})
+
+        pruned = graph.prune(code, 'main')
+        self.assertEqual(graph.pruned, 2)
+        self.assertEqual(
+            [ins.operands[0] for ins in pruned if ins.type == avm.BCO_FUNCTION],
+            ['main', 'a', 'b', 'init']
+        )
+
+    def test_library(self):
+        code = [*self.function('a'), *self.function('b')]
+        self.assertEqual(optimize.CallGraph(code).prune(code, 'main'), code)
+
+
+class EmitterTests(unittest.TestCase):
+
+    def test_build(self):
+        out = emitter.Emitter('mod', 'mod.asx')
+        out.emit(generate('test_sources/astro_file_string.asx'))
+        buf = out.build()
+
+        hdr = struct.unpack_from('<4sIIIBBIIIIIIII', buf)
+        magic, version, size, _, _, _, data, code, mut, oname, mname, func, \
+            sym, lines = hdr
+        self.assertEqual(magic, avm.BC_MAGIC)
+        self.assertEqual(version, avm.BC_VERSION)
+        self.assertEqual(size, len(buf))
+        self.assertEqual(code % emitter.CODE_ALIGN, 0)
+        self.assertEqual(mut, len(buf))
+        self.assertEqual(buf[mname:buf.index(0, mname)], b'mod')
+        self.assertEqual(buf[oname:buf.index(0, oname)], b'mod.asx')
+        self.assertEqual(buf[func:buf.index(0, func)], b'main')
+        self.assertTrue(data <= oname < code)
+        self.assertTrue(oname < sym < code)
+        self.assertEqual(sym % 4, 0)
+        self.assertEqual(lines, 0)
+
+        # First instruction is the function, pointing at its name
+        type_, length, source = struct.unpack_from('<HHI', buf, code)
+        self.assertEqual((type_, length), (avm.BCO_FUNCTION, 12))
+        name = struct.unpack_from('<I', buf, code + 8)[0]
+        self.assertEqual(buf[name:buf.index(0, name)], b'function_name')
+        self.assertEqual(struct.unpack_from('<I', buf, source)[0], 1)
+
+    def test_intern(self):
+        out = emitter.Emitter('main', 'main.asx')
+        self.assertEqual(out.off_mname, out.off_func)
+        self.assertEqual(out.add_string('x'), out.add_string('x'))
+        self.assertNotEqual(out.add_string('x'), out.add_string('y'))
+
+        code = [codegen.Instruction(avm.BCO_ASSIGN, ('x', "'string'"))]
+        out.emit(code)
+        size = len(out.data)
+        out.emit(code * 100)
+        self.assertEqual(len(out.data), size)
+        self.assertEqual(out.build().index(b"'string'"),
+                         out.build().rindex(b"'string'"))
+
+    def test_spool(self):
+        code = generate('test_sources/astro_file_string.asx') \
+            + generate('test_sources/astro_file_comments.asx')
+        for line_table in (False, True):
+            whole = emitter.Emitter('mod', 'mod.asx', line_table=line_table)
+            whole.emit(code)
+            spooled = emitter.Emitter('mod', 'mod.asx', line_table=line_table,
+                                      spool=True)
+            for ins in code:
+                spooled.emit([ins])
+                if ins.type == avm.BCO_ENDFUNC:
+                    spooled.flush()
+            self.assertEqual(spooled._strings, {})
+            out = io.BytesIO()
+            self.assertEqual(spooled.write_spooled(out), len(out.getvalue()))
+            data = out.getvalue()
+            self.assertEqual(listing(data), listing(whole.build()))
+            self.assertEqual(avm.bc_hdr.unpack_from(data).hdr_flags,
+                             avm.BCF_HDR_STREAMED)
+
+
+class AvmTests(unittest.TestCase):
+
+    header = '../avm/include/avm/bc.h'
+    sizes = {'_bc8': 1, '_bc16': 2, '_bc32': 4, '_bc_ptr': 4}
+
+    def c_structs(self) -> dict:
+        """Parse the struct definitions from the C header into a dict of
+        field names and sizes. """
+        structs = {}
+        content = read_file(self.header)
+        for name, body in re.findall(r'struct[^\n]*?(bc_\w+)\n\{(.*?)\};',
+                                     content, re.S):
+            fields = []
+            for typ, ptr, field, array in re.findall(
+                    r'(\w+)\s+(\*?)(\w+)(\[\d*\])?;', body):
+                if ptr:
+                    size = struct.calcsize('P')
+                elif array:
+                    size = self.sizes[typ] * int(array[1:-1] or 0)
+                else:
+                    size = self.sizes[typ]
+                fields.append((field, size))
+            structs[name] = fields
+        return structs
+
+    def test_layouts(self):
+        structs = self.c_structs()
+        for name in ('bc_hdr', 'bc_ins', 'bc_sym', 'bc_symtab', 'bc_source',
+                     'bc_lines'):
+            cls = getattr(avm, name)
+            fields = structs[name]
+            self.assertEqual(cls._fields, tuple(f for f, _ in fields), name)
+            self.assertEqual(cls.SIZE, sum(size for _, size in fields), name)
+
+    def test_hash(self):
+        self.assertEqual(avm.bc_hash(b''), 0)
+        self.assertEqual(avm.bc_hash(b'123456789'), 0xcbf43926)
+
+    def test_pack(self):
+        ins = avm.bc_ins(avm.BCO_CALL, 4, 0x42, b'\x01\x02\x03\x04')
+        buf = bytearray(16)
+        self.assertEqual(ins.pack_into(buf, 2), ins.size())
+        read = avm.bc_ins.unpack_from(memoryview(buf), 2)
+        self.assertEqual((read.ins_type, read.ins_len, read.ins_source),
+                         (avm.BCO_CALL, 4, 0x42))
+        self.assertEqual(bytes(read.ins_payload), ins.ins_payload)
+        self.assertEqual(ins.pack(), bytes(buf[2:14]))
+
+        with self.assertRaises(AttributeError):
+            ins.ins_other = 1
+
+
+class ReaderTests(unittest.TestCase):
+
+    def setUp(self):
+        self.code = generate('test_sources/astro_file_string.asx')
+        out = emitter.Emitter('mod', 'mod.asx')
+        out.emit(self.code)
+        fd, self.path = tempfile.mkstemp(suffix='.abc')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(out.build())
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_read(self):
+        with reader.Reader(self.path) as bc:
+            self.assertEqual((bc.module_name, bc.source_name, bc.entry),
+                             ('mod', 'mod.asx', 'main'))
+            ops = list(bc.instructions())
+            self.assertEqual([op.type for op in ops],
+                             [ins.type for ins in self.code])
+            self.assertEqual([tuple(bc.operands(op)) for op in ops],
+                             [ins.operands for ins in self.code])
+            self.assertEqual(bc.source(ops[0].source),
+                             (1, '! function_name(param1, param2):'))
+            self.assertIsNone(bc.source(ops[1].source))
+
+    def test_function(self):
+        with reader.Reader(self.path) as bc:
+            ops = list(bc.function('function_name'))
+            self.assertEqual(ops[-1].type, avm.BCO_ENDFUNC)
+            with self.assertRaises(KeyError):
+                list(bc.function('missing'))
+
+    def test_symbols(self):
+        code = [codegen.Instruction(avm.BCO_FUNCTION, ('main',)),
+                codegen.Instruction(avm.BCO_CALL, ('f1',)),
+                codegen.Instruction(avm.BCO_ENDFUNC)]
+        for index in range(1000):
+            code += [codegen.Instruction(avm.BCO_FUNCTION, (f'f{index}',)),
+                     codegen.Instruction(avm.BCO_ENDFUNC)]
+        out = emitter.Emitter('mod', 'mod.asx')
+        out.called = optimize.CallGraph(code).reachable('main')
+        out.emit(code)
+        buf = out.build()
+        with open(self.path, 'wb') as f:
+            f.write(buf)
+
+        with reader.Reader(self.path) as bc:
+            self.assertEqual(len(list(bc.symbols())), 1001)
+            for name in ('main', 'f0', 'f1', 'f999'):
+                sym = bc.symbol(name)
+                op = next(bc.instructions(sym.sym_pos))
+                self.assertEqual(bc.operands(op), [name])
+                self.assertEqual(bool(sym.sym_flags & avm.BCF_SYM_CALLED),
+                                 name in ('main', 'f1'))
+            self.assertIsNone(bc.symbol('f1000'))
+            indexed = [op.offset for op in bc.function('f500')]
+
+        # Files without a symbol table are searched instead
+        hdr = avm.bc_hdr.unpack_from(buf)
+        hdr.hdr_off_sym = 0
+        hdr.pack_into(buf, 0)
+        with open(self.path, 'wb') as f:
+            f.write(buf)
+        with reader.Reader(self.path) as bc:
+            self.assertEqual(list(bc.symbols()), [])
+            self.assertIsNone(bc.symbol('f500'))
+            self.assertEqual([op.offset for op in bc.function('f500')],
+                             indexed)
+
+    def write(self, code: list, **kwargs) -> bytearray:
+        out = emitter.Emitter('mod', 'mod.asx', **kwargs)
+        out.emit(code)
+        buf = out.build()
+        with open(self.path, 'wb') as f:
+            f.write(buf)
+        return buf
+
+    def test_line_table(self):
+        Ins = codegen.Instruction
+        code = [Ins(avm.BCO_FUNCTION, ('main',), 1, '! main():'),
+                Ins(avm.BCO_BASECALL, ('out',) * 300, 1000, '    out'),
+                Ins(avm.BCO_BASECALL, ('out',), 3, '    out'),
+                Ins(avm.BCO_ENDFUNC),
+                Ins(avm.BCO_CALL, ('main',), 5, 'main()')]
+        expected = [(ins.line, ins.source) if ins.line else None
+                    for ins in code]
+        self.write(code, line_table=True)
+        with reader.Reader(self.path) as bc:
+            self.assertTrue(bc.header.hdr_off_lines)
+            self.assertEqual([bc.line(op) for op in bc.instructions()],
+                             expected)
+
+        # The same lines repeated further down share their sources
+        code = [Ins(ins.type, ins.operands, ins.line and ins.line + 4 * copy,
+                    ins.source) for copy in range(20) for ins in self.code]
+        lines = [(ins.line, ins.source) for ins in code if ins.line]
+        sizes = {}
+        for mode in ({}, {'line_table': True}, {'debug': False}):
+            sizes[tuple(mode)] = len(self.write(code, **mode))
+            with reader.Reader(self.path) as bc:
+                found = [bc.line(op) for op in bc.instructions()]
+            if mode == {'debug': False}:
+                self.assertEqual(found, [None] * len(found))
+            else:
+                self.assertEqual([line for line in found if line], lines)
+        self.assertLess(sizes[('debug',)], sizes[('line_table',)])
+        self.assertLess(sizes[('line_table',)], sizes[()])
+
+    def test_line_table_gap(self):
+        # The blank lines are NOPs without a line, long enough to need
+        # filler pairs between the two lines
+        source = '! main():\n    out a\n' + '\n' * 200 + '    out b\n'
+        options = build.Options(line_table=True)
+        with open(self.path, 'wb') as f:
+            f.write(build.compile_source(source, 'mod.asx', options))
+        with reader.Reader(self.path) as bc:
+            found = [(op.type, bc.line(op)) for op in bc.instructions()]
+        self.assertEqual(found[1], (avm.BCO_BASECALL, (2, '    out a')))
+        self.assertEqual(set(found[2:202]), {(avm.BCO_NOP, None)})
+        self.assertEqual(found[202], (avm.BCO_BASECALL, (203, '    out b')))
+
+    def test_invalid(self):
+        with open(self.path, 'r+b') as f:
+            f.write(b'nope')
+        with self.assertRaises(ValueError):
+            reader.Reader(self.path)
+
+
+class LinkTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def compile(self, name: str, source: str) -> str:
+        src = os.path.join(self.dir.name, name + '.asx')
+        with open(src, 'w') as f:
+            f.write(source)
+        build.build_file(src, None, build.Options())
+        return build.output_path(src)
+
+    def disassemble(self, path: str, function: str) -> list:
+        with reader.Reader(path) as r:
+            return [line[10:] for line in reader.disassemble(r, function)]
+
+    def test_link(self):
+        prog = self.compile('prog', '! main():\n    helper(1)\n')
+        lib = self.compile('lib', '! helper(x):\n    out x\n\n'
+                                  '! unused():\n    out 2\n')
+        image = os.path.join(self.dir.name, 'image.abc')
+        with open(image, 'wb') as f:
+            f.write(link.link([prog, lib]))
+
+        with reader.Reader(image) as r:
+            self.assertEqual((r.module_name, r.entry), ('prog', 'main'))
+            self.assertTrue(r.header.hdr_flags & avm.BCF_HDR_STANDALONE)
+            flags = {r.string(sym.sym_name): sym.sym_flags
+                     for sym in r.symbols()}
+        self.assertEqual(set(flags), {'main', 'helper', 'unused'})
+        self.assertTrue(flags['helper'] & avm.BCF_SYM_CALLED)
+        self.assertFalse(flags['unused'] & avm.BCF_SYM_CALLED)
+        for path, function in ((prog, 'main'), (lib, 'helper')):
+            self.assertEqual(self.disassemble(image, function),
+                             self.disassemble(path, function))
+
+    def test_sources(self):
+        prog = self.compile('prog', '! main():\n    helper(1)\n')
+        lib = self.compile('lib', '! helper(x):\n    out x\n')
+        with reader.Reader(lib) as r:
+            self.assertEqual(r.line(next(r.function('helper'))),
+                             (1, '! helper(x):'))
+
+        # The bc_source structures are moved into the data of the image
+        image = os.path.join(self.dir.name, 'image.abc')
+        with open(image, 'wb') as f:
+            f.write(link.link([prog, lib]))
+        with reader.Reader(image) as r:
+            for name, source in (('main', '! main():'),
+                                 ('helper', '! helper(x):')):
+                op = next(r.function(name))
+                self.assertGreaterEqual(op.source, r.header.hdr_off_data)
+                self.assertLess(op.source, r.header.hdr_off_sym)
+                self.assertEqual(r.source(op.source), (1, source))
+            self.assertEqual(r.line(list(r.function('helper'))[1]),
+                             (2, '    out x'))
+
+        # A line table would mix up the lines of both modules
+        with self.assertRaises(ValueError):
+            link.link([prog, lib], line_table=True)
+
+        # A single module keeps them
+        with open(image, 'wb') as f:
+            f.write(link.link([lib], line_table=True))
+        with reader.Reader(image) as r:
+            self.assertEqual(r.line(next(r.function('helper'))),
+                             (1, '! helper(x):'))
+
+    def test_duplicate(self):
+        a = self.compile('a', '! f():\n    out 1\n')
+        b = self.compile('b', '! f():\n    out 2\n')
+        with self.assertRaises(ValueError):
+            link.link([a, b])
+
+
+class DepsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.cache = os.path.join(self.dir.name, 'cache')
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def write(self, name: str, source: str) -> str:
+        path = os.path.join(self.dir.name, name + '.asx')
+        with open(path, 'w') as f:
+            f.write(source)
+        return path
+
+    def test_scan(self):
+        path = self.write('a', 'import lib ; why\n; import no\n'
+                               ';; import\nno ;;\n! f():\n    import x\n'
+                               'import other\nimport lib\n')
+        self.assertEqual(deps.scan_imports(path), ['lib', 'other'])
+        code = generate(path)
+        self.assertEqual([ins.operands for ins in code
+                          if ins.type == avm.BCO_IMPORT],
+                         [('lib',), ('other',), ('lib',)])
+
+    def test_order(self):
+        a = self.write('a', 'import b\nimport c\n')
+        b = self.write('b', 'import c\n')
+        c = self.write('c', '')
+        graph = deps.DependencyGraph([a, b, c])
+        self.assertEqual(graph.imports[a], [b, c])
+        self.assertEqual(graph.order(), [c, b, a])
+
+        self.write('c', 'import a\n')
+        with self.assertRaises(ValueError):
+            deps.DependencyGraph([a, b, c]).order()
+
+    def build(self, sources: list, jobs: int = 1) -> dict:
+        results = build.build_many(sources, build.Options(), jobs,
+                                   cache.CompileCache(self.cache))
+        return {os.path.basename(r.src): r for r in results}
+
+    def test_build(self):
+        prog = self.write('prog', 'import lib\n! main():\n    helper(1)\n')
+        lib = self.write('lib', '! helper(x):\n    out x\n')
+        results = self.build([prog, lib], jobs=2)
+        self.assertTrue(all(r.ok for r in results.values()))
+        self.assertEqual(results['lib.asx'].interface, {'helper': 1})
+
+        # Changing only the body of the function keeps the interface
+        self.write('lib', '! helper(x):\n    out 2\n')
+        results = self.build([prog, lib])
+        self.assertFalse(results['lib.asx'].cached)
+        self.assertTrue(results['prog.asx'].cached)
+
+        self.write('lib', '! helper(x, y):\n    out x\n')
+        results = self.build([prog, lib])
+        self.assertFalse(results['prog.asx'].ok)
+        self.assertIn('helper from lib takes 2 arguments, 1 given',
+                      results['prog.asx'].stderr)
+
+    def test_failed_import(self):
+        prog = self.write('prog', 'import lib\nimport empty\n'
+                                  '! main():\n    helper(1)\n')
+        lib = self.write('lib', '! helper(x:\n    out x\n')
+        empty = self.write('empty', 'x = 1\n')
+        user = self.write('user', 'import prog\n')
+        for jobs in (1, 2):
+            results = self.build([prog, lib, empty, user], jobs)
+            self.assertTrue(results['empty.asx'].ok)
+            self.assertEqual(results['empty.asx'].interface, {})
+            self.assertFalse(results['lib.asx'].ok)
+            for name, broken in (('prog', lib), ('user', prog)):
+                self.assertFalse(results[name + '.asx'].ok)
+                self.assertIn(f'because {broken} failed to compile',
+                              results[name + '.asx'].stderr)
+
+
+class CacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.cache = cache.CompileCache(self.dir.name, max_size=100)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_key(self):
+        key = self.cache.key(b'out x')
+        self.assertEqual(key, self.cache.key(b'out x'))
+        self.assertNotEqual(key, self.cache.key(b'out y'))
+        self.assertNotEqual(key, self.cache.key(b'out x', 'strip'))
+
+        # Any change to the compiler changes the key
+        fingerprint = cache.fingerprint
+        self.assertEqual(len(fingerprint()), 64)
+        try:
+            cache.fingerprint = lambda: '0' * 64
+            self.assertNotEqual(key, self.cache.key(b'out x'))
+        finally:
+            cache.fingerprint = fingerprint
+
+    def test_get_put(self):
+        self.assertIsNone(self.cache.get('a'))
+        self.cache.put('a', b'data')
+        self.assertEqual(self.cache.get('a'), b'data')
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+        self.assertEqual(os.listdir(self.dir.name), ['a.abc'])
+
+    def test_evict(self):
+        for index, key in enumerate('abc'):
+            self.cache.put(key, bytes(40))
+            path = os.path.join(self.dir.name, key + '.abc')
+            os.utime(path, (index, 1e9 + index))
+
+        self.cache.max_age = float('inf')
+        self.assertEqual(self.cache.evict(), 1)
+        self.assertIsNone(self.cache.get('a'))
+        self.assertIsNotNone(self.cache.get('c'))
+
+        self.cache.max_age = 0
+        self.assertEqual(self.cache.evict(), 2)
+
+    def test_build_file(self):
+        src = 'test_sources/astro_file_string.asx'
+        out = os.path.join(self.dir.name, 'out.abc')
+        self.cache.max_size = 1 << 20
+        options = build.Options()
+        self.assertFalse(build.build_file(src, out, options, self.cache))
+        with open(out, 'rb') as f:
+            first = f.read()
+        os.remove(out)
+        self.assertTrue(build.build_file(src, out, options, self.cache))
+        with open(out, 'rb') as f:
+            self.assertEqual(f.read(), first)
+
+
+class BuildTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.sources = []
+        for name, content in (('b.asx', '! f(x):\n    out x\n'),
+                              ('a.asx', '! f(:\n'),
+                              ('sub/c.asx', 'x = 1\n')):
+            path = os.path.join(self.dir.name, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w') as f:
+                f.write(content)
+            self.sources.append(path)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_collect_sources(self):
+        found = build.collect_sources([self.sources[0], self.dir.name])
+        self.assertEqual([os.path.relpath(p, self.dir.name) for p in found],
+                         ['b.asx', 'a.asx', os.path.join('sub', 'c.asx')])
+
+    def test_build_many(self):
+        for jobs in (1, 2):
+            results = build.build_many(self.sources, build.Options(), jobs)
+            self.assertEqual([r.src for r in results], self.sources)
+            self.assertEqual([r.ok for r in results], [True, False, True])
+            self.assertIn('invalid syntax', results[1].stderr)
+            self.assertTrue(os.path.exists(
+                os.path.join(self.dir.name, 'sub', 'c.abc')))
+
+    def test_errors(self):
+        with open(self.sources[0], 'wb') as f:
+            f.write(b'\xff\xfe\n')
+        for jobs in (1, 2):
+            results = build.build_many(self.sources, build.Options(), jobs)
+            self.assertEqual([r.ok for r in results], [False, False, True])
+            self.assertIn('UnicodeDecodeError', results[0].stderr)
+
+        results = build.compile_many([('a.asx', b'\xff'), ('b.asx', 'x = 1')])
+        self.assertEqual([r.ok for r in results], [False, True])
+        self.assertIn('UnicodeDecodeError', results[0].stderr)
+
+    def test_compile_source(self):
+        with open(self.sources[0]) as f:
+            text = f.read()
+        data = build.compile_source(text, 'b.asx')
+        self.assertEqual(data, build.compile_file(self.sources[0],
+                                                  build.Options()))
+        streamed = build.compile_source(text, 'b.asx',
+                                        build.Options(stream=True))
+        self.assertIsInstance(streamed, bytearray)
+
+        # Errors are raised instead of exiting
+        for options in (build.Options(), build.Options(stream=True)):
+            with self.assertRaises(build.CompileError) as caught:
+                build.compile_source('! f(:\n', 'a.asx', options)
+            self.assertIn('Compilation error in a.asx',
+                          caught.exception.diagnostics)
+            self.assertIn('invalid syntax', str(caught.exception))
+
+        results = build.compile_many([('b.asx', text), ('a.asx', '! f(:\n')])
+        self.assertEqual([r.ok for r in results], [True, False])
+        self.assertEqual(results[0].data, data)
+        self.assertIsNone(results[1].data)
+        self.assertIn('invalid syntax', results[1].stderr)
+
+    def test_error_position(self):
+        # The block comment collapses lines 2 and 3 into one
+        text = 'x = 1\n;; a block\ncomment ;; ) ( bad\ny = 2\n'
+        with open(self.sources[0], 'w') as f:
+            f.write(text)
+        expected = '   3 | comment ;; ) ( bad\n' \
+                   '                  ^~~~~~~\n'
+        for options in (build.Options(), build.Options(stream=True)):
+            with self.assertRaises(build.CompileError) as caught:
+                build.compile_source(text, 'b.asx', options)
+            self.assertIn(expected, caught.exception.diagnostics)
+
+            err = io.StringIO()
+            with redirect_stderr(err), self.assertRaises(SystemExit):
+                build.compile_file(self.sources[0], options)
+            self.assertIn(expected, err.getvalue())
+
+    def test_stream(self):
+        path = os.path.join(self.dir.name, 'big.asx')
+        with open(path, 'w') as f:
+            f.write(benchmark.generate_source('functions', 200))
+            f.write('x = 1\n' * (2 * build.STREAM_CHUNK))
+        for options in ({}, {'optimize': optimize.Optimizer.RULES},
+                        {'line_table': True}):
+            eager = listing(build.compile_file(path,
+                                               build.Options(**options)))
+            options = build.Options(stream=True, **options)
+            self.assertEqual(listing(build.compile_file(path, options)),
+                             eager)
+            build.build_file(path, None, options)
+            with open(build.output_path(path), 'rb') as f:
+                self.assertEqual(listing(f.read()), eager)
+        self.assertNotEqual(options.key(), build.Options().key())
+
+
+class StatsTests(unittest.TestCase):
+
+    def test_null(self):
+        with stats.NULL.phase('read'):
+            stats.NULL.count('lines', 1)
+        self.assertIsNone(stats.NULL.report())
+        self.assertFalse(stats.NULL.enabled)
+
+    def test_nested(self):
+        collector = stats.Stats()
+        with collector.phase('outer'):
+            data = bytearray(4_000_000)
+            del data
+            for _ in range(2):
+                with collector.phase('inner'):
+                    data = bytearray(1_000_000)
+                    del data
+        phases = collector.report()['phases']
+        self.assertGreaterEqual(phases['outer']['peak'], 4_000_000)
+        self.assertGreaterEqual(phases['inner']['peak'], 1_000_000)
+        self.assertLess(phases['inner']['peak'], 4_000_000)
+
+    def test_build(self):
+        result = build.build_one('test_sources/astro_file_comments.asx',
+                                 os.devnull, build.Options(stats=True))
+        self.assertTrue(result.ok, result.stderr)
+        self.assertEqual(list(result.stats['phases']),
+                         ['read', 'tokenize', 'parse', 'codegen', 'emit',
+                          'write'])
+        self.assertGreater(result.stats['counts']['tokens'], 0)
+        self.assertIn('tokens_per_sec', result.stats)
+        self.assertIn('total', stats.format_report('x', result.stats))
+
+        result = build.build_one('test_sources/astro_file_comments.asx',
+                                 os.devnull, build.Options())
+        self.assertIsNone(result.stats)
+
+
+class WatchTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.src = os.path.join(self.dir.name, 'w.asx')
+        self.lines = benchmark.generate_source('functions', 100).split('\n')
+        self.lines[2:2] = ['    ;; multiline', 'comment ;;']
+        self.inc = watch.IncrementalBuild(self.src)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def write(self):
+        with open(self.src, 'w') as f:
+            f.write('\n'.join(self.lines))
+
+    def disassemble(self, path: str) -> list:
+        with reader.Reader(path) as r:
+            return [line[10:] for line in reader.disassemble(r, source=True)]
+
+    def test_split_chunks(self):
+        chunks, is_open = watch.split_chunks(self.lines[:12])
+        self.assertEqual([start for start, _ in chunks], [0, 7])
+        self.assertFalse(is_open)
+        self.assertTrue(watch.split_chunks(['x', ';; open'])[1])
+
+    def test_update(self):
+        self.write()
+        self.assertTrue(self.inc.update())
+        self.assertFalse(self.inc.update())
+        with open(self.inc.output, 'rb') as f:
+            self.assertEqual(f.read(), build.compile_file(self.src,
+                                                          build.Options()))
+
+        full = os.path.join(self.dir.name, 'full.abc')
+        for edit in (lambda: self.lines.__setitem__(9, '    out changed'),
+                     lambda: self.lines.insert(9, '    y = 1'),
+                     lambda: self.lines.insert(30, '! g(z):'),
+                     lambda: self.lines.__delitem__(2)):
+            edit()
+            self.write()
+            self.inc.update()
+            self.assertLessEqual(self.inc.compiled, 2)
+            build.build_file(self.src, full, build.Options())
+            self.assertEqual(self.disassemble(self.inc.output),
+                             self.disassemble(full))
+
+    def test_line_table(self):
+        options = build.Options(line_table=True)
+        inc = watch.IncrementalBuild(self.src, options=options)
+        self.write()
+        inc.update()
+        self.lines.insert(9, '    y = 1')
+        self.write()
+        inc.update()
+        with open(inc.output, 'rb') as f:
+            self.assertEqual(f.read(), build.compile_file(self.src, options))
+
+    def test_prune(self):
+        options = build.Options(prune=True)
+        inc = watch.IncrementalBuild(self.src, options=options)
+        self.lines[:0] = ['! main():', '    func0(1, 2)', '']
+        self.write()
+        inc.update()
+        self.lines[1] = '    func5(1, 2)'
+        self.write()
+        inc.update()
+        with open(inc.output, 'rb') as f:
+            data = f.read()
+        self.assertEqual(data, build.compile_file(self.src, options))
+        self.assertLess(len(data), len(build.compile_file(self.src,
+                                                          build.Options())))
+
+    def test_imports(self):
+        lib = os.path.join(self.dir.name, 'lib.asx')
+        with open(lib, 'w') as f:
+            f.write('! helper(x):\n    out x\n')
+        inc = watch.IncrementalBuild(self.src, imports=[lib])
+        self.lines[:0] = ['import lib', '! main():', '    out 1', '']
+        self.lines += ['! late():', '    helper(1, 2)']
+        self.write()
+        # Nothing is checked until the imported module is built
+        self.assertTrue(inc.update())
+
+        # The call is reported at its line after the edit moved it
+        build.build_file(lib, None, build.Options())
+        raw = inc.raw
+        self.lines.insert(3, '    out 2')
+        self.write()
+        err = io.StringIO()
+        with redirect_stderr(err), self.assertRaises(SystemExit):
+            inc.update()
+        self.assertIn('helper from lib takes 1 arguments, 2 given',
+                      err.getvalue())
+        self.assertIn(f'{len(self.lines):4} |     helper(1, 2)',
+                      err.getvalue())
+        self.assertIs(inc.raw, raw)
+
+
+class BenchmarkTests(unittest.TestCase):
+
+    def test_shapes(self):
+        for shape in benchmark.SHAPES:
+            fd, path = tempfile.mkstemp(suffix='.asx')
+            with os.fdopen(fd, 'w') as f:
+                f.write(benchmark.generate_source(shape, 200))
+            try:
+                result = build.build_one(path, os.devnull, build.Options())
+            finally:
+                os.remove(path)
+            self.assertTrue(result.ok, f'{shape}: {result.stderr}')
+
+    def test_startup_imports(self):
+        fd, path = tempfile.mkstemp(suffix='.asx')
+        os.close(fd)
+        try:
+            imports = benchmark.import_times(path)
+        finally:
+            os.remove(path)
+            os.remove(os.path.splitext(path)[0] + '.abc')
+        names = [name for name, _, _ in imports]
+        self.assertIn('build', names)
+        for lazy in ('argparse', 'cache', 'json', 'pprint', 'shutil',
+                     'tempfile', 'typing'):
+            self.assertNotIn(lazy, names)
+
+    def test_compare(self):
+        baseline = {'deep': {'match': {'time': 1.0}}}
+        results = {'deep': {'match': {'time': 1.1}, 'read': {'time': 9}}}
+        self.assertEqual(benchmark.compare(results, baseline, 0.2), [])
+        self.assertEqual(benchmark.compare(results, baseline, 0.05),
+                         [('deep', 'match', 1.0, 1.1)])
+
 
 def suite():
     tests = unittest.TestSuite()
     tests.addTest(AstroFileTests('test_cleanup'))
+    tests.addTest(AstroFileTests('test_original_position'))
+    tests.addTest(AstroFileTests('test_stream'))
+    tests.addTest(AstroFileTests('test_cleanup_line_comment'))
+    tests.addTest(AstroFileTests('test_from_string'))
+    tests.addTest(AstroFileTests('test_original_source'))
+    tests.addTest(TokenizerTests('test_engines_match'))
+    tests.addTest(TokenizerTests('test_compact_match'))
+    tests.addTest(TokenizerTests('test_scan_names'))
+    tests.addTest(TokenizerTests('test_tabs'))
+    tests.addTest(ParserTests('test_match'))
+    tests.addTest(ParserTests('test_validate'))
+    tests.addTest(ParserTests('test_match_short'))
+    tests.addTest(ParserTests('test_match_cache'))
+    tests.addTest(ParserTests('test_collect'))
+    tests.addTest(ParserTests('test_collect_deep'))
+    tests.addTest(CodegenTests('test_generate'))
+    tests.addTest(OptimizerTests('test_rules'))
+    tests.addTest(OptimizerTests('test_toggle'))
+    tests.addTest(OptimizerTests('test_empty_else'))
+    tests.addTest(OptimizerTests('test_build'))
+    tests.addTest(CallGraphTests('test_prune'))
+    tests.addTest(CallGraphTests('test_library'))
+    tests.addTest(EmitterTests('test_build'))
+    tests.addTest(EmitterTests('test_intern'))
+    tests.addTest(EmitterTests('test_spool'))
+    tests.addTest(AvmTests('test_layouts'))
+    tests.addTest(AvmTests('test_hash'))
+    tests.addTest(AvmTests('test_pack'))
+    tests.addTest(ReaderTests('test_read'))
+    tests.addTest(ReaderTests('test_function'))
+    tests.addTest(ReaderTests('test_symbols'))
+    tests.addTest(ReaderTests('test_line_table'))
+    tests.addTest(ReaderTests('test_line_table_gap'))
+    tests.addTest(ReaderTests('test_invalid'))
+    tests.addTest(LinkTests('test_link'))
+    tests.addTest(LinkTests('test_duplicate'))
+    tests.addTest(LinkTests('test_sources'))
+    tests.addTest(DepsTests('test_scan'))
+    tests.addTest(DepsTests('test_order'))
+    tests.addTest(DepsTests('test_build'))
+    tests.addTest(DepsTests('test_failed_import'))
+    tests.addTest(CacheTests('test_key'))
+    tests.addTest(CacheTests('test_get_put'))
+    tests.addTest(CacheTests('test_evict'))
+    tests.addTest(CacheTests('test_build_file'))
+    tests.addTest(BuildTests('test_collect_sources'))
+    tests.addTest(BuildTests('test_build_many'))
+    tests.addTest(BuildTests('test_errors'))
+    tests.addTest(BuildTests('test_compile_source'))
+    tests.addTest(BuildTests('test_error_position'))
+    tests.addTest(BuildTests('test_stream'))
+    tests.addTest(StatsTests('test_null'))
+    tests.addTest(StatsTests('test_nested'))
+    tests.addTest(StatsTests('test_build'))
+    tests.addTest(WatchTests('test_split_chunks'))
+    tests.addTest(WatchTests('test_update'))
+    tests.addTest(WatchTests('test_line_table'))
+    tests.addTest(WatchTests('test_prune'))
+    tests.addTest(WatchTests('test_imports'))
+    tests.addTest(BenchmarkTests('test_shapes'))
+    tests.addTest(BenchmarkTests('test_startup_imports'))
+    tests.addTest(BenchmarkTests('test_compare'))
     return tests
 
 
@@ -0,0 +1,393 @@
+"""
+Incremental compilation for --watch. The source is split into chunks at
+every top level function, which the code generator already treats as
+independent, so only the chunks touched by an edit are tokenized, parsed and
+generated again, and only their instructions are packed into new code. Calls
+to the imported modules are checked against their last built bytecode.
+"""
+import os
+import struct
+import time
+from bisect import bisect_right
+
+import ac_parser
+import avm
+import build
+import deps
+from astro_file import AstroFile, comment_open
+from codegen import CodeGenerator, Instruction
+from emitter import Emitter
+from optimize import CallGraph, Optimizer
+from tokenizer import Tokenizer
+
+__author__  = 'bellrise'
+__version__ = '0.1'
+
+_PTR = struct.Struct('<I')
+_INS_SIZE = avm.bc_ins.SIZE
+# Offset of ins_source in a packed bc_ins
+_SOURCE_FIELD = struct.calcsize('<HH')
+
+
+class _ChunkFile(AstroFile):
+    """Lines of a single chunk, cleaned up like a streamed file would be and
+    numbered like they are in the whole file. """
+
+    def __init__(self, file_name: str, lines: list, start: int):
+        super().__init__(file_name, stream=True)
+        self._lines = lines
+        self._start = start
+
+    def _raw_lines(self):
+        return ((0, line) for line in self._lines)
+
+    def numbered_lines(self):
+        for number, offset, line in super().numbered_lines():
+            yield self._start + number, offset, line
+
+    def original_source(self, line: int, column: int = 0) -> tuple:
+        line, column, source = super().original_source(line - self._start,
+                                                       column)
+        return self._start + line, column, source
+
+
+class _Chunk:
+    """A top level function (or the code before the first one) along with
+    its generated instructions and their packed code. The line numbers in
+    the instructions are the ones from when the chunk started at
+    code_start. """
+
+    __slots__ = ('start', 'lines', 'code', 'code_start', 'width', 'packed',
+                 'graph', 'functions')
+
+    def __init__(self, start: int, lines: list):
+        self.start = start
+        self.lines = lines
+        self.code = None
+        self.code_start = start
+        self.width = 0
+        self.packed = None
+        self.graph = None
+        self.functions = None
+
+
+def split_chunks(lines: list, start: int = 0) -> list:
+    """Split raw source lines into (start, lines) chunks, starting a new one
+    at every line beginning with a '!' that is not inside of a block comment.
+    Returns the chunks and whether a block comment is open at the end. """
+    chunks = []
+    begin = 0
+    is_open = False
+    for index, line in enumerate(lines):
+        if index and not is_open and line.startswith('!'):
+            chunks.append((start + begin, lines[begin:index]))
+            begin = index
+        is_open = comment_open(line, is_open)
+
+    chunks.append((start + begin, lines[begin:]))
+    return chunks, is_open
+
+
+def _common_prefix(a: list, b: list) -> int:
+    """Return the length of the common prefix of two lists, comparing whole
+    blocks of lines first. """
+    size = min(len(a), len(b))
+    pos = 0
+    step = 256
+    while pos < size:
+        end = min(pos + step, size)
+        if a[pos:end] == b[pos:end]:
+            pos = end
+            continue
+        if step == 1:
+            break
+        step = max(1, step // 16)
+    return pos
+
+
+class IncrementalBuild:
+    """Keeps the chunks of a single source file between builds. Every call
+    to update() compares the file with the previous version line by line and
+    compiles only the chunks which changed. Chunks moved by added or removed
+    lines keep their instructions, and are only packed again with the new
+    line numbers. """
+
+    def __init__(self, src: str, output: str = None,
+                 options: build.Options = None, imports: list = ()):
+        """Prepare the incremental build. Nothing is compiled until the first
+        call to update().
+        :param src: path to the source code
+        :param output: path to the bytecode file, None for the default
+        :param options: compilation options
+        :param imports: sources of the imported modules, the calls to them
+                        are checked against their bytecode at the default
+                        output path
+        """
+        self.src = src
+        self.output = output or build.output_path(src)
+        self.options = options or build.Options()
+        self.imports = list(imports)
+        self.raw = None
+        self.chunks = []
+        self.compiled = 0
+        self._emitter = None
+        self._data_size = 0
+
+    def read(self) -> list:
+        """Return the raw lines of the source file. """
+        with open(self.src, 'r') as f:
+            return f.read().split('\n')
+
+    def update(self, lines: list = None) -> bool:
+        """Compile the changes made since the last update and write the
+        bytecode. Returns False if nothing changed. Compilation errors exit
+        like they do in a full build, leaving the previous state untouched.
+        :param lines: new raw lines, read from the file by default
+        """
+        lines = self.read() if lines is None else lines
+        if lines == self.raw:
+            return False
+
+        if self.raw is None:
+            chunks = self._compile(split_chunks(lines)[0], 0)
+            self._check_calls([(chunk, chunk.start) for chunk in chunks])
+            self._replace(0, 0, chunks, lines)
+        else:
+            self._update(lines)
+
+        self.write()
+        return True
+
+    def _update(self, lines: list):
+        old = self.raw
+        prefix = _common_prefix(old, lines)
+        limit = min(len(old), len(lines)) - prefix
+        suffix = _common_prefix(old[::-1][:limit], lines[::-1][:limit])
+        stop = len(old) - suffix
+        shift = len(lines) - len(old)
+
+        # A change at the start of a chunk may belong to the previous one,
+        # and the chunks are extended until no block comment crosses the end
+        starts = [chunk.start for chunk in self.chunks]
+        first = bisect_right(starts, max(prefix - 1, 0)) - 1
+        last = bisect_right(starts, max(stop - 1, prefix - 1, 0)) - 1
+        while True:
+            end = starts[last+1] if last + 1 < len(starts) else len(old)
+            begin = starts[first]
+            pieces, is_open = split_chunks(lines[begin:end+shift], begin)
+            if not is_open or last + 1 >= len(starts):
+                break
+            last += 1
+
+        width = next((c.width for c in self.chunks[:first] if c.width), 0)
+        chunks = self._compile(pieces, width)
+        self._check_calls(
+            [(c, c.start) for c in self.chunks[:first] + chunks]
+            + [(c, c.start + shift) for c in self.chunks[last+1:]]
+        )
+        self._replace(first, last + 1, chunks, lines, shift)
+
+    def _compile(self, pieces: list, width: int) -> list:
+        """Compile (start, lines) pieces into chunks. """
+        chunks = []
+        for start, lines in pieces:
+            chunk = _Chunk(start, lines)
+            file_obj = _ChunkFile(self.src, lines, start)
+            tokenizer = Tokenizer(file_obj, self.options.tokenizer,
+                                  self.options.compact)
+            tokenizer.tokenize()
+
+            parser = ac_parser.Parser(self.src, tokenizer.get_context(),
+                                      trust_me=True, source_file=file_obj)
+            parser.indent_width = width
+            contexts = parser.parse()
+            chunk.width = width = parser.indent_width
+            chunk.code = CodeGenerator(self.src).generate(contexts)
+            if self.options.optimize:
+                chunk.code = Optimizer(self.options.optimize) \
+                    .optimize(chunk.code)
+            chunk.graph = CallGraph(chunk.code)
+            chunks.append(chunk)
+        return chunks
+
+    def interfaces(self) -> dict:
+        """Return the interfaces of the imported modules which have been
+        built, by module name. """
+        found = {}
+        for dep in self.imports:
+            try:
+                found[build.module_name(dep)] = \
+                    deps.read_interface(build.output_path(dep))
+            except (OSError, ValueError):
+                # Not built yet, left for the virtual machine to check
+                pass
+        return found
+
+    def _check_calls(self, chunks: list):
+        """Check the calls to the imported modules like a full build would,
+        exiting with a compilation error before any state is changed.
+        :param chunks: (chunk, start) pairs of the whole module, with the
+                       line each chunk is going to start at
+        """
+        interfaces = self.interfaces()
+        if not interfaces:
+            return
+        local = {name for chunk, _ in chunks
+                 for _, _, name in chunk.graph.functions}
+        for chunk, start in chunks:
+            for ins, module, params in deps.wrong_calls(chunk.code,
+                                                        interfaces):
+                if ins.operands[0] in local:
+                    continue
+                line = ins.line + start - chunk.code_start
+                deps.call_error(self.src, Instruction(ins.type, ins.operands,
+                                                      line, ins.source),
+                                module, params)
+
+    def _replace(self, first: int, last: int, chunks: list, lines: list,
+                 shift: int = 0):
+        """Replace the chunks from first to last with the new ones, moving
+        the chunks after them by shift lines. If the width of an indent
+        changes, the chunks after them are compiled again since their
+        indents are checked against it. """
+        rest = self.chunks[last:]
+        before = next((c.width for c in self.chunks[:last] if c.width), 0)
+        after = next((c.width for c in self.chunks[:first] + chunks
+                      if c.width), 0)
+        compiled = len(chunks)
+        if before != after and rest:
+            rest = self._compile([(c.start + shift, c.lines) for c in rest],
+                                 after)
+            compiled += len(rest)
+        else:
+            for chunk in rest:
+                chunk.start += shift
+
+        self.chunks[first:] = chunks + rest
+        self.raw = lines
+        self.compiled = compiled
+
+    def build(self) -> bytearray:
+        """Pack the chunks which are new or were moved, and lay out the
+        module. The data segment is only appended to, so once it grows to
+        twice the size it had after packing everything, the emitter is
+        started over. A line table is laid out from every instruction in
+        order, and an edit anywhere may change which functions are pruned,
+        so with either of them the whole module is emitted again. """
+        graph = CallGraph()
+        for chunk in self.chunks:
+            graph.update(chunk.graph)
+
+        if self.options.line_table or self.options.prune:
+            emitter = self._new_emitter()
+            emitter.called = graph.reachable(build.ENTRY)
+            code = []
+            for chunk in self.chunks:
+                self._shift(chunk)
+                code += chunk.code
+                chunk.packed = None
+            if self.options.prune:
+                code = CallGraph(code).prune(code, build.ENTRY)
+            emitter.emit(code)
+            return emitter.build()
+
+        emitter = self._emitter
+        reset = emitter is None or len(emitter.data) > 2 * self._data_size
+        if reset:
+            emitter = self._emitter = self._new_emitter()
+
+        for chunk in self.chunks:
+            if self._shift(chunk):
+                if chunk.packed is not None and not reset:
+                    self._repoint(emitter, chunk)
+                    continue
+            elif chunk.packed is not None and not reset:
+                continue
+
+            mark = emitter.mark()
+            emitter.emit(chunk.code)
+            chunk.packed = emitter.pack_code(mark)
+            chunk.functions = emitter.functions(mark)
+
+        if reset:
+            self._data_size = len(emitter.data)
+
+        functions = []
+        pos = 0
+        for chunk in self.chunks:
+            functions.extend((pos + offset, name, ptr)
+                             for offset, name, ptr in chunk.functions)
+            pos += len(chunk.packed)
+        emitter.called = graph.reachable(build.ENTRY)
+        return emitter.build([chunk.packed for chunk in self.chunks],
+                             functions)
+
+    def _new_emitter(self) -> Emitter:
+        return Emitter(build.module_name(self.src),
+                       os.path.basename(self.src), build.ENTRY,
+                       not self.options.strip_debug, self.options.line_table)
+
+    @staticmethod
+    def _shift(chunk: _Chunk) -> bool:
+        """Move the line numbers of the instructions to where the chunk
+        starts now, returning True if it has moved. """
+        shift = chunk.start - chunk.code_start
+        if not shift:
+            return False
+        for ins in chunk.code:
+            if ins.line:
+                ins.line += shift
+        chunk.code_start = chunk.start
+        return True
+
+    @staticmethod
+    def _repoint(emitter: Emitter, chunk: _Chunk):
+        """Point the packed instructions of a moved chunk to the source
+        structures with their new line numbers. The operands do not change,
+        so the rest of the code is kept as is. """
+        packed = chunk.packed
+        pos = 0
+        for ins in chunk.code:
+            if ins.line and emitter.debug:
+                _PTR.pack_into(packed, pos + _SOURCE_FIELD,
+                               emitter.add_source(ins.line, ins.source))
+            pos += _INS_SIZE + _PTR.size * len(ins.operands)
+
+    def write(self):
+        with open(self.output, 'wb') as f:
+            f.write(self.build())
+
+
+def watch(builds: list, interval: float = 0.2, log=print):
+    """Poll the sources of the incremental builds and update them whenever
+    their modification time or size changes. Runs until interrupted.
+    :param builds: list of IncrementalBuild
+    :param interval: seconds between polls
+    :param log: function called with a message after every update
+    """
+    seen = {}
+    try:
+        while True:
+            for inc in builds:
+                try:
+                    stat = os.stat(inc.src)
+                except FileNotFoundError:
+                    continue
+                key = stat.st_mtime_ns, stat.st_size
+                if seen.get(inc.src) == key:
+                    continue
+                seen[inc.src] = key
+
+                start = time.perf_counter()
+                try:
+                    changed = inc.update()
+                except SystemExit:
+                    log(f'{inc.src}: failed, waiting for changes')
+                    continue
+                if changed:
+                    elapsed = (time.perf_counter() - start) * 1000
+                    log(f'{inc.src}: compiled {inc.compiled} of '
+                        f'{len(inc.chunks)} functions in {elapsed:.1f} ms')
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        pass